@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+from io import BytesIO
+from PIL import Image
+from server.project.projectArchive import ProjectArchive
+from server.segment_anything.automatic_mask_generator_onnx import (
+    SamAutomaticMaskGeneratorOnnx,
+)
+
+MODES = ["per_batch", "per_crop", "stored"]
+
+
+class CountingSession:
+    """
+    Wrap an onnxruntime session to count its runs
+    """
+
+    def __init__(self, session: ort.InferenceSession):
+        self.session = session
+        self.num_runs = 0
+
+    def get_inputs(self):
+        return self.session.get_inputs()
+
+    def run(self, output_names, input_feed):
+        self.num_runs += 1
+        return self.session.run(output_names, input_feed)
+
+
+class PerBatchEncodingGenerator(SamAutomaticMaskGeneratorOnnx):
+    """
+    Re-encode the crop for every batch of points, as the generator used to,
+    to measure the speedup of encoding once per crop
+    """
+
+    def _process_crop(self, image, crop_box, crop_layer_idx, orig_size, embedding=None):
+        x0, y0, x1, y1 = crop_box
+        self.cropped_im = Image.fromarray(image[y0:y1, x0:x1, :])
+        self.num_batches = 0
+        return super()._process_crop(image, crop_box, crop_layer_idx, orig_size, embedding)
+
+    def _process_batch(self, embeddings, *args):
+        if self.num_batches > 0:
+            embeddings = self._encode_image(self.cropped_im)
+        self.num_batches += 1
+        return super()._process_batch(embeddings, *args)
+
+
+def main(args):
+    archive = ProjectArchive(args.project)
+    project_info = archive.load_json(ProjectArchive.PROJECT_INFO_FILE)
+    embedding_layout = project_info.get(
+        "embedding_layout", ProjectArchive.EMBEDDING_LAYOUT_NPY
+    )
+    embedding_dtype = project_info.get("embedding_dtype", "float32")
+
+    image_filenames = archive.list_files(ProjectArchive.IMAGE_FOLDER)
+    image_filenames = image_filenames[: args.num_images]
+
+    encoder = CountingSession(ort.InferenceSession(args.encoder))
+    decoder = ort.InferenceSession(args.decoder)
+    generator_args = {
+        "points_per_side": args.points_per_side,
+        "points_per_batch": args.points_per_batch,
+        "crop_n_layers": args.crop_n_layers,
+        "low_res_filtering": args.low_res_filtering,
+    }
+    generators = {
+        "per_batch": PerBatchEncodingGenerator(encoder, decoder, **generator_args),
+        "per_crop": SamAutomaticMaskGeneratorOnnx(encoder, decoder, **generator_args),
+        "stored": SamAutomaticMaskGeneratorOnnx(encoder, decoder, **generator_args),
+    }
+
+    total_time = {mode: 0.0 for mode in MODES}
+    encoder_runs = {mode: 0 for mode in MODES}
+    num_masks = {mode: 0 for mode in MODES}
+
+    for image_filename in image_filenames:
+        print(f"Processing {image_filename} ...")
+        filename = os.path.splitext(image_filename)[0]
+        image = Image.open(BytesIO(archive.read(ProjectArchive.image_member(image_filename))))
+        image = np.array(image.convert("RGB"))
+
+        if embedding_layout == ProjectArchive.EMBEDDING_LAYOUT_PACKED:
+            embedding = archive.load_packed_embedding(filename)
+        else:
+            embedding = archive.load_embedding(filename, embedding_dtype)
+        embedding = np.array(embedding, dtype=np.float32)
+
+        for mode in MODES:
+            encoder.num_runs = 0
+            start_time = time.time()
+            if mode == "stored":
+                anns = generators[mode].generate(image, embedding)
+            else:
+                anns = generators[mode].generate(image)
+            total_time[mode] += time.time() - start_time
+            encoder_runs[mode] += encoder.num_runs
+            num_masks[mode] += len(anns)
+
+    num_images = len(image_filenames)
+    report = {}
+    print()
+    print(
+        f"{'mode':<12}{'s / image':>12}{'encoder runs':>15}{'masks':>10}{'speedup':>10}"
+    )
+    for mode in MODES:
+        report[mode] = {
+            "seconds_per_image": total_time[mode] / num_images,
+            "encoder_runs_per_image": encoder_runs[mode] / num_images,
+            "masks_per_image": num_masks[mode] / num_images,
+            "speedup": total_time["per_batch"] / max(total_time[mode], 1e-9),
+        }
+        print(
+            f"{mode:<12}"
+            f"{report[mode]['seconds_per_image']:>12.2f}"
+            f"{report[mode]['encoder_runs_per_image']:>15.1f}"
+            f"{report[mode]['masks_per_image']:>10.1f}"
+            f"{report[mode]['speedup']:>10.2f}"
+        )
+
+    # Encoding once per crop must not change the masks
+    if num_masks["per_batch"] != num_masks["per_crop"]:
+        print("Warning: encoding once per crop changed the number of masks")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    archive.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the automatic mask generator when the image is encoded per point batch, once per crop, or taken from the stored embedding"
+    )
+    parser.add_argument(
+        "--project", type=str, required=True, help="Path to a sample project (.sat)"
+    )
+    parser.add_argument(
+        "--encoder",
+        type=str,
+        default="models/vit_h_encoder_quantized.onnx",
+        help="Path to the encoder model. It should be the model used to create the project",
+    )
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        default="models/coralscop_decoder_quantized.onnx",
+        help="Path to the coral decoder model, with the category and feature outputs. It should be exported with the same model as the encoder",
+    )
+    parser.add_argument(
+        "--num_images", type=int, default=5, help="Number of images to benchmark"
+    )
+    parser.add_argument(
+        "--points_per_side", type=int, default=32, help="Number of grid points per side"
+    )
+    parser.add_argument(
+        "--points_per_batch", type=int, default=64, help="Number of points per decoder batch"
+    )
+    parser.add_argument(
+        "--crop_n_layers", type=int, default=0, help="Number of crop layers"
+    )
+    parser.add_argument(
+        "--low_res_filtering",
+        action="store_true",
+        help="Filter the masks at low resolution and upsample only the remaining masks",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Path to save the report as json"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from server.maskCreator import MaskCreator, Prompt
+from server.project.projectArchive import ProjectArchive
+from server.util.quantization import EMBEDDING_DTYPES, encode_embedding, decode_embedding
+
+
+def compute_iou(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum() / union)
+
+
+def main(args):
+    archive = ProjectArchive(args.project)
+    project_info = archive.load_json(ProjectArchive.PROJECT_INFO_FILE)
+    embedding_layout = project_info.get(
+        "embedding_layout", ProjectArchive.EMBEDDING_LAYOUT_NPY
+    )
+    embedding_dtype = project_info.get("embedding_dtype", "float32")
+    if embedding_dtype != "float32":
+        print(
+            f"Warning: the project stores {embedding_dtype} embeddings. "
+            f"The drift is measured against the dequantized embeddings."
+        )
+
+    image_filenames = archive.list_files(ProjectArchive.IMAGE_FOLDER)
+    image_filenames = image_filenames[: args.num_images]
+
+    mask_creator = MaskCreator(args.decoder)
+    rng = np.random.default_rng(args.seed)
+
+    disk_size = {dtype: 0 for dtype in EMBEDDING_DTYPES}
+    load_time = {dtype: 0.0 for dtype in EMBEDDING_DTYPES}
+    ious = {dtype: [] for dtype in EMBEDDING_DTYPES}
+
+    for image_filename in image_filenames:
+        print(f"Processing {image_filename} ...")
+        filename = os.path.splitext(image_filename)[0]
+        if embedding_layout == ProjectArchive.EMBEDDING_LAYOUT_PACKED:
+            reference = archive.load_packed_embedding(filename)
+        else:
+            reference = archive.load_embedding(filename, embedding_dtype)
+        reference = np.array(reference, dtype=np.float32)
+
+        annotation = archive.load_json(ProjectArchive.annotation_member(filename))
+        image_info = annotation["images"][0]
+        image_size = [image_info["height"], image_info["width"]]
+
+        prompts = [
+            Prompt(
+                {
+                    "imageX": int(rng.integers(0, image_size[1])),
+                    "imageY": int(rng.integers(0, image_size[0])),
+                    "label": 1,
+                }
+            )
+            for _ in range(args.num_prompts)
+        ]
+
+        # Reset the image for each prompt, so that the previous mask is not used as input
+        reference_masks = []
+        for prompt in prompts:
+            mask_creator.set_image(reference, image_size)
+            reference_masks.append(mask_creator.create_mask([prompt]))
+
+        for dtype in EMBEDDING_DTYPES:
+            encoded = encode_embedding(reference, dtype)
+            disk_size[dtype] += len(encoded)
+
+            start_time = time.time()
+            for _ in range(args.repeat):
+                embedding = decode_embedding(encoded, dtype)
+            load_time[dtype] += (time.time() - start_time) / args.repeat
+
+            for prompt, reference_mask in zip(prompts, reference_masks):
+                mask_creator.set_image(embedding, image_size)
+                mask = mask_creator.create_mask([prompt])
+                ious[dtype].append(compute_iou(reference_mask, mask))
+
+    num_images = len(image_filenames)
+    report = {}
+    print()
+    print(
+        f"{'dtype':<10}{'MB / image':>12}{'load ms / image':>18}"
+        f"{'mean IoU':>12}{'min IoU':>12}"
+    )
+    for dtype in EMBEDDING_DTYPES:
+        report[dtype] = {
+            "bytes_per_image": disk_size[dtype] / num_images,
+            "load_ms_per_image": load_time[dtype] / num_images * 1000,
+            "mean_iou": float(np.mean(ious[dtype])),
+            "min_iou": float(np.min(ious[dtype])),
+        }
+        print(
+            f"{dtype:<10}"
+            f"{report[dtype]['bytes_per_image'] / 1024 / 1024:>12.2f}"
+            f"{report[dtype]['load_ms_per_image']:>18.2f}"
+            f"{report[dtype]['mean_iou']:>12.4f}"
+            f"{report[dtype]['min_iou']:>12.4f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    archive.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the disk size, load time and mask IoU drift of the embedding storage types against float32"
+    )
+    parser.add_argument(
+        "--project", type=str, required=True, help="Path to a sample project (.sat)"
+    )
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        default="models/vit_h_decoder_quantized.onnx",
+        help="Path to the decoder model",
+    )
+    parser.add_argument(
+        "--num_images", type=int, default=20, help="Number of images to benchmark"
+    )
+    parser.add_argument(
+        "--num_prompts",
+        type=int,
+        default=10,
+        help="Number of random point prompts per image for the IoU drift",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of repeats for the load time"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--output", type=str, default=None, help="Path to save the report as json"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -6,6 +6,10 @@ from PIL import Image
 from server.project import ProjectCreator
 from server.util.requests import ProjectCreateRequest
 from server.embedding import EmbeddingGenerator
+from server.embeddingCache import EmbeddingCache
+from server.segment_anything.automatic_mask_generator_onnx import (
+    SamAutomaticMaskGeneratorOnnx,
+)
 from typing import Dict, List, Generator
 
 
@@ -69,6 +73,11 @@ def main(args):
     max_iou = args.max_iou
 
     embedding_model_path = args.embedding_model
+    embedding_layout = args.embedding_layout
+    embedding_dtype = args.embedding_dtype
+    encoder_batch_size = args.encoder_batch_size
+    resume = args.resume
+    assert encoder_batch_size > 0, "Encoder batch size should be greater than 0"
 
     print(f"Creating projects for {len(image_files)} images")
     print(f"Output directory: {output_dir}")
@@ -77,6 +86,11 @@ def main(args):
     print(f"Minimum confidence: {min_confidence}")
     print(f"Maximum IOU: {max_iou}")
     print(f"Embedding model: {embedding_model_path}")
+    print(f"Embedding layout: {embedding_layout} ({embedding_dtype})")
+    print(f"Encoder batch size: {encoder_batch_size}")
+    print(f"Resume: {resume}")
+    print(f"Embedding cache: {args.embedding_cache_dir}")
+    print(f"Detect coral: {args.detect_coral}")
 
     project_requests = []
     for idx, image_batch in enumerate(batch_iterator(image_files, batch_size)):
@@ -94,6 +108,11 @@ def main(args):
             "minArea": min_area,
             "minConfidence": min_confidence,
             "maxIOU": max_iou,
+            "embeddingLayout": embedding_layout,
+            "embeddingDtype": embedding_dtype,
+            "encoderBatchSize": encoder_batch_size,
+            "resume": resume,
+            "detectCoral": args.detect_coral,
         }
 
         request["inputs"] = inputs
@@ -104,14 +123,41 @@ def main(args):
         project_requests.append(project_request)
 
     # Create embedding model
-    embedding_generator = EmbeddingGenerator(embedding_model_path)
+    embedding_cache = None
+    if args.embedding_cache_dir is not None:
+        embedding_cache = EmbeddingCache(
+            args.embedding_cache_dir,
+            embedding_model_path,
+            int(args.embedding_cache_size * 1024 * 1024 * 1024),
+        )
+    embedding_generator = EmbeddingGenerator(embedding_model_path, embedding_cache)
 
-    project_creator = ProjectCreator(embedding_generator)
+    # The masks are generated from the embeddings of the embedding model, so
+    # the decoder should be exported with the same model
+    mask_generator = None
+    if args.detect_coral:
+        mask_generator = SamAutomaticMaskGeneratorOnnx(
+            embedding_model_path,
+            args.decoder_model,
+            points_per_side=args.points_per_side,
+            pred_iou_thresh=min_confidence,
+            output_mode="coco_rle",
+            low_res_filtering=True,
+            num_workers=args.detection_workers,
+        )
+
+    project_creator = ProjectCreator(embedding_generator, mask_generator)
 
     for idx, request in enumerate(project_requests):
+        if resume and os.path.exists(request.get_output_file()):
+            print(f"Project {idx + 1} already exists. Skipped.")
+            continue
         print(f"Creating project {idx + 1} ...")
         project_creator.create_(request, frontend_enabled=False)
 
+    if mask_generator is not None:
+        mask_generator.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Project Projects")
@@ -148,5 +194,65 @@ if __name__ == "__main__":
         default="models/vit_h_encoder_quantized.onnx",
         help="Path to the embedding model",
     )
+    parser.add_argument(
+        "--embedding_layout",
+        type=str,
+        default="npy",
+        choices=["npy", "packed"],
+        help="Store one npy file per image, or pack all embeddings into one memory-mappable file",
+    )
+    parser.add_argument(
+        "--embedding_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "int8"],
+        help="Data type of the stored embeddings. int8 is quantized per channel",
+    )
+    parser.add_argument(
+        "--encoder_batch_size",
+        type=int,
+        default=1,
+        help="Number of images embedded in one encoder run. Requires an encoder exported with a dynamic batch axis",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="Folder of the embedding cache shared across projects. Images embedded before are not encoded again",
+    )
+    parser.add_argument(
+        "--embedding_cache_size",
+        type=float,
+        default=4,
+        help="Maximum size of the embedding cache in GB",
+    )
+    parser.add_argument(
+        "--detect_coral",
+        action="store_true",
+        help="Detect the corals in each image and save them as annotations, filtered by the minimum area, minimum confidence and maximum IOU",
+    )
+    parser.add_argument(
+        "--decoder_model",
+        type=str,
+        default="models/coralscop_decoder_quantized.onnx",
+        help="Path to the coral decoder model used for detection",
+    )
+    parser.add_argument(
+        "--points_per_side",
+        type=int,
+        default=32,
+        help="Number of grid points per side prompted for detection",
+    )
+    parser.add_argument(
+        "--detection_workers",
+        type=int,
+        default=0,
+        help="Number of processes generating masks for detection. The images of each encoder batch are detected in parallel, one per process",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the existing projects and continue an interrupted project from its completed images",
+    )
     args = parser.parse_args()
     main(args)
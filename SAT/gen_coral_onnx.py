@@ -17,6 +17,11 @@ def export_encoder(sam, output):
         args=torch.randn(1, 3, 1024, 1024),
         input_names=["images"],
         output_names=["embeddings"],
+        # Allow embedding multiple images in one run
+        dynamic_axes={
+            "images": {0: "batch_size"},
+            "embeddings": {0: "batch_size"}
+        },
         export_params=True,
     )  
 
@@ -40,18 +45,25 @@ def export_decoder(sam, output):
     mask_input_size = [4 * x for x in embed_size]
 
 
+    # Axis 0 of the point prompts is the number of prompts decoded in one run
+    # against the same image embedding, e.g. a batch of grid points
     dynamic_axes = {
-        "point_coords": {1: "num_points"},
-        "point_labels": {1: "num_points"},
+        "point_coords": {0: "num_prompts", 1: "num_points"},
+        "point_labels": {0: "num_prompts", 1: "num_points"},
+        "masks": {0: "num_prompts"},
+        "iou_predictions": {0: "num_prompts"},
+        "low_res_masks": {0: "num_prompts"},
+        "cate_pred": {0: "num_prompts"},
+        "fc_features": {0: "num_prompts"},
     }
 
 
-    output_names = ["masks", "iou_predictions", "low_res_masks"]
+    output_names = ["masks", "iou_predictions", "low_res_masks", "cate_pred", "fc_features"]
 
     dummy_inputs = {
         "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
-        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
-        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(2, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(2, 5), dtype=torch.float),
         "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
         "has_mask_input": torch.tensor([1], dtype=torch.float),
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
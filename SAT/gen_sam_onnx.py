@@ -14,6 +14,11 @@ def export_encoder(sam, output):
         args=torch.randn(1, 3, 1024, 1024),
         input_names=["images"],
         output_names=["embeddings"],
+        # Allow embedding multiple images in one run
+        dynamic_axes={
+            "images": {0: "batch_size"},
+            "embeddings": {0: "batch_size"}
+        },
         export_params=True
     )  
     quantize_output = output.replace(".onnx", "_quantized.onnx")
@@ -1,7 +1,12 @@
 import logging
+import mimetypes
+import bottle
 import eel
 
 from server.server import Server
+from server.maskCreator import MaskCreator
+from server.util.coco import RLE_VIS_FORMAT_LIST
+from server.project import ProjectLoader
 from typing import List, Dict, Tuple
 from server.util.requests import FileDialogRequest
 
@@ -92,8 +97,13 @@ def get_data_list() -> List[Dict]:
 
 
 @eel.expose
-def save_data(data: Dict):
-    server.save_data(data)
+def save_data(data: Dict) -> int:
+    return server.save_data(data)
+
+
+@eel.expose
+def save_data_patch(patch: Dict) -> Dict:
+    return server.save_data_patch(patch)
 
 
 @eel.expose
@@ -102,8 +112,29 @@ def save_dataset(output_path: str):
 
 
 @eel.expose
-def create_mask(prompts: List[Dict]) -> Dict:
-    return server.create_mask(prompts)
+def create_mask(
+    prompts: List[Dict],
+    session_id: str = MaskCreator.DEFAULT_SESSION_ID,
+    image_idx: int = None,
+    rle_format: str = RLE_VIS_FORMAT_LIST,
+    roi: bool = False,
+) -> Dict:
+    return server.create_mask(prompts, session_id, image_idx, rle_format, roi)
+
+
+@eel.expose
+def speculate_mask(
+    prompt_sets: List[List[Dict]],
+    session_id: str = MaskCreator.DEFAULT_SESSION_ID,
+    image_idx: int = None,
+    roi: bool = False,
+):
+    server.speculate_mask(prompt_sets, session_id, image_idx, roi)
+
+
+@eel.expose
+def close_mask_session(session_id: str):
+    server.close_mask_session(session_id)
 
 
 @eel.expose
@@ -111,6 +142,13 @@ def get_data_ids_by_category_id(category_id: int) -> List[int]:
     return server.get_data_ids_by_category_id(category_id)
 
 
+@eel.expose
+def get_similar_masks(
+    image_idx: int, annotation_id: int, top_k: int = 100, min_similarity: float = 0.8
+) -> List[Dict]:
+    return server.get_similar_masks(image_idx, annotation_id, top_k, min_similarity)
+
+
 @eel.expose
 def export_images(output_dir: str):
     server.export_images(output_dir)
@@ -131,6 +169,36 @@ def import_json(input_path: str):
     server.import_json(input_path)
 
 
+@bottle.route(f"/{ProjectLoader.PROJECT_IMAGE_ROUTE}/<token>/<image_name:path>")
+def get_project_image(token: str, image_name: str):
+    """
+    Serve an image of the opened project straight from the project file
+    """
+    image = server.get_project_image(token, image_name)
+    if image is None:
+        raise bottle.HTTPError(404, f"Image {image_name} not found")
+
+    content_type, _ = mimetypes.guess_type(image_name)
+    bottle.response.content_type = content_type or "application/octet-stream"
+    # The images of an opened project never change
+    bottle.response.set_header("Cache-Control", "private, max-age=86400")
+    return image
+
+
+@bottle.route(f"/{ProjectLoader.PROJECT_THUMBNAIL_ROUTE}/<token>/<image_name:path>")
+def get_project_thumbnail(token: str, image_name: str):
+    """
+    Serve the thumbnail of an image of the opened project
+    """
+    thumbnail = server.get_project_thumbnail(token, image_name)
+    if thumbnail is None:
+        raise bottle.HTTPError(404, f"Thumbnail of {image_name} not found")
+
+    bottle.response.content_type = "image/jpeg"
+    bottle.response.set_header("Cache-Control", "private, max-age=86400")
+    return thumbnail
+
+
 if __name__ == "__main__":
     setup_logging()
     print("Please wait for the tool to be ready ...")
@@ -1,7 +1,10 @@
+import logging
 import numpy as np
-import copy
+import threading
 
-from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
+from .util.cache import LRUCache
 from .util.coco import rle_mask_to_rle_vis_encoding
 
 
@@ -10,10 +13,19 @@ class Data:
     def __init__(self):
         self.image_name = None
         self.image_path = None
+        self.thumbnail_path = None
         self.idx = -1
         self.embedding = None
+        self.embedding_loader: Callable[[], np.ndarray] = None
         self.segmentation = None
 
+        # Visualization RLE of the annotations, keyed by their COCO RLE
+        self.rle_vis_cache: Dict[Tuple, List[int]] = {}
+
+        # Incremented on every change of the segmentation, so that a client
+        # can only patch the version it has seen
+        self.version = 0
+
     def set_image_name(self, image_name: str):
         self.image_name = image_name
 
@@ -26,6 +38,15 @@ class Data:
     def get_image_path(self) -> str:
         return self.image_path
 
+    def set_thumbnail_path(self, thumbnail_path: str):
+        self.thumbnail_path = thumbnail_path
+
+    def get_thumbnail_path(self) -> str:
+        """
+        Path to the downscaled image for the gallery, or None to use the image itself
+        """
+        return self.thumbnail_path
+
     def set_idx(self, idx: int):
         self.idx = idx
 
@@ -35,11 +56,120 @@ class Data:
     def set_embedding(self, embedding: np.ndarray):
         self.embedding = embedding
 
+    def set_embedding_loader(self, embedding_loader: Callable[[], np.ndarray]):
+        """
+        Set the function used to read the embedding on demand,
+        when the embedding is not held in memory
+        """
+        self.embedding_loader = embedding_loader
+
     def get_embedding(self) -> np.ndarray:
+        if self.embedding is None and self.embedding_loader is not None:
+            return self.embedding_loader()
         return self.embedding
 
     def set_segmentation(self, segmentation: Dict):
         self.segmentation = segmentation
+        self.version += 1
+        self.prune_rle_vis_cache()
+
+    def apply_patch(self, patch: Dict):
+        """
+        Apply the changes of the annotations in place:
+        {
+            "added": List[Dict] - New annotations,
+            "updated": List[Dict] - Annotations replacing those of the same id,
+            "deleted": List[int] - Ids of the removed annotations
+        }
+        """
+        assert self.segmentation is not None, "Data has no segmentation"
+        added = patch.get("added", [])
+        updated = {annotation["id"]: annotation for annotation in patch.get("updated", [])}
+        deleted_ids = set(patch.get("deleted", []))
+
+        annotations = self.segmentation["annotations"]
+        existing_ids = {annotation["id"] for annotation in annotations}
+        for annotation_id in list(updated.keys()) + list(deleted_ids):
+            assert (
+                annotation_id in existing_ids
+            ), f"Annotation {annotation_id} not found in data {self.idx}"
+        remaining_ids = existing_ids - deleted_ids
+        for annotation in added:
+            assert (
+                annotation["id"] not in remaining_ids
+            ), f"Annotation {annotation['id']} already exists in data {self.idx}"
+            remaining_ids.add(annotation["id"])
+
+        self.drop_stale_feature_ids(added + list(updated.values()))
+
+        annotations = [
+            updated.get(annotation["id"], annotation)
+            for annotation in annotations
+            if annotation["id"] not in deleted_ids
+        ]
+        annotations.extend(added)
+
+        self.segmentation["annotations"] = annotations
+        self.version += 1
+        self.prune_rle_vis_cache()
+
+    def drop_stale_feature_ids(self, annotations: List[Dict]):
+        """
+        Remove the feature_id of the given annotations, unless they keep the
+        segmentation of the detected coral the feature belongs to. A new or
+        changed mask must not take the feature of another mask, e.g. when the
+        label page reuses the id of a deleted mask.
+        """
+        segmentation_keys = {}
+        if self.segmentation is not None:
+            for annotation in self.segmentation["annotations"]:
+                if "feature_id" in annotation:
+                    segmentation_keys[annotation["feature_id"]] = (
+                        self.get_rle_vis_key(annotation)
+                    )
+
+        for annotation in annotations:
+            feature_id = annotation.get("feature_id")
+            if feature_id is None:
+                continue
+            if segmentation_keys.get(feature_id) != self.get_rle_vis_key(annotation):
+                del annotation["feature_id"]
+
+    def get_version(self) -> int:
+        return self.version
+
+    def prune_rle_vis_cache(self):
+        """
+        Keep the visualization RLE of the masks that are not changed
+        """
+        keys = set()
+        if self.segmentation is not None:
+            keys = {
+                self.get_rle_vis_key(annotation)
+                for annotation in self.segmentation["annotations"]
+            }
+        self.rle_vis_cache = {
+            key: rle_vis for key, rle_vis in self.rle_vis_cache.items() if key in keys
+        }
+
+    def get_rle_vis_key(self, annotation: Dict) -> Tuple:
+        segmentation = annotation["segmentation"]
+        counts = segmentation["counts"]
+        if isinstance(counts, list):
+            counts = tuple(counts)
+        return (counts, tuple(segmentation["size"]))
+
+    def get_rle_vis(self, annotation: Dict) -> List[int]:
+        """
+        Get the RLE of the annotation for the frontend visualization, which is
+        computed once per mask
+        """
+        key = self.get_rle_vis_key(annotation)
+        rle_vis = self.rle_vis_cache.get(key)
+        if rle_vis is None:
+            rle_vis = rle_mask_to_rle_vis_encoding(annotation["segmentation"])
+            self.rle_vis_cache[key] = rle_vis
+        return rle_vis
 
     def get_segmentation(self) -> Dict:
         return self.segmentation
@@ -57,6 +187,7 @@ class Data:
             "image_name": "image_name",
             "image_path": "image_path",
             "idx": 0,
+            "version": Version of the segmentation, to be sent back with the patches,
             "segmentation": Json information containing ["images" and "annotations"]. Also note that there is
             an additional key "rle" which is the RLE encoding for the segmentation mask for visualization.
         }
@@ -67,15 +198,19 @@ class Data:
         assert self.idx != -1, "Data has no index"
         assert self.segmentation is not None, "Data has no segmentation"
 
-        # Convert the segmentation mask encoding to RLE for front end visualization
-        segmentation = copy.deepcopy(self.segmentation)
-        for annotation in segmentation["annotations"]:
-            annotation["rle"] = rle_mask_to_rle_vis_encoding(annotation["segmentation"])
+        # Add the RLE for front end visualization to a shallow copy of the
+        # annotations, as the response is only serialized
+        segmentation = dict(self.segmentation)
+        segmentation["annotations"] = [
+            dict(annotation, rle=self.get_rle_vis(annotation))
+            for annotation in self.segmentation["annotations"]
+        ]
 
         return {
             "image_name": self.image_name,
             "image_path": self.image_path,
             "idx": self.idx,
+            "version": self.version,
             "segmentation": segmentation,
         }
 
@@ -83,19 +218,52 @@ class Data:
         return {
             "image_name": self.image_name,
             "image_path": self.image_path,
+            "thumbnail_path": self.thumbnail_path,
             "idx": self.idx,
         }
 
 
 class Dataset:
 
-    def __init__(self):
+    # Embeddings read on demand are kept in a LRU cache bounded by this number of bytes.
+    # An embedding of 1x256x64x64 float32 takes 4 MB.
+    DEFAULT_EMBEDDING_CACHE_BYTES = 512 * 1024 * 1024
+
+    # Number of neighbouring embeddings to load in background, on each side
+    DEFAULT_PREFETCH_RADIUS = 2
+
+    def __init__(
+        self,
+        embedding_cache_bytes: int = DEFAULT_EMBEDDING_CACHE_BYTES,
+        prefetch_radius: int = DEFAULT_PREFETCH_RADIUS,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
 
         # Key is the image idx, and the value is the Data object
         self.data: Dict[int, Data] = {}
         self.category_info: List[Dict] = None
         self.last_saved_id = 0
 
+        # Index of the data whose segmentation is modified since the last save
+        self.dirty_data_ids: Set[int] = set()
+
+        # Opened project file, if the dataset is loaded lazily
+        self.archive = None
+
+        # Storage format of the embeddings in the project file
+        self.embedding_layout = "npy"
+        self.embedding_dtype = "float32"
+
+        # Cache of the embeddings that are read on demand. Key is the image idx
+        self.embedding_cache = LRUCache(embedding_cache_bytes)
+        self.prefetch_radius = prefetch_radius
+        self.prefetch_executor: ThreadPoolExecutor = None
+        self.pending_embeddings: Dict[int, Future] = {}
+        self.pending_lock = threading.Lock()
+
+        # Serializes the changes of the segmentations by the clients
+        self.data_lock = threading.Lock()
+
     def add_data(self, data: Data):
         """
         Add data to the dataset.
@@ -109,8 +277,158 @@ class Dataset:
         """
         assert data_idx in self.data, f"Data at index {data_idx} not found"
         data = self.data[data_idx]
-        data.set_segmentation(segmentation)
-        self.last_saved_id = data_idx
+        with self.data_lock:
+            data.drop_stale_feature_ids(segmentation["annotations"])
+            data.set_segmentation(segmentation)
+            self.last_saved_id = data_idx
+            self.mark_dirty(data_idx)
+
+    def patch_data(self, data_idx: int, version: int, patch: Dict) -> bool:
+        """
+        Apply the changes of the annotations to the data at the given index,
+        see Data.apply_patch. The patch is rejected if the data changed since
+        the given version, so that a stale client does not overwrite a newer
+        segmentation.
+
+        Returns:
+        - bool: True if the patch is applied
+        """
+        assert data_idx in self.data, f"Data at index {data_idx} not found"
+        data = self.data[data_idx]
+        with self.data_lock:
+            if data.get_version() != version:
+                self.logger.warning(
+                    f"Rejected patch of data {data_idx} at version {version}, current version is {data.get_version()}"
+                )
+                return False
+            data.apply_patch(patch)
+            self.last_saved_id = data_idx
+            self.mark_dirty(data_idx)
+        return True
+
+    def mark_dirty(self, data_idx: int):
+        """
+        Mark the segmentation of the data as modified since the last save
+        """
+        self.dirty_data_ids.add(data_idx)
+
+    def get_dirty_data_ids(self) -> List[int]:
+        return sorted(self.dirty_data_ids)
+
+    def clear_dirty_data_ids(self, data_ids: List[int]):
+        """
+        Clear the given data ids after they are saved
+        """
+        self.dirty_data_ids.difference_update(data_ids)
+
+    def set_archive(self, archive):
+        self.archive = archive
+
+    def get_archive(self):
+        return self.archive
+
+    def set_embedding_format(self, embedding_layout: str, embedding_dtype: str):
+        self.embedding_layout = embedding_layout
+        self.embedding_dtype = embedding_dtype
+
+    def get_embedding_layout(self) -> str:
+        return self.embedding_layout
+
+    def get_embedding_dtype(self) -> str:
+        return self.embedding_dtype
+
+    def get_embedding(self, idx: int) -> np.ndarray:
+        """
+        Get the embedding of the data at the given index.
+
+        Embeddings that are not held in memory by the data are read
+        through the embedding cache. If the embedding is being prefetched,
+        wait for the prefetch instead of reading it again.
+        """
+        data = self.data[idx]
+        if data.embedding is not None:
+            return data.embedding
+
+        embedding = self.embedding_cache.get(idx)
+        if embedding is not None:
+            return embedding
+
+        with self.pending_lock:
+            future = self.pending_embeddings.get(idx, None)
+        if future is not None:
+            embedding = future.result()
+            if embedding is not None:
+                return embedding
+
+        return self.load_embedding(idx)
+
+    def load_embedding(self, idx: int) -> np.ndarray:
+        embedding = self.data[idx].get_embedding()
+
+        # Memory-mapped embeddings are backed by the page cache already
+        if embedding is not None and not isinstance(embedding, np.memmap):
+            self.embedding_cache.put(idx, embedding)
+        return embedding
+
+    def prefetch(self, idx: int):
+        """
+        Load the embeddings of the neighbours of the given index in background,
+        so that moving to the next or previous data does not wait for the disk.
+        """
+        if self.prefetch_radius <= 0:
+            return
+
+        if self.prefetch_executor is None:
+            self.prefetch_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="EmbeddingPrefetch"
+            )
+
+        # Nearest neighbours first
+        targets = []
+        for offset in range(1, self.prefetch_radius + 1):
+            targets.append(idx + offset)
+            targets.append(idx - offset)
+
+        for target in targets:
+            if target not in self.data:
+                continue
+            if self.data[target].embedding is not None:
+                continue
+            if self.embedding_cache.contains(target):
+                continue
+
+            with self.pending_lock:
+                if target in self.pending_embeddings:
+                    continue
+                future = self.prefetch_executor.submit(self.prefetch_, target)
+                self.pending_embeddings[target] = future
+
+    def prefetch_(self, idx: int) -> np.ndarray:
+        try:
+            embedding = self.load_embedding(idx)
+            if isinstance(embedding, np.memmap):
+                # Touch the pages, so that switching to the image is a page cache hit
+                embedding.max()
+            return embedding
+        except Exception as e:
+            self.logger.error(f"Failed to prefetch embedding {idx}: {e}")
+            return None
+        finally:
+            with self.pending_lock:
+                self.pending_embeddings.pop(idx, None)
+
+    def close(self):
+        """
+        Release the resources held by the dataset
+        """
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown(wait=True)
+            self.prefetch_executor = None
+        self.embedding_cache.clear()
+
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
 
     def get_last_saved_id(self) -> int:
         return self.last_saved_id
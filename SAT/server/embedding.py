@@ -5,11 +5,13 @@ import onnxruntime as ort
 import time
 from PIL import Image
 from segment_anything import sam_model_registry, SamPredictor
+from typing import List
+from .embeddingCache import EmbeddingCache, hash_image
 from .util.onnx import preprocess_image
 
 
 class EmbeddingGenerator:
-    def __init__(self, model_path):
+    def __init__(self, model_path, embedding_cache: EmbeddingCache = None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info(f"Initializing {self.__class__.__name__} ...")
         self.logger.info(f"Loading model from {model_path}")
@@ -17,11 +19,82 @@ class EmbeddingGenerator:
         execution_providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
         self.encoder = ort.InferenceSession(model_path, providers=execution_providers)
 
+        # Encoders exported with a dynamic batch axis can embed multiple
+        # images in one run. Older exports have a fixed batch size of 1.
+        batch_dim = self.encoder.get_inputs()[0].shape[0]
+        self.batch_supported = not isinstance(batch_dim, int)
+        self.logger.info(f"Batch inference supported: {self.batch_supported}")
+
+        # Embeddings of images seen before are loaded from the cache
+        self.embedding_cache = embedding_cache
+
+    def is_batch_supported(self) -> bool:
+        return self.batch_supported
+
+    def set_embedding_cache(self, embedding_cache: EmbeddingCache):
+        self.embedding_cache = embedding_cache
+
+    def get_embedding_cache(self) -> EmbeddingCache:
+        return self.embedding_cache
+
     def generate_embedding(self, image: np.ndarray) -> np.ndarray:
+        image_hash = None
+        if self.embedding_cache is not None:
+            image_hash = hash_image(image)
+            embedding = self.embedding_cache.get_by_key(image_hash)
+            if embedding is not None:
+                self.logger.info("Embedding loaded from cache")
+                return embedding
+
         start_time = time.time()
         input_tensor = preprocess_image(Image.fromarray(image))
         outputs = self.encoder.run(None, {"images": input_tensor})
         self.logger.info(
             f"Generate embedding time: {time.time() - start_time:.2f} seconds"
         )
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.put_by_key(image_hash, outputs[0])
         return outputs[0]
+
+    def generate_embeddings(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Generate the embeddings of multiple images in one encoder run.
+        Falls back to one run per image if the encoder does not support batching.
+        Only the images missing from the embedding cache are encoded.
+
+        Returns:
+        - List[np.ndarray]: 1 x 256 x 64 x 64 embedding of each image
+        """
+        if not self.batch_supported or len(images) == 1:
+            return [self.generate_embedding(image) for image in images]
+
+        embeddings = [None] * len(images)
+        image_hashes = [None] * len(images)
+        if self.embedding_cache is not None:
+            for idx, image in enumerate(images):
+                image_hashes[idx] = hash_image(image)
+                embeddings[idx] = self.embedding_cache.get_by_key(image_hashes[idx])
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if self.embedding_cache is not None:
+            self.logger.info(
+                f"{len(images) - len(missing)} of {len(images)} embeddings loaded from cache"
+            )
+        if len(missing) == 0:
+            return embeddings
+
+        start_time = time.time()
+        input_tensor = np.concatenate(
+            [preprocess_image(Image.fromarray(images[idx])) for idx in missing], axis=0
+        )
+        outputs = self.encoder.run(None, {"images": input_tensor})
+        self.logger.info(
+            f"Generate {len(missing)} embeddings time: {time.time() - start_time:.2f} seconds"
+        )
+
+        for idx, embedding in zip(missing, outputs[0]):
+            embeddings[idx] = embedding[None]
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_by_key(image_hashes[idx], embeddings[idx])
+        return embeddings
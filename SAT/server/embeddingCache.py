@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+from typing import Dict, Optional
+from .util.diskCache import DiskCache
+
+
+def hash_image(image: np.ndarray) -> str:
+    """
+    Hash the decoded pixels of the image, so that the same photo has the same
+    hash whether it is read from a file or from an image url
+    """
+    image = np.ascontiguousarray(image)
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{image.shape}:{image.dtype.str}".encode("utf-8"))
+    hasher.update(image.data)
+    return hasher.hexdigest()
+
+
+def hash_file(file_path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of image embeddings shared across projects. The embeddings
+    are stored as npy files keyed by the hash of the image content, in a sub
+    folder keyed by the hash of the encoder model:
+
+    cache_dir/
+        model_hashes.json
+        <model hash>/
+            <image hash>.npy
+
+    The total size of the cached embeddings is bounded, see DiskCache.
+    """
+
+    MODEL_HASH_FILE = "model_hashes.json"
+
+    def __init__(self, cache_dir: str, model_path: str, max_bytes: int):
+        assert max_bytes >= 0, "Cache size must be non-negative"
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = cache_dir
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.model_hash = self.get_model_hash(model_path)
+        self.model_dir = os.path.join(cache_dir, self.model_hash)
+        self.cache = DiskCache(self.model_dir, ".npy", max_bytes)
+        self.logger.info(
+            f"Embedding cache at {self.model_dir} with {self.cache.get_num_entries()} embeddings ({self.cache.get_size_bytes() / 1024 / 1024:.1f} MB)"
+        )
+
+    def get_model_hash(self, model_path: str) -> str:
+        """
+        Hash the model file. Hashing a large model takes a while, so the hash is
+        remembered in the cache folder by the path, size and modification time.
+        """
+        stat = os.stat(model_path)
+        model_key = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        model_hash_path = os.path.join(self.cache_dir, EmbeddingCache.MODEL_HASH_FILE)
+        model_hashes: Dict[str, str] = {}
+        if os.path.exists(model_hash_path):
+            try:
+                with open(model_hash_path) as f:
+                    model_hashes = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Failed to read model hashes: {e}")
+
+        if model_key not in model_hashes:
+            self.logger.info(f"Hashing model {model_path} ...")
+            model_hashes[model_key] = hash_file(model_path)
+            temp_path = model_hash_path + f".{os.getpid()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(model_hashes, f, indent=4)
+            os.replace(temp_path, model_hash_path)
+        return model_hashes[model_key]
+
+    def get(self, image: np.ndarray) -> Optional[np.ndarray]:
+        return self.get_by_key(hash_image(image))
+
+    def get_by_key(self, key: str) -> Optional[np.ndarray]:
+        return self.cache.get(key, np.load)
+
+    def put(self, image: np.ndarray, embedding: np.ndarray):
+        self.put_by_key(hash_image(image), embedding)
+
+    def put_by_key(self, key: str, embedding: np.ndarray):
+        embedding = embedding.astype(np.float32, copy=False)
+        self.cache.put(key, lambda f: np.save(f, embedding), embedding.nbytes)
+
+    def remove(self, key: str):
+        self.cache.remove(key)
+
+    def get_size_bytes(self) -> int:
+        return self.cache.get_size_bytes()
+
+    def get_max_bytes(self) -> int:
+        return self.cache.get_max_bytes()
@@ -17,6 +17,10 @@ class AnnotationJson:
         self.iscrowd = None
         self.predicted_iou = None
 
+        # Row of the feature of the mask in the feature file of the image,
+        # only for the masks detected when the project was created
+        self.feature_id = None
+
     def set_segmentation(self, segmentation: Dict):
         self.segmentation = segmentation
 
@@ -38,6 +42,9 @@ class AnnotationJson:
     def set_iscrowd(self, iscrowd: int):
         self.iscrowd = iscrowd
 
+    def set_feature_id(self, feature_id: int):
+        self.feature_id = feature_id
+
     def to_json(self):
         assert self.segmentation is not None, "segmentation is not set"
         assert self.bbox is not None, "bbox is not set"
@@ -46,7 +53,7 @@ class AnnotationJson:
         assert self.id is not None, "id is not set"
         assert self.image_id is not None, "image_id is not set"
         assert self.iscrowd is not None, "iscrowd is not set"
-        return {
+        annotation = {
             "segmentation": self.segmentation,
             "bbox": self.bbox,
             "area": self.area,
@@ -55,3 +62,6 @@ class AnnotationJson:
             "image_id": self.image_id,
             "iscrowd": self.iscrowd,
         }
+        if self.feature_id is not None:
+            annotation["feature_id"] = self.feature_id
+        return annotation
@@ -6,6 +6,8 @@ class ProjectInfoJson:
     def __init__(self):
         self.last_image_idx = None
         self.category_info: List[CategoryJson] = []
+        self.embedding_layout = "npy"
+        self.embedding_dtype = "float32"
 
     def set_last_image_idx(self, last_image_idx: int):
         self.last_image_idx = last_image_idx
@@ -13,9 +15,17 @@ class ProjectInfoJson:
     def add_category_info(self, category_info: CategoryJson):
         self.category_info.append(category_info)
 
+    def set_embedding_layout(self, embedding_layout: str):
+        self.embedding_layout = embedding_layout
+
+    def set_embedding_dtype(self, embedding_dtype: str):
+        self.embedding_dtype = embedding_dtype
+
     def to_json(self):
         assert self.last_image_idx is not None, "last_image_idx is not set"
         return {
             "last_image_idx": self.last_image_idx,
             "category_info": [category.to_json() for category in self.category_info],
+            "embedding_layout": self.embedding_layout,
+            "embedding_dtype": self.embedding_dtype,
         }
@@ -1,9 +1,13 @@
 import logging
+import math
+import threading
 
 import numpy as np
 import onnxruntime as ort
 
-from typing import Dict, List
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Tuple
 from .segment_anything.utils.transforms import ResizeLongestSide
 
 
@@ -23,7 +27,74 @@ class Prompt:
         return self.label
 
 
+class MaskSession:
+    """
+    Prompt state of one client of the mask creator: the image being prompted
+    and the low resolution logits of the previous mask, which refine the next
+    mask of the same prompt sequence.
+    """
+
+    def __init__(self):
+        # Masks of one session are decoded in order, as each mask depends
+        # on the logits of the previous one
+        self.lock = threading.Lock()
+        self.image_key = None
+        self.image_embedding: np.ndarray = None
+        self.image_size: List[int] = None
+        self.low_res_logits: np.ndarray = None
+
+        # Incremented on every change of the state, so that a speculative
+        # decoding is only used in the state it was made in
+        self.state_id = 0
+
+    def set_image(
+        self, image_embedding: np.ndarray, image_size: List[int], image_key=None
+    ):
+        self.image_key = image_key
+        self.image_embedding = image_embedding
+        self.image_size = image_size
+        self.low_res_logits = None
+        self.state_id += 1
+
+    def get_image_key(self):
+        return self.image_key
+
+    def get_image_embedding(self) -> np.ndarray:
+        return self.image_embedding
+
+    def get_image_size(self) -> List[int]:
+        return self.image_size
+
+    def set_low_res_logits(self, low_res_logits: np.ndarray):
+        self.low_res_logits = low_res_logits
+        self.state_id += 1
+
+    def get_state_id(self) -> int:
+        return self.state_id
+
+    def get_low_res_logits(self) -> np.ndarray:
+        return self.low_res_logits
+
+
 class MaskCreator:
+    """
+    Decode masks from the point prompts of the users.
+
+    The decoding itself is stateless, see decode. The prompt state of each
+    client is kept in a MaskSession, looked up by the session id, so that
+    several clients can decode masks in parallel on the shared onnxruntime
+    session, whose run is thread-safe.
+    """
+
+    DEFAULT_SESSION_ID = "default"
+
+    MASK_THRESHOLD = 0.5
+    # Longest side of the encoder input, and its ratio to the low resolution logits
+    INPUT_SIZE = 1024
+    LOW_RES_SCALE = 4
+
+    # Number of speculative decodings kept for the following create_mask
+    SPECULATION_CACHE_SIZE = 8
 
     def __init__(self, onnx_path: str):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -32,27 +103,307 @@ class MaskCreator:
         self.ort_session = ort.InferenceSession(
             onnx_path, providers=["CUDAExecutionProvider", "CPUExecutionProvider"]
         )
-        self.image: np.ndarray = None
-        self.image_embedding: np.ndarray = None
-        self.image_size = None
-        self.inputs: List = None
 
         self.default_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
         self.default_has_mask_input = np.zeros(1, dtype=np.float32)
         self.transforms = ResizeLongestSide(1024)
 
-        self.low_res_logits = None
+        # Key: session id, Value: MaskSession
+        self.sessions: Dict[str, MaskSession] = {}
+        self.sessions_lock = threading.Lock()
 
-    def set_image(self, image_embedding: np.ndarray, image_size: List[int]):
-        self.image_embedding = image_embedding
-        self.image_size = image_size
-        self.low_res_logits = None
+        # Speculative decodings, run one at a time in the background so that
+        # they do not slow down the decodings of the clicks. Key: see
+        # get_speculation_key, Value: Future of the result of the decoding
+        self.speculation_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="MaskSpeculation"
+        )
+        self.speculations: OrderedDict[Tuple, Future] = OrderedDict()
+        self.speculations_lock = threading.Lock()
 
-    def create_mask(self, prompts: List[Prompt]) -> np.ndarray:
+    def get_session(self, session_id: str = DEFAULT_SESSION_ID) -> MaskSession:
+        """
+        Get the prompt state of the session, created on first use
+        """
+        with self.sessions_lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = MaskSession()
+            return self.sessions[session_id]
+
+    def close_session(self, session_id: str):
+        with self.sessions_lock:
+            self.sessions.pop(session_id, None)
+        with self.speculations_lock:
+            for key in list(self.speculations.keys()):
+                if key[0] == session_id:
+                    self.speculations.pop(key).cancel()
+
+    def set_image(
+        self,
+        image_embedding: np.ndarray,
+        image_size: List[int],
+        session_id: str = DEFAULT_SESSION_ID,
+        image_key=None,
+    ):
+        """
+        Set the image prompted in the session, which starts a new prompt sequence
+
+        Args:
+        - image_key: Identifier of the image, e.g. its index in the dataset
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            session.set_image(image_embedding, image_size, image_key)
+
+    def create_mask(
+        self, prompts: List[Prompt], session_id: str = DEFAULT_SESSION_ID
+    ) -> np.ndarray:
+        """
+        Create the mask of the prompts on the image of the session, refined by
+        the previous mask of the session
+        """
         self.logger.info(f"Creating mask with {len(prompts)} prompts ...")
+        (mask,) = self.decode_in_session(prompts, session_id, roi=False)
+        return mask
+
+    def create_mask_roi(
+        self, prompts: List[Prompt], session_id: str = DEFAULT_SESSION_ID
+    ) -> Tuple[np.ndarray, List[int]]:
+        """
+        Same as create_mask, but only the region of interest of the mask is
+        decoded, see decode_roi
+
+        Returns:
+        - np.ndarray: (h, w) boolean crop of the mask
+        - List[int]: [x, y] offset of the crop in the image
+        """
+        self.logger.info(f"Creating mask with {len(prompts)} prompts in ROI ...")
+        mask, offset = self.decode_in_session(prompts, session_id, roi=True)
+        return mask, offset
+
+    def decode_in_session(
+        self, prompts: List[Prompt], session_id: str, roi: bool
+    ) -> Tuple:
+        """
+        Decode the prompts with the state of the session, and keep the logits
+        of the mask in the session. The result of a speculative decoding of
+        the same prompts in the same state is used, if any and if it succeeded.
+
+        Returns:
+        - Tuple: The result of decode or decode_roi, without the logits
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            assert (
+                session.get_image_embedding() is not None
+            ), f"No image is set for session {session_id}"
+            future = self.take_speculation(session_id, session, prompts, roi)
+            result = None
+            if future is not None:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # E.g. cancelled by a change of the session image. The
+                    # prompts are decoded again, so that the request does not fail.
+                    self.logger.warning(f"Speculative decoding failed: {e!r}")
+            if result is None:
+                decode = self.decode_roi if roi else self.decode
+                result = decode(
+                    session.get_image_embedding(),
+                    session.get_image_size(),
+                    prompts,
+                    session.get_low_res_logits(),
+                )
+
+            low_res_logits = result[-1]
+            if low_res_logits is not None:
+                session.set_low_res_logits(low_res_logits)
+        return result[:-1]
+
+    def speculate(
+        self,
+        prompt_sets: List[List[Prompt]],
+        session_id: str = DEFAULT_SESSION_ID,
+        roi: bool = False,
+    ):
+        """
+        Decode the candidate prompt sets in the background, e.g. the prompts
+        with the point under the pointer, so that a following create_mask
+        with one of them returns at once. The candidates replace the pending
+        candidates of the session that are not started yet, and the decodings
+        made in a previous state of the session are dropped.
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            if session.get_image_embedding() is None:
+                return
+            image_embedding = session.get_image_embedding()
+            image_size = session.get_image_size()
+            low_res_logits = session.get_low_res_logits()
+            state_key = (session.get_image_key(), session.get_state_id())
+            keys = [
+                self.get_speculation_key(session_id, session, prompts, roi)
+                for prompts in prompt_sets
+            ]
+
+        decode = self.decode_roi if roi else self.decode
+        with self.speculations_lock:
+            for key in list(self.speculations.keys()):
+                if key[0] != session_id or key in keys:
+                    continue
+                if key[1:3] != state_key:
+                    # Made in a previous state of the session, so never used
+                    self.speculations.pop(key).cancel()
+                elif self.speculations[key].cancel():
+                    del self.speculations[key]
+
+            for key, prompts in zip(keys, prompt_sets):
+                if len(prompts) == 0:
+                    continue
+                if key in self.speculations:
+                    self.speculations.move_to_end(key)
+                    continue
+                self.speculations[key] = self.speculation_executor.submit(
+                    decode, image_embedding, image_size, prompts, low_res_logits
+                )
+
+            while len(self.speculations) > MaskCreator.SPECULATION_CACHE_SIZE:
+                _, future = self.speculations.popitem(last=False)
+                future.cancel()
+
+    def take_speculation(
+        self, session_id: str, session: MaskSession, prompts: List[Prompt], roi: bool
+    ) -> Future:
+        """
+        Remove and get the speculative decoding of the prompts in the current
+        state of the session, or None if there is none
+        """
+        key = self.get_speculation_key(session_id, session, prompts, roi)
+        with self.speculations_lock:
+            return self.speculations.pop(key, None)
+
+    def get_speculation_key(
+        self, session_id: str, session: MaskSession, prompts: List[Prompt], roi: bool
+    ) -> Tuple:
+        """
+        Key of a decoding, by the session, the image and the logits it is
+        refined by, the prompts and the mode
+        """
+        prompts_key = tuple(
+            (prompt.get_x(), prompt.get_y(), prompt.get_label()) for prompt in prompts
+        )
+        return (
+            session_id,
+            session.get_image_key(),
+            session.get_state_id(),
+            prompts_key,
+            roi,
+        )
+
+    def decode(
+        self,
+        image_embedding: np.ndarray,
+        image_size: List[int],
+        prompts: List[Prompt],
+        low_res_logits: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the mask of the prompts. It does not depend on any state of the
+        mask creator, and can be called from several threads.
+
+        Args:
+        - image_size: [height, width] of the image
+        - low_res_logits: (1, 1, 256, 256) logits of the previous mask, if any
+
+        Returns:
+        - np.ndarray: (H, W) boolean mask
+        - np.ndarray: (1, 1, 256, 256) logits of the mask, or None if there is
+          no prompt
+        """
+        if len(prompts) == 0:
+            return np.zeros(image_size, dtype=np.uint8), None
+
+        mask, low_res_logits = self.run_decoder(
+            image_embedding, image_size, prompts, low_res_logits, image_size
+        )
+        mask = mask > MaskCreator.MASK_THRESHOLD
+        mask = mask.squeeze()
+
+        return mask, low_res_logits
+
+    def decode_roi(
+        self,
+        image_embedding: np.ndarray,
+        image_size: List[int],
+        prompts: List[Prompt],
+        low_res_logits: np.ndarray = None,
+    ) -> Tuple[np.ndarray, List[int], np.ndarray]:
+        """
+        Same as decode, but the mask is only upsampled within the region of
+        interest around it, found from the low resolution logits. The cost
+        depends on the size of the mask rather than on the size of the image.
+
+        Returns:
+        - np.ndarray: (h, w) boolean crop of the mask, tight around the mask
+        - List[int]: [x, y] offset of the crop in the image
+        - np.ndarray: (1, 1, 256, 256) logits of the mask, or None if there is
+          no prompt
+        """
         if len(prompts) == 0:
-            return np.zeros(self.image_size, dtype=np.uint8)
+            return np.zeros((0, 0), dtype=bool), [0, 0], None
+
+        # The decoder upsamples its output to the size it is given. Give it
+        # the low resolution size of the image, so that it stays small.
+        height, width = image_size
+        input_height, input_width = get_resized_size(image_size)
+        low_res_size = [
+            math.ceil(input_height / MaskCreator.LOW_RES_SCALE),
+            math.ceil(input_width / MaskCreator.LOW_RES_SCALE),
+        ]
+        _, low_res_logits = self.run_decoder(
+            image_embedding, image_size, prompts, low_res_logits, low_res_size
+        )
+        low_res_mask = low_res_logits[0, 0]
+
+        # Bilinear upsampling stays at or below the threshold away from the
+        # low resolution pixels above it, so the mask lies within their bbox
+        # padded by one low resolution pixel
+        rows = np.flatnonzero((low_res_mask > MaskCreator.MASK_THRESHOLD).any(axis=1))
+        columns = np.flatnonzero((low_res_mask > MaskCreator.MASK_THRESHOLD).any(axis=0))
+        if len(rows) == 0:
+            return np.zeros((0, 0), dtype=bool), [0, 0], low_res_logits
+
+        y0, y1 = get_roi_range(rows[0], rows[-1], input_height, height)
+        x0, x1 = get_roi_range(columns[0], columns[-1], input_width, width)
+        if y0 >= y1 or x0 >= x1:
+            return np.zeros((0, 0), dtype=bool), [0, 0], low_res_logits
+        roi_logits = upsample_roi(
+            low_res_mask, [y0, y1], [x0, x1], [input_height, input_width], image_size
+        )
+        roi_mask = roi_logits > MaskCreator.MASK_THRESHOLD
+
+        # Crop the mask tight
+        rows = np.flatnonzero(roi_mask.any(axis=1))
+        columns = np.flatnonzero(roi_mask.any(axis=0))
+        if len(rows) == 0:
+            return np.zeros((0, 0), dtype=bool), [0, 0], low_res_logits
+        roi_mask = roi_mask[rows[0] : rows[-1] + 1, columns[0] : columns[-1] + 1]
+        offset = [int(x0 + columns[0]), int(y0 + rows[0])]
+
+        return roi_mask, offset, low_res_logits
 
+    def run_decoder(
+        self,
+        image_embedding: np.ndarray,
+        image_size: List[int],
+        prompts: List[Prompt],
+        low_res_logits: np.ndarray,
+        output_size: List[int],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run the decoder on the prompts, given in the coordinates of the image,
+        with the mask logits upsampled to the output size
+        """
         input_points = []
         for prompt in prompts:
             input_points.append([prompt.get_x(), prompt.get_y()])
@@ -62,7 +413,7 @@ class MaskCreator:
             input_labels.append(prompt.get_label())
 
         onnx_coord = np.array(input_points, dtype=np.float32)[None, :, :]
-        onnx_coord = self.transforms.apply_coords(onnx_coord, self.image_size).astype(
+        onnx_coord = self.transforms.apply_coords(onnx_coord, image_size).astype(
             np.float32
         )
 
@@ -70,26 +421,153 @@ class MaskCreator:
             np.float32
         )
 
-        if self.low_res_logits is not None:
-            mask_input = self.low_res_logits
+        if low_res_logits is not None:
+            mask_input = low_res_logits
             has_mask_input = np.ones(1, dtype=np.float32)
         else:
             mask_input = self.default_mask_input
             has_mask_input = self.default_has_mask_input
 
         ort_inputs = {
-            "image_embeddings": self.image_embedding,
+            "image_embeddings": image_embedding,
             "point_coords": onnx_coord,
             "point_labels": onnx_label,
             "mask_input": mask_input,
             "has_mask_input": has_mask_input,
-            "orig_im_size": np.array(self.image_size, dtype=np.float32),
+            "orig_im_size": np.array(output_size, dtype=np.float32),
         }
 
         mask, _, low_res_logits = self.ort_session.run(None, ort_inputs)
-        mask = mask > 0.5
-        mask = mask.squeeze()
+        return mask, low_res_logits
 
-        self.low_res_logits = low_res_logits
 
-        return mask
+def get_resized_size(image_size: List[int]) -> Tuple[int, int]:
+    """
+    Get the size of the image resized to the encoder input, rounded as by
+    the postprocessing of the decoder, see SamOnnxModel.resize_longest_image_size
+    """
+    height, width = image_size
+    scale = MaskCreator.INPUT_SIZE / max(height, width)
+    return int(math.floor(height * scale + 0.5)), int(math.floor(width * scale + 0.5))
+
+
+def get_roi_range(
+    low_res_start: int, low_res_end: int, input_size: int, image_size: int
+) -> Tuple[int, int]:
+    """
+    Get the range of image pixels, along one axis, whose upsampled logits
+    depend on the low resolution pixels from low_res_start to low_res_end
+    (inclusive), padded by one pixel
+    """
+    scale = MaskCreator.LOW_RES_SCALE
+    input_start = max(scale * (low_res_start - 1), 0)
+    input_end = min(scale * (low_res_end + 2), input_size)
+    start = int(math.floor((input_start - 1) * image_size / input_size)) - 1
+    end = int(math.ceil((input_end + 1) * image_size / input_size)) + 1
+    return max(start, 0), min(end, image_size)
+
+
+def get_source_coords(
+    start: int, end: int, source_size: int, size: int, clip_size: int
+) -> np.ndarray:
+    """
+    Get the source coordinates of the pixels from start to end (exclusive)
+    of a bilinear resize from source_size to size without aligned corners,
+    clipped to the first clip_size source pixels.
+
+    The scale is a float32, and the coordinates are rounded to float32 once,
+    as by the fused multiply-add of the postprocessing of the decoder.
+    """
+    scale = np.float64(np.float32(source_size) / np.float32(size))
+    coords = scale * (np.arange(start, end, dtype=np.float64) + 0.5) - 0.5
+    return np.clip(coords.astype(np.float32), 0, clip_size - 1)
+
+
+def interpolate_bilinear(
+    image: np.ndarray, rows: np.ndarray, columns: np.ndarray
+) -> np.ndarray:
+    """
+    Interpolate the image at the grid of the given source rows and columns,
+    which lie within the image. The weights and the interpolation are in
+    float32, as in the postprocessing of the decoder, instead of the fixed
+    point weights of cv2.remap, which flip the pixels with logits close to
+    the mask threshold.
+    """
+    image = image.astype(np.float32, copy=False)
+    row0 = np.floor(rows).astype(np.int64)
+    row1 = np.minimum(row0 + 1, image.shape[0] - 1)
+    row_weights = (rows - row0).astype(np.float32)[:, None]
+    column0 = np.floor(columns).astype(np.int64)
+    column1 = np.minimum(column0 + 1, image.shape[1] - 1)
+    column_weights = (columns - column0).astype(np.float32)
+
+    # The columns are interpolated first, in the rows of the image, which
+    # are fewer than the interpolated rows when upsampling. np.take keeps
+    # the result C-contiguous, so that the rows are gathered fast.
+    image = interpolate_linear(
+        np.take(image, column0, axis=1), np.take(image, column1, axis=1), column_weights
+    )
+    return interpolate_linear(image[row0], image[row1], row_weights)
+
+
+def interpolate_linear(
+    values0: np.ndarray, values1: np.ndarray, weights: np.ndarray
+) -> np.ndarray:
+    """
+    Compute values0 * (1 - weights) + values1 * weights in place, which
+    overwrites both values, as they are large for a region of a whole image
+    """
+    values0 *= 1 - weights
+    values1 *= weights
+    values0 += values1
+    return values0
+
+
+def upsample_roi(
+    low_res_mask: np.ndarray,
+    roi_rows: List[int],
+    roi_columns: List[int],
+    input_size: List[int],
+    image_size: List[int],
+) -> np.ndarray:
+    """
+    Upsample the region of interest of the (256, 256) low resolution logits
+    the same way as the postprocessing of the decoder: resize to the input
+    size of the encoder, crop away the padding and resize to the image size.
+    Only the pixels needed for the region are interpolated. The logits agree
+    with the postprocessing up to float32 rounding, so a pixel may only differ
+    if its logit is within about 1e-6 of the mask threshold.
+
+    Args:
+    - roi_rows, roi_columns: [start, end) of the region in the image
+
+    Returns:
+    - np.ndarray: Logits of the region
+    """
+    low_res_size = low_res_mask.shape[0]
+    padded_size = MaskCreator.INPUT_SIZE
+
+    # Coordinates of the region in the resized image
+    input_rows = get_source_coords(*roi_rows, input_size[0], image_size[0], input_size[0])
+    input_columns = get_source_coords(
+        *roi_columns, input_size[1], image_size[1], input_size[1]
+    )
+    input_y0 = int(np.floor(input_rows[0]))
+    input_y1 = min(int(np.floor(input_rows[-1])) + 2, input_size[0])
+    input_x0 = int(np.floor(input_columns[0]))
+    input_x1 = min(int(np.floor(input_columns[-1])) + 2, input_size[1])
+
+    # Upsample the low resolution logits to the part of the resized image
+    # around the region
+    low_res_rows = get_source_coords(
+        input_y0, input_y1, low_res_size, padded_size, low_res_size
+    )
+    low_res_columns = get_source_coords(
+        input_x0, input_x1, low_res_size, padded_size, low_res_size
+    )
+    input_logits = interpolate_bilinear(low_res_mask, low_res_rows, low_res_columns)
+
+    # Resize it to the region in the image
+    return interpolate_bilinear(
+        input_logits, input_rows - input_y0, input_columns - input_x0
+    )
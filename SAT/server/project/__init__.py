@@ -3,3 +3,5 @@ from .projectExportor import ProjectExportor
 from .projectLoader import ProjectLoader
 from .projectSaver import ProjectSaver
 from .jsonImportor import JsonImportor
+from .projectArchive import ProjectArchive
+from .maskFeatureIndex import MaskFeatureIndex
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+
+from typing import Dict, List, Optional
+
+
+def gen_input_key(input: Dict) -> str:
+    """
+    Generate the key identifying an input of a project creation request.
+    Image files are identified by their path, size and modification time.
+    Image urls are identified by the hash of their content.
+    """
+    if "image_path" in input:
+        image_path = os.path.abspath(input["image_path"])
+        stat = os.stat(image_path)
+        return f"{image_path}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(input["image_url"].encode("utf-8")).hexdigest()
+
+
+class CreationManifest:
+    """
+    Record of the inputs whose image, embedding and annotation file are complete
+    in the temporary folder of a project creation. It is used to resume an
+    interrupted creation without embedding the completed inputs again.
+
+    The manifest is stored as manifest.json in the temporary folder:
+    {
+        "output_file": "/path/to/output.sat",
+        "embedding_layout": "npy",
+        "embedding_dtype": "float32",
+        "input_keys": [key of each input, in the order of the request],
+        "detection_config": {"minArea": 0.001, ...} or null,
+        "completed": {
+            key: {
+                "idx": 0,
+                "image_file_name": "image.jpg",
+                "width": 1024,
+                "height": 768
+            }
+        }
+    }
+    """
+
+    FILENAME = "manifest.json"
+
+    def __init__(
+        self,
+        folder: str,
+        output_file: str,
+        embedding_layout: str,
+        embedding_dtype: str,
+        input_keys: List[str],
+        detection_config: Optional[Dict] = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.file_path = os.path.join(folder, CreationManifest.FILENAME)
+        self.output_file = os.path.abspath(output_file)
+        self.embedding_layout = embedding_layout
+        self.embedding_dtype = embedding_dtype
+        self.input_keys = input_keys
+        self.detection_config = detection_config
+        self.completed: Dict[str, Dict] = {}
+
+    def load(self) -> bool:
+        """
+        Load the completed inputs of a previous creation.
+
+        Returns:
+        - bool: False if there is no manifest, or if it was written for a
+          different output, embedding format or coral detection, in which case
+          the temporary folder cannot be reused.
+        """
+        if not os.path.exists(self.file_path):
+            return False
+
+        try:
+            with open(self.file_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Failed to read creation manifest: {e}")
+            return False
+
+        if (
+            manifest.get("output_file") != self.output_file
+            or manifest.get("embedding_layout") != self.embedding_layout
+            or manifest.get("embedding_dtype") != self.embedding_dtype
+            or manifest.get("detection_config") != self.detection_config
+        ):
+            return False
+
+        # Packed embeddings are stored by row, so the inputs must not change
+        if self.embedding_layout == "packed" and (
+            manifest.get("input_keys") != self.input_keys
+        ):
+            return False
+
+        self.completed = manifest.get("completed", {})
+        return True
+
+    def save(self):
+        """
+        Save the manifest atomically, so that an interruption while saving
+        does not lose the completed inputs
+        """
+        manifest = {
+            "output_file": self.output_file,
+            "embedding_layout": self.embedding_layout,
+            "embedding_dtype": self.embedding_dtype,
+            "input_keys": self.input_keys,
+            "detection_config": self.detection_config,
+            "completed": self.completed,
+        }
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.file_path)
+
+    def get_file_path(self) -> str:
+        return self.file_path
+
+    def is_completed(self, key: str) -> bool:
+        return key in self.completed
+
+    def get_completed(self, key: str) -> Dict:
+        return self.completed[key]
+
+    def get_completed_keys(self) -> List[str]:
+        return list(self.completed.keys())
+
+    def add_completed(
+        self, key: str, idx: int, image_file_name: str, width: int, height: int
+    ):
+        self.completed[key] = {
+            "idx": idx,
+            "image_file_name": image_file_name,
+            "width": width,
+            "height": height,
+        }
+
+    def remove_completed(self, key: str):
+        self.completed.pop(key, None)
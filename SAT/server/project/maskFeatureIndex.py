@@ -0,0 +1,235 @@
+import logging
+import os
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from ..dataset import Dataset
+from .projectArchive import ProjectArchive
+
+# Dimension of the features of the coral decoder
+FEATURE_DIM = 256
+
+
+class MaskFeatureIndex:
+    """
+    Nearest neighbour index over the features of the detected corals of all
+    the images in a project. The features are L2-normalized when they are
+    generated, so the cosine similarity of two masks is their dot product.
+
+    Row i of the feature file of an image belongs to the annotation whose
+    feature_id is i, not to the annotation with id i, as the label page reuses
+    the ids of deleted masks. The annotations of an image must be set again
+    whenever they change, so that the index does not serve stale features.
+
+    The search is exact. The features are kept as float16 and compared to the
+    query in blocks, so that a query over a large project needs one matrix
+    product per block and only a block of float32 features in memory.
+    """
+
+    BLOCK_SIZE = 16384
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.features = np.zeros((0, FEATURE_DIM), dtype=np.float16)
+        self.image_idxs = np.zeros(0, dtype=np.int64)
+
+        # Id of the annotation holding the feature of each row, or -1 if no
+        # annotation holds it, e.g. the detected coral is deleted
+        self.annotation_ids = np.zeros(0, dtype=np.int64)
+
+        # Key: image idx, Value: (first row, number of rows) of its features
+        self.image_rows: Dict[int, Tuple[int, int]] = {}
+
+        # Key: (image idx, annotation id), Value: row in the features
+        self.rows: Dict[Tuple[int, int], int] = {}
+
+    @staticmethod
+    def from_dataset(dataset: Dataset) -> "MaskFeatureIndex":
+        """
+        Build the index from the features stored in the project archive of the
+        dataset. Images without stored features, e.g. of projects created
+        without coral detection, are skipped.
+        """
+        index = MaskFeatureIndex()
+        archive: ProjectArchive = dataset.get_archive()
+        if archive is None:
+            index.logger.warning("No project archive to load the mask features from")
+            return index
+
+        image_idxs = []
+        features_list = []
+        for data in dataset.get_data_list():
+            filename = os.path.splitext(data.get_image_name())[0]
+            feature_member = ProjectArchive.feature_member(filename)
+            if not archive.contains(feature_member):
+                continue
+            image_idxs.append(data.get_idx())
+            features_list.append(archive.load_numpy(feature_member))
+        index.add_all(image_idxs, features_list)
+
+        for image_idx in image_idxs:
+            data = dataset.get_data(image_idx)
+            index.set_annotations(image_idx, data.get_segmentation()["annotations"])
+
+        index.logger.info(
+            f"Mask feature index built with {index.get_size()} masks of {len(image_idxs)} images"
+        )
+        return index
+
+    def add(self, image_idx: int, features: np.ndarray):
+        """
+        Add the features of the masks of one image. They are not searched until
+        the annotations holding them are set.
+
+        Args:
+        - features: (N, 256) features, where row i belongs to the annotation with feature_id i
+        """
+        self.add_all([image_idx], [features])
+
+    def add_all(self, image_idxs: List[int], features_list: List[np.ndarray]):
+        """
+        Add the features of the masks of several images at once
+        """
+        if len(image_idxs) == 0:
+            return
+        for image_idx, features in zip(image_idxs, features_list):
+            assert (
+                features.ndim == 2 and features.shape[1] == FEATURE_DIM
+            ), f"Features should have shape (N, {FEATURE_DIM}), got {features.shape}"
+            assert (
+                image_idx not in self.image_rows
+            ), f"Features of image {image_idx} are already added"
+
+        start = len(self.features)
+        self.features = np.concatenate(
+            [self.features] + [features.astype(np.float16) for features in features_list]
+        )
+        self.image_idxs = np.concatenate(
+            [self.image_idxs]
+            + [
+                np.full(len(features), image_idx, dtype=np.int64)
+                for image_idx, features in zip(image_idxs, features_list)
+            ]
+        )
+        self.annotation_ids = np.concatenate(
+            [self.annotation_ids, np.full(len(self.features) - start, -1, dtype=np.int64)]
+        )
+
+        for image_idx, features in zip(image_idxs, features_list):
+            self.image_rows[image_idx] = (start, len(features))
+            start += len(features)
+
+    def set_annotations(self, image_idx: int, annotations: List[Dict]):
+        """
+        Set the annotations of the image, after they are loaded or changed.
+        The entries of the previous annotations of the image are dropped, and
+        each annotation with a feature_id takes the feature of that row.
+        """
+        if image_idx not in self.image_rows:
+            return
+        start, count = self.image_rows[image_idx]
+
+        for annotation_id in self.annotation_ids[start : start + count]:
+            self.rows.pop((image_idx, int(annotation_id)), None)
+        self.annotation_ids[start : start + count] = -1
+
+        for annotation in annotations:
+            feature_id = annotation.get("feature_id")
+            if feature_id is None or not 0 <= feature_id < count:
+                continue
+            row = start + feature_id
+            self.annotation_ids[row] = annotation["id"]
+            self.rows[(image_idx, annotation["id"])] = row
+
+    def get_size(self) -> int:
+        """
+        Number of masks held by an annotation, which are searched
+        """
+        return len(self.rows)
+
+    def contains(self, image_idx: int, annotation_id: int) -> bool:
+        return (image_idx, annotation_id) in self.rows
+
+    def get_feature(self, image_idx: int, annotation_id: int) -> np.ndarray:
+        """
+        Get the (256,) feature of the mask, as float32
+        """
+        assert self.contains(
+            image_idx, annotation_id
+        ), f"No feature for annotation {annotation_id} of image {image_idx}"
+        return self.features[self.rows[(image_idx, annotation_id)]].astype(np.float32)
+
+    def search(
+        self,
+        query: np.ndarray,
+        top_k: int,
+        min_similarity: float = -1.0,
+        exclude_row: int = -1,
+    ) -> List[Dict]:
+        """
+        Find the masks most similar to the query feature
+
+        Args:
+        - query: (256,) L2-normalized feature
+        - top_k: Maximum number of masks to return
+        - min_similarity: Minimum cosine similarity of the returned masks
+        - exclude_row: Row of the index to leave out, e.g. the query mask itself
+
+        Returns:
+        - List[Dict]: The masks sorted by descending similarity:
+            {
+                "image_idx": int,
+                "annotation_id": int,
+                "similarity": float
+            }
+        """
+        assert top_k > 0, "top_k should be greater than 0"
+        query = np.asarray(query, dtype=np.float32).reshape(FEATURE_DIM)
+
+        # Keep the best top_k rows seen so far, merged with the rows of each block
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_similarities = np.zeros(0, dtype=np.float32)
+        for start in range(0, len(self.features), MaskFeatureIndex.BLOCK_SIZE):
+            block = self.features[start : start + MaskFeatureIndex.BLOCK_SIZE]
+            similarities = block.astype(np.float32) @ query
+            similarities[self.annotation_ids[start : start + len(block)] < 0] = -np.inf
+            if start <= exclude_row < start + len(block):
+                similarities[exclude_row - start] = -np.inf
+
+            rows = np.nonzero(similarities >= min_similarity)[0]
+            best_rows = np.concatenate([best_rows, rows + start])
+            best_similarities = np.concatenate([best_similarities, similarities[rows]])
+            if len(best_rows) > top_k:
+                keep = np.argpartition(-best_similarities, top_k - 1)[:top_k]
+                best_rows = best_rows[keep]
+                best_similarities = best_similarities[keep]
+
+        order = np.argsort(-best_similarities, kind="stable")
+        return [
+            {
+                "image_idx": int(self.image_idxs[best_rows[i]]),
+                "annotation_id": int(self.annotation_ids[best_rows[i]]),
+                "similarity": float(best_similarities[i]),
+            }
+            for i in order
+        ]
+
+    def get_similar_masks(
+        self,
+        image_idx: int,
+        annotation_id: int,
+        top_k: int,
+        min_similarity: float = -1.0,
+    ) -> List[Dict]:
+        """
+        Find the masks of the project most similar to the given mask, which
+        is not included in the result
+        """
+        query = self.get_feature(image_idx, annotation_id)
+        return self.search(
+            query,
+            top_k,
+            min_similarity,
+            exclude_row=self.rows[(image_idx, annotation_id)],
+        )
@@ -0,0 +1,152 @@
+import os
+import struct
+import threading
+import zipfile
+
+import numpy as np
+
+from typing import Dict, List
+from ..util.quantization import quantize_int8
+
+# Shape of the embedding of one image, without the batch axis
+EMBEDDING_SHAPE = (256, 64, 64)
+
+# Size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class PackedEmbeddingWriter:
+    """
+    Write the embeddings of a project into one fixed-stride binary file.
+    The embedding of the i-th image is stored at row i, so rows can be
+    written in any order and from multiple threads.
+
+    For int8 embeddings, the per-channel scale and zero point of each row
+    are saved into a separate N x 2 x 256 npy file on flush and close.
+
+    With resume enabled, an existing file of the expected size is reopened
+    instead of truncated, keeping the rows written by a previous creation.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        num_rows: int,
+        dtype: str = "float32",
+        quantization_path: str = None,
+        resume: bool = False,
+    ):
+        assert dtype in ["float32", "float16", "int8"], f"Unsupported dtype {dtype}"
+        assert (
+            dtype != "int8" or quantization_path is not None
+        ), "Int8 embeddings need a path for the quantization parameters"
+        self.file_path = file_path
+        self.num_rows = num_rows
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(EMBEDDING_SHAPE)) * self.dtype.itemsize
+
+        self.quantization_path = quantization_path
+        self.quantization = None
+        if self.dtype == np.int8:
+            self.quantization = np.zeros(
+                (num_rows, 2, EMBEDDING_SHAPE[0]), dtype=np.float32
+            )
+
+        file_bytes = self.num_rows * self.row_bytes
+        resume = (
+            resume
+            and os.path.exists(file_path)
+            and os.path.getsize(file_path) == file_bytes
+        )
+        if resume and self.quantization is not None:
+            if os.path.exists(quantization_path):
+                self.quantization = np.load(quantization_path)
+            else:
+                resume = False
+
+        self.lock = threading.Lock()
+        if resume:
+            self.file = open(file_path, "r+b")
+        else:
+            self.file = open(file_path, "wb")
+            self.file.truncate(file_bytes)
+
+    def write(self, row: int, embedding: np.ndarray):
+        assert 0 <= row < self.num_rows, f"Row {row} out of range"
+        embedding = embedding.reshape(EMBEDDING_SHAPE)
+        if self.quantization is not None:
+            embedding, scale, zero_point = quantize_int8(embedding[None])
+            self.quantization[row, 0] = scale
+            self.quantization[row, 1] = zero_point
+
+        data = np.ascontiguousarray(embedding, dtype=self.dtype).tobytes()
+        with self.lock:
+            self.file.seek(row * self.row_bytes)
+            self.file.write(data)
+
+    def flush(self):
+        """
+        Make the written rows durable, e.g. before recording them as complete
+        """
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                if self.quantization is not None:
+                    with open(self.quantization_path, "wb") as f:
+                        np.save(f, self.quantization)
+                        f.flush()
+                        os.fsync(f.fileno())
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+                if self.quantization is not None:
+                    np.save(self.quantization_path, self.quantization)
+
+
+def gen_embedding_index(filenames: List[str], dtype: str) -> Dict:
+    """
+    Generate the index of the packed embedding file:
+    {
+        "dtype": "float32",
+        "shape": [256, 64, 64],
+        "rows": {filename: row}
+    }
+    """
+    return {
+        "dtype": dtype,
+        "shape": list(EMBEDDING_SHAPE),
+        "rows": {filename: row for row, filename in enumerate(filenames)},
+    }
+
+
+def get_member_data_offset(project_path: str, info: zipfile.ZipInfo) -> int:
+    """
+    Get the offset of the data of a zip member in the zip file
+    """
+    with open(project_path, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(ZIP_LOCAL_HEADER_SIZE)
+    filename_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + filename_length + extra_length
+
+
+def open_packed_embeddings(
+    project_path: str, info: zipfile.ZipInfo, index: Dict
+) -> np.ndarray:
+    """
+    Memory-map the packed embedding member of the project file.
+
+    Returns:
+    - np.ndarray: N x 256 x 64 x 64 memory-mapped array
+    """
+    assert (
+        info.compress_type == zipfile.ZIP_STORED
+    ), "Packed embeddings must be stored without compression"
+
+    dtype = np.dtype(index["dtype"])
+    shape = (len(index["rows"]),) + tuple(index["shape"])
+    offset = get_member_data_offset(project_path, info)
+    return np.memmap(project_path, dtype=dtype, mode="r", offset=offset, shape=shape)
@@ -0,0 +1,331 @@
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+import uuid
+import zipfile
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .packedEmbedding import open_packed_embeddings
+from ..util.thumbnail import THUMBNAIL_EXTENSION
+from ..util.quantization import (
+    decode_embedding,
+    dequantize_int8,
+    get_embedding_extension,
+)
+
+
+# Layout of the zip end of central directory records, see the zip specification
+END_RECORD_SIGNATURE = b"PK\x05\x06"
+END_RECORD_STRUCT = "<4s4H2LH"
+END_RECORD_SIZE = struct.calcsize(END_RECORD_STRUCT)
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_LOCATOR_STRUCT = "<4sLQL"
+ZIP64_LOCATOR_SIZE = struct.calcsize(ZIP64_LOCATOR_STRUCT)
+ZIP64_END_RECORD_SIGNATURE = b"PK\x06\x06"
+ZIP64_END_RECORD_STRUCT = "<4sQ2H2L4Q"
+ZIP64_END_RECORD_SIZE = struct.calcsize(ZIP64_END_RECORD_STRUCT)
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+
+
+class ProjectArchive:
+    """
+    Random access reader of a project file (.sat).
+
+    The zip file is kept open for the whole session so that images, embeddings
+    and annotations can be read straight from the zip members on demand,
+    instead of extracting the whole project up front.
+    """
+
+    IMAGE_FOLDER = "images"
+    EMBEDDING_FOLDER = "embeddings"
+    ANNOTATION_FOLDER = "annotations"
+    PROJECT_INFO_FILE = "project_info.json"
+
+    # Downscaled images for the gallery. Older projects do not have them.
+    THUMBNAIL_FOLDER = "thumbnails"
+
+    # L2-normalized features of the detected corals, as a float16 (N, 256)
+    # array per image, where row i belongs to the annotation with feature_id i.
+    # Projects created without coral detection do not have them.
+    FEATURE_FOLDER = "features"
+
+    # Optional layout, where all the embeddings are stored in one
+    # uncompressed fixed-stride file that can be memory-mapped
+    PACKED_EMBEDDING_FILE = "embeddings.bin"
+    EMBEDDING_INDEX_FILE = "embedding_index.json"
+    EMBEDDING_QUANTIZATION_FILE = "embedding_quantization.npy"
+
+    EMBEDDING_LAYOUT_NPY = "npy"
+    EMBEDDING_LAYOUT_PACKED = "packed"
+
+    def __init__(self, project_path: str):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.project_path = project_path
+
+        # Identifies this opened project in the urls of its images, so that
+        # the browser does not mix up the images of different projects
+        self.token = uuid.uuid4().hex
+
+        # The zip file handle is shared by the main thread and the background
+        # loaders, so every access to it is serialized
+        self.lock = threading.RLock()
+        self.archive: zipfile.ZipFile = None
+
+        # Memory-mapped packed embeddings, opened on first access
+        self.packed_embeddings: np.ndarray = None
+        self.embedding_index: Dict = None
+        self.embedding_quantization: np.ndarray = None
+        self.open()
+
+    def open(self):
+        with self.lock:
+            self.archive = zipfile.ZipFile(self.project_path, "r")
+
+    def close(self):
+        with self.lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+            # Views of the memory map that are still in use keep it alive
+            self.packed_embeddings = None
+            self.embedding_index = None
+            self.embedding_quantization = None
+
+    @contextmanager
+    def released(self, project_path: str = None):
+        """
+        Temporarily release the file handle, e.g. while the project file
+        is rewritten. The archive is re-opened afterwards, optionally at a
+        different project path.
+        """
+        with self.lock:
+            self.close()
+            try:
+                yield
+            finally:
+                if project_path is not None:
+                    self.project_path = project_path
+                self.open()
+
+    @staticmethod
+    def recover(project_path: str) -> bool:
+        """
+        Restore a project file whose last incremental save was interrupted,
+        e.g. by a crash or a power loss. The saves append after the previous
+        end of central directory record, so the file is cut back to the last
+        complete record, which describes the project as it was before the save.
+
+        Returns:
+        - bool: True if the file was cut back
+        """
+        # Only read the file, unless it must be cut back, so that projects
+        # on read-only files or media can still be loaded
+        with open(project_path, "rb") as f:
+            file_size = f.seek(0, os.SEEK_END)
+            if ProjectArchive.is_end_record(f, file_size - END_RECORD_SIZE):
+                return False
+            recovered_size = ProjectArchive.find_last_end(f, file_size)
+
+        if recovered_size is None:
+            raise zipfile.BadZipFile(f"No complete central directory in {project_path}")
+        with open(project_path, "r+b") as f:
+            f.truncate(recovered_size)
+        logging.getLogger(ProjectArchive.__name__).warning(
+            f"Recovered {project_path} from an interrupted save, dropping {file_size - recovered_size} bytes"
+        )
+        return True
+
+    @staticmethod
+    def find_last_end(f, file_size: int) -> Optional[int]:
+        """
+        Find the end of the last complete end of central directory record,
+        searching backwards. The unfinished save is small, so the last
+        complete record is close to the end.
+
+        Returns:
+        - int: Position right after the record and its comment, or None if
+          there is no complete record
+        """
+        chunk_size = 1024 * 1024
+        end = file_size
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            # Overlap the chunks, so that a signature is not split
+            data = f.read(end - start + len(END_RECORD_SIGNATURE) - 1)
+            pos = data.rfind(END_RECORD_SIGNATURE)
+            while pos >= 0:
+                if ProjectArchive.is_end_record(f, start + pos):
+                    f.seek(start + pos + END_RECORD_SIZE - 2)
+                    (comment_size,) = struct.unpack("<H", f.read(2))
+                    return start + pos + END_RECORD_SIZE + comment_size
+                pos = data.rfind(END_RECORD_SIGNATURE, 0, pos)
+            end = start
+        return None
+
+    @staticmethod
+    def is_end_record(f, pos: int) -> bool:
+        """
+        Check if a complete end of central directory record is at the position,
+        i.e. the central directory it points to is right before it
+        """
+        if pos < 0:
+            return False
+        f.seek(pos)
+        data = f.read(END_RECORD_SIZE)
+        if len(data) < END_RECORD_SIZE:
+            return False
+        signature, _, _, _, _, cd_size, cd_offset, _ = struct.unpack(
+            END_RECORD_STRUCT, data
+        )
+        if signature != END_RECORD_SIGNATURE:
+            return False
+
+        cd_end = pos
+        locator_pos = pos - ZIP64_LOCATOR_SIZE
+        if locator_pos >= 0:
+            f.seek(locator_pos)
+            locator = struct.unpack(ZIP64_LOCATOR_STRUCT, f.read(ZIP64_LOCATOR_SIZE))
+            if locator[0] == ZIP64_LOCATOR_SIGNATURE:
+                # The sizes of large projects are in the zip64 record
+                zip64_pos = locator[2]
+                if zip64_pos + ZIP64_END_RECORD_SIZE != locator_pos:
+                    return False
+                f.seek(zip64_pos)
+                record = struct.unpack(
+                    ZIP64_END_RECORD_STRUCT, f.read(ZIP64_END_RECORD_SIZE)
+                )
+                if record[0] != ZIP64_END_RECORD_SIGNATURE:
+                    return False
+                cd_size, cd_offset = record[8], record[9]
+                cd_end = zip64_pos
+
+        if cd_offset + cd_size != cd_end:
+            return False
+        if cd_size == 0:
+            return True
+        f.seek(cd_offset)
+        return f.read(len(CENTRAL_DIRECTORY_SIGNATURE)) == CENTRAL_DIRECTORY_SIGNATURE
+
+    def get_project_path(self) -> str:
+        return self.project_path
+
+    def get_token(self) -> str:
+        return self.token
+
+    def list_files(self, folder: str) -> List[str]:
+        """
+        List the sorted file names directly under the given folder of the archive
+        """
+        prefix = f"{folder}/"
+        with self.lock:
+            names = self.archive.namelist()
+
+        filenames = set()
+        for name in names:
+            if name.startswith(prefix) and not name.endswith("/"):
+                filenames.add(name[len(prefix) :])
+        return sorted(filenames)
+
+    def contains(self, member: str) -> bool:
+        with self.lock:
+            try:
+                self.archive.getinfo(member)
+                return True
+            except KeyError:
+                return False
+
+    def get_member_info(self, member: str) -> zipfile.ZipInfo:
+        with self.lock:
+            return self.archive.getinfo(member)
+
+    def read(self, member: str) -> bytes:
+        with self.lock:
+            return self.archive.read(member)
+
+    def load_json(self, member: str) -> Dict:
+        return json.loads(self.read(member))
+
+    def load_numpy(self, member: str) -> np.ndarray:
+        return np.load(BytesIO(self.read(member)))
+
+    def load_embedding(self, filename: str, dtype: str = "float32") -> np.ndarray:
+        """
+        Get the embedding of the given file from its own npy/npz member,
+        converted to float32
+        """
+        member = ProjectArchive.embedding_member(filename, dtype)
+        return decode_embedding(self.read(member), dtype)
+
+    def load_packed_embedding(self, filename: str) -> np.ndarray:
+        """
+        Get the embedding of the given file from the packed embedding file.
+        Float32 embeddings are returned as a view of the memory map, without copying.
+        Float16 and int8 embeddings are converted to float32.
+
+        Returns:
+        - np.ndarray: 1 x 256 x 64 x 64 float32 embedding
+        """
+        with self.lock:
+            if self.packed_embeddings is None:
+                self.embedding_index = self.load_json(
+                    ProjectArchive.EMBEDDING_INDEX_FILE
+                )
+                self.packed_embeddings = open_packed_embeddings(
+                    self.project_path,
+                    self.archive.getinfo(ProjectArchive.PACKED_EMBEDDING_FILE),
+                    self.embedding_index,
+                )
+                if self.packed_embeddings.dtype == np.int8:
+                    self.embedding_quantization = self.load_numpy(
+                        ProjectArchive.EMBEDDING_QUANTIZATION_FILE
+                    )
+            row = self.embedding_index["rows"][filename]
+            embedding = self.packed_embeddings[row : row + 1]
+            quantization = None
+            if self.embedding_quantization is not None:
+                quantization = self.embedding_quantization[row]
+
+        if quantization is not None:
+            embedding = dequantize_int8(embedding, quantization[0], quantization[1])
+        elif embedding.dtype != np.float32:
+            embedding = np.array(embedding, dtype=np.float32)
+        return embedding
+
+    def extract_file(self, member: str, output_path: str):
+        """
+        Copy the raw bytes of the member to the output path without decoding it
+        """
+        with self.lock:
+            with self.archive.open(member) as src, open(output_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    @staticmethod
+    def image_member(image_filename: str) -> str:
+        return f"{ProjectArchive.IMAGE_FOLDER}/{image_filename}"
+
+    @staticmethod
+    def thumbnail_member(image_filename: str) -> str:
+        filename = os.path.splitext(image_filename)[0]
+        return f"{ProjectArchive.THUMBNAIL_FOLDER}/{filename}{THUMBNAIL_EXTENSION}"
+
+    @staticmethod
+    def embedding_member(filename: str, dtype: str = "float32") -> str:
+        extension = get_embedding_extension(dtype)
+        return f"{ProjectArchive.EMBEDDING_FOLDER}/{filename}{extension}"
+
+    @staticmethod
+    def annotation_member(filename: str) -> str:
+        return f"{ProjectArchive.ANNOTATION_FOLDER}/{filename}.json"
+
+    @staticmethod
+    def feature_member(filename: str) -> str:
+        return f"{ProjectArchive.FEATURE_FOLDER}/{filename}.npy"
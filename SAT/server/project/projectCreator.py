@@ -1,25 +1,39 @@
 import logging
 import os
 import threading
-import time
 import eel
 import numpy as np
 import zipfile
 import shutil
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Tuple
+
 from ..util.general import decode_image_url
-from ..util.json import save_json
+from ..util.json import load_json, save_json
+from ..util.nms import mask_nms
+from ..util.quantization import get_embedding_extension, save_embedding
+from ..util.thumbnail import create_thumbnail
 from ..embedding import EmbeddingGenerator
+from ..segment_anything.automatic_mask_generator_onnx import SamAutomaticMaskGeneratorOnnx
 from PIL import Image
 from ..util.requests import ProjectCreateRequest
+from .packedEmbedding import PackedEmbeddingWriter, gen_embedding_index
+from .projectArchive import ProjectArchive
+from .maskFeatureIndex import FEATURE_DIM
+from .creationManifest import CreationManifest, gen_input_key
 
 from ..jsonFormat import (
+    AnnotationJson,
     ImageJson,
     ProjectInfoJson,
     AnnotationFileJson,
 )
 
 TEMP_CREATE_NAME = "__coralscop_lat_temp"
+EXIF_ORIENTATION_TAG = 0x0112
+DETECTED_CORAL_CATEGORY_ID = -1
 
 
 class ProjectCreator:
@@ -27,6 +41,11 @@ class ProjectCreator:
     SAM_ENCODER_PATH = "models/vit_h_encoder_quantized.onnx"
     SAM_MODEL_TYPE = "vit_b"
 
+    # Image decoding and writing run on worker threads, overlapping with the
+    # encoder inference. PIL and zlib release the GIL for most of the work.
+    NUM_DECODE_WORKERS = 2
+    NUM_WRITE_WORKERS = 2
+
     # Singleton
     _instance = None
 
@@ -35,13 +54,20 @@ class ProjectCreator:
             cls._instance = super(ProjectCreator, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, embedding_generator: EmbeddingGenerator):
+    def __init__(
+        self,
+        embedding_generator: EmbeddingGenerator,
+        mask_generator: SamAutomaticMaskGeneratorOnnx = None,
+    ):
         if hasattr(self, "initialized"):
             # Prevent re-initialization
             return
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.embeddings_generator = embedding_generator
+        self.mask_generator: SamAutomaticMaskGeneratorOnnx = None
+        if mask_generator is not None:
+            self.set_mask_generator(mask_generator)
 
         # Threading
         self.stop_event = threading.Event()
@@ -54,6 +80,13 @@ class ProjectCreator:
     ):
         """
         Create a proejct from the request. The project data will be stored in a zip file with .coral extension.
+
+        If resume is enabled in the request, the temporary folder of an interrupted
+        creation of the same output is reused, and only the inputs that are not
+        recorded as completed in its manifest are processed.
+
+        If coral detection is enabled in the request, the masks generated by the
+        mask generator are saved as annotations of the "Detected Coral" category.
         """
         inputs = request.get_inputs()
         inputs = sorted(inputs, key=lambda x: x["image_file_name"])
@@ -64,11 +97,43 @@ class ProjectCreator:
 
         output_dir = os.path.dirname(output_file)
 
+        # Embeddings are either stored as one npy file per image, or packed
+        # into one uncompressed file that can be memory-mapped. They can be
+        # stored as float16 or per-channel quantized int8 to save space.
+        embedding_layout = request.get_embedding_layout()
+        embedding_dtype = request.get_embedding_dtype()
+        self.logger.info(f"Embedding layout: {embedding_layout} ({embedding_dtype})")
+
         # Temporary folders for storing images, embeddings, annotations, and project info
         output_temp_dir = os.path.join(output_dir, TEMP_CREATE_NAME)
-        # Clear the temporary folder if it exists
-        if os.path.exists(output_temp_dir):
-            shutil.rmtree(output_temp_dir)
+
+        detection_config = None
+        if request.get_detect_coral():
+            if self.mask_generator is None:
+                self.logger.warning("Coral detection skipped, as no mask generator is set")
+            else:
+                detection_config = {
+                    "minArea": request.get_min_area(),
+                    "minConfidence": request.get_min_confidence(),
+                    "maxIOU": request.get_max_iou(),
+                }
+                self.logger.info(f"Coral detection: {detection_config}")
+
+        resume = request.get_resume()
+        input_keys = [gen_input_key(input) for input in inputs]
+        manifest = CreationManifest(
+            output_temp_dir,
+            output_file,
+            embedding_layout,
+            embedding_dtype,
+            input_keys,
+            detection_config,
+        )
+        resumed = resume and manifest.load()
+        if not resumed:
+            # Clear the temporary folder if it exists
+            if os.path.exists(output_temp_dir):
+                shutil.rmtree(output_temp_dir)
         os.makedirs(output_temp_dir, exist_ok=True)
 
         image_folder = os.path.join(output_temp_dir, "images")
@@ -80,77 +145,178 @@ class ProjectCreator:
         annotation_folder = os.path.join(output_temp_dir, "annotations")
         os.makedirs(annotation_folder, exist_ok=True)
 
-        project_info_path = os.path.join(output_temp_dir, "project_info.json")
-
-        # Update process in the frontend
-
-        if frontend_enabled:
-            eel.updateProgressPercentage(0)
-
-        terminated = False
-        for idx, input in enumerate(inputs):
-            image_filename = input["image_file_name"]
-            filename = os.path.splitext(image_filename)[0]
+        thumbnail_folder = os.path.join(
+            output_temp_dir, ProjectArchive.THUMBNAIL_FOLDER
+        )
+        os.makedirs(thumbnail_folder, exist_ok=True)
 
-            self.logger.info(f"Processing input {idx + 1} of {len(inputs)}")
-            self.logger.info(f"Processing image: {image_filename}")
+        if detection_config is not None:
+            feature_folder = os.path.join(
+                output_temp_dir, ProjectArchive.FEATURE_FOLDER
+            )
+            os.makedirs(feature_folder, exist_ok=True)
 
-            # image, embedding, annotations = self.process_one_input(
-            #     image_url, image_filename, min_area, min_confidence, max_iou
-            # )
+        project_info_path = os.path.join(output_temp_dir, "project_info.json")
 
-            start_time = time.time()
-            self.logger.info(f"Processing image {image_filename} ...")
+        if resumed:
+            self.reuse_completed_outputs(
+                inputs, input_keys, manifest, output_temp_dir, embedding_dtype
+            )
+            self.logger.info(
+                f"Resuming project creation with {len(manifest.get_completed_keys())} of {len(inputs)} inputs completed"
+            )
+        manifest.save()
+
+        packed_embedding_writer = None
+        if embedding_layout == ProjectArchive.EMBEDDING_LAYOUT_PACKED:
+            packed_embedding_writer = PackedEmbeddingWriter(
+                os.path.join(output_temp_dir, ProjectArchive.PACKED_EMBEDDING_FILE),
+                len(inputs),
+                embedding_dtype,
+                os.path.join(
+                    output_temp_dir, ProjectArchive.EMBEDDING_QUANTIZATION_FILE
+                ),
+                resume=resumed,
+            )
+
+        pending_inputs = [
+            (idx, input)
+            for idx, (input, key) in enumerate(zip(inputs, input_keys))
+            if not manifest.is_completed(key)
+        ]
+        num_written = len(inputs) - len(pending_inputs)
 
-            # Create image
-            if "image_path" in input:
-                image_path = input["image_path"]
-                image = Image.open(image_path)
-                image = np.array(image)
-            else:
-                image_url = input["image_url"]
-                image = decode_image_url(image_url)
-
-            if self.stop_event.is_set():
-                self.logger.info("Project creation stopped.")
-                terminated = True
-                break
-
-            # Generate embedding
-            embedding = self.embeddings_generator.generate_embedding(image)
-            if self.stop_event.is_set():
-                self.logger.info("Project creation stopped.")
-                terminated = True
-                break
-
-            # Detect coral
-            annotation_file_json = AnnotationFileJson()
-
-            image_json = ImageJson()
-            image_json.set_id(idx)
-            image_json.set_filename(image_filename)
-            image_json.set_width(image.shape[1])
-            image_json.set_height(image.shape[0])
-            annotation_file_json.add_image(image_json)
-
-            image_path = os.path.join(image_folder, image_filename)
-            embedding_path = os.path.join(embedding_folder, f"{filename}.npy")
-            annotation_path = os.path.join(annotation_folder, f"{filename}.json")
-
-            np.save(embedding_path, embedding)
-            save_json(annotation_file_json.to_json(), annotation_path)
-            Image.fromarray(image).save(image_path)
+        # Update process in the frontend
+        self.update_progress(num_written, len(inputs), frontend_enabled)
+
+        # Images are embedded in batches, so that one encoder run can use all
+        # the cores. The batch size is bounded by the memory of the activations.
+        encoder_batch_size = request.get_encoder_batch_size()
+        assert encoder_batch_size > 0, "Encoder batch size should be greater than 0"
+        self.logger.info(f"Encoder batch size: {encoder_batch_size}")
+
+        # The images are decoded ahead of the encoder and written behind it.
+        # Both queues are bounded, so that at most a few batches of decoded
+        # images are held in memory.
+        max_pending = 2 * encoder_batch_size
+        decode_executor = ThreadPoolExecutor(
+            max_workers=ProjectCreator.NUM_DECODE_WORKERS,
+            thread_name_prefix="ProjectDecode",
+        )
+        write_executor = ThreadPoolExecutor(
+            max_workers=ProjectCreator.NUM_WRITE_WORKERS,
+            thread_name_prefix="ProjectWrite",
+        )
+        # Each batch is detected by one call of the mask generator, behind the
+        # encoder. A generator with workers detects the images of the batch in
+        # parallel, and one without workers already uses all the cores.
+        detection_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ProjectDetect"
+        )
+        decode_futures: Deque[Future] = deque()
+        write_futures: Deque[Tuple[Future, int, np.ndarray]] = deque()
+        num_submitted = 0
+
+        def finish_write():
+            """
+            Wait for the oldest write and record its input as completed
+            """
+            nonlocal num_written
+            future, idx, image = write_futures.popleft()
+            future.result()
+            manifest.add_completed(
+                input_keys[idx],
+                idx,
+                inputs[idx]["image_file_name"],
+                image.shape[1],
+                image.shape[0],
+            )
+            num_written += 1
+            self.update_progress(num_written, len(inputs), frontend_enabled)
+
+        def checkpoint():
+            if packed_embedding_writer is not None:
+                packed_embedding_writer.flush()
+            manifest.save()
 
-            process_percentage = (idx + 1) / len(inputs) * 100
-            process_percentage = int(process_percentage)
+        terminated = False
+        try:
+            for batch_start in range(0, len(pending_inputs), encoder_batch_size):
+                batch_inputs = pending_inputs[
+                    batch_start : batch_start + encoder_batch_size
+                ]
+                self.logger.info(
+                    f"Processing inputs {batch_start + 1} to {batch_start + len(batch_inputs)} of {len(pending_inputs)}"
+                )
+
+                # Create images
+                while num_submitted < len(pending_inputs) and (
+                    num_submitted < batch_start + len(batch_inputs) + max_pending
+                ):
+                    _, input = pending_inputs[num_submitted]
+                    decode_futures.append(decode_executor.submit(self.load_image, input))
+                    num_submitted += 1
+                images = [decode_futures.popleft().result() for _ in batch_inputs]
+
+                if self.stop_event.is_set():
+                    self.logger.info("Project creation stopped.")
+                    terminated = True
+                    break
+
+                # Generate embeddings
+                embeddings = self.embeddings_generator.generate_embeddings(images)
+                if self.stop_event.is_set():
+                    self.logger.info("Project creation stopped.")
+                    terminated = True
+                    break
+
+                detection_future = None
+                if detection_config is not None:
+                    detection_future = detection_executor.submit(
+                        self.detect_coral, images, embeddings, detection_config
+                    )
 
-            if frontend_enabled:
-                eel.updateProgressPercentage(process_percentage)
+                for batch_idx, ((idx, input), image, embedding) in enumerate(
+                    zip(batch_inputs, images, embeddings)
+                ):
+                    future = write_executor.submit(
+                        self.save_output,
+                        idx,
+                        input,
+                        image,
+                        embedding,
+                        output_temp_dir,
+                        embedding_dtype,
+                        packed_embedding_writer,
+                        detection_future,
+                        batch_idx,
+                    )
+                    write_futures.append((future, idx, image))
+
+                if len(write_futures) > max_pending:
+                    while len(write_futures) > max_pending:
+                        finish_write()
+                    checkpoint()
+
+            while len(write_futures) > 0:
+                finish_write()
+        finally:
+            decode_executor.shutdown(wait=True, cancel_futures=True)
+            write_executor.shutdown(wait=True)
+            detection_executor.shutdown(wait=True)
+
+            if packed_embedding_writer is not None:
+                packed_embedding_writer.close()
+            # Keep the completed writes, even if the creation failed
+            while len(write_futures) > 0 and write_futures[0][0].exception() is None:
+                finish_write()
+            manifest.save()
 
         if terminated:
-            # If the process is terminated, clear the temporary folder and return
-            # self.clear_temp_folder(output_dir)
-            shutil.rmtree(output_temp_dir)
+            # If the process is terminated, clear the temporary folder and return.
+            # The folder is kept when resuming, so that the next creation can reuse it.
+            if not resume:
+                shutil.rmtree(output_temp_dir)
             status = {}
             status["finished"] = False
 
@@ -160,19 +326,37 @@ class ProjectCreator:
 
         project_info_json = ProjectInfoJson()
         project_info_json.set_last_image_idx(0)
+        project_info_json.set_embedding_layout(embedding_layout)
+        project_info_json.set_embedding_dtype(embedding_dtype)
+
+        if packed_embedding_writer is not None:
+            filenames = [
+                os.path.splitext(input["image_file_name"])[0] for input in inputs
+            ]
+            save_json(
+                gen_embedding_index(filenames, embedding_dtype),
+                os.path.join(output_temp_dir, ProjectArchive.EMBEDDING_INDEX_FILE),
+            )
 
         save_json(project_info_json.to_json(), project_info_path)
 
         # project_name = self.find_available_project_name(output_dir)
         # project_path = os.path.join(output_dir, project_name)
         project_path = output_file
-        with zipfile.ZipFile(project_path, "w") as archive:
+
+        # Write to a partial file first, so that an interrupted creation never
+        # leaves an incomplete project at the output path
+        partial_path = project_path + ".part"
+        with zipfile.ZipFile(partial_path, "w") as archive:
             for root, _, files in os.walk(output_temp_dir):
                 for file in files:
+                    if os.path.join(root, file) == manifest.get_file_path():
+                        continue
                     archive.write(
                         os.path.join(root, file),
                         os.path.relpath(os.path.join(root, file), output_temp_dir),
                     )
+        os.replace(partial_path, project_path)
 
         if os.path.exists(output_temp_dir):
             shutil.rmtree(output_temp_dir)
@@ -184,6 +368,287 @@ class ProjectCreator:
         if frontend_enabled:
             eel.afterProjectCreation(status)
 
+    def reuse_completed_outputs(
+        self,
+        inputs: List[Dict],
+        input_keys: List[str],
+        manifest: CreationManifest,
+        output_temp_dir: str,
+        embedding_dtype: str,
+    ):
+        """
+        Prepare the temporary folder of an interrupted creation for resuming.
+        The completed inputs that are no longer requested are forgotten, the
+        files of incomplete inputs are removed, and the annotation files are
+        rewritten for the completed inputs whose index changed.
+        """
+        current_keys = set(input_keys)
+        for key in manifest.get_completed_keys():
+            if key not in current_keys:
+                manifest.remove_completed(key)
+
+        expected_files = set()
+        for idx, (input, key) in enumerate(zip(inputs, input_keys)):
+            if not manifest.is_completed(key):
+                continue
+
+            completed = manifest.get_completed(key)
+            if completed["image_file_name"] != input["image_file_name"]:
+                manifest.remove_completed(key)
+                continue
+
+            expected_files.update(
+                self.get_output_files(input["image_file_name"], embedding_dtype)
+            )
+            if completed["idx"] != idx:
+                # Keep the detected corals
+                filename = os.path.splitext(input["image_file_name"])[0]
+                annotation_file = load_json(
+                    os.path.join(output_temp_dir, "annotations", f"{filename}.json")
+                )
+                self.save_annotation_file(
+                    idx,
+                    input["image_file_name"],
+                    completed["width"],
+                    completed["height"],
+                    output_temp_dir,
+                    annotation_file["annotations"],
+                )
+                manifest.add_completed(
+                    key,
+                    idx,
+                    input["image_file_name"],
+                    completed["width"],
+                    completed["height"],
+                )
+
+        for folder in [
+            "images",
+            "embeddings",
+            "annotations",
+            ProjectArchive.THUMBNAIL_FOLDER,
+            ProjectArchive.FEATURE_FOLDER,
+        ]:
+            if not os.path.exists(os.path.join(output_temp_dir, folder)):
+                continue
+            for file in os.listdir(os.path.join(output_temp_dir, folder)):
+                if f"{folder}/{file}" not in expected_files:
+                    os.remove(os.path.join(output_temp_dir, folder, file))
+
+    def get_output_files(self, image_filename: str, embedding_dtype: str) -> List[str]:
+        """
+        Get the paths of the files of one input, relative to the temporary folder
+        """
+        filename = os.path.splitext(image_filename)[0]
+        return [
+            f"images/{image_filename}",
+            f"embeddings/{filename}{get_embedding_extension(embedding_dtype)}",
+            f"annotations/{filename}.json",
+            ProjectArchive.thumbnail_member(image_filename),
+            ProjectArchive.feature_member(filename),
+        ]
+
+    def load_image(self, input: Dict) -> np.ndarray:
+        if "image_path" in input:
+            image_path = input["image_path"]
+            image = Image.open(image_path)
+            image = np.array(image)
+        else:
+            image_url = input["image_url"]
+            image = decode_image_url(image_url)
+        return image
+
+    def save_output(
+        self,
+        idx: int,
+        input: Dict,
+        image: np.ndarray,
+        embedding: np.ndarray,
+        output_temp_dir: str,
+        embedding_dtype: str,
+        packed_embedding_writer: PackedEmbeddingWriter = None,
+        detection_future: Future = None,
+        batch_idx: int = 0,
+    ):
+        """
+        Save the image, embedding and annotation file of one input into the
+        temporary project folder. The annotation file holds the detected corals
+        if detection_future is given, and is empty otherwise. The features of
+        the detected corals are saved for the mask feature index.
+
+        Args:
+        - detection_future: Detection of the encoder batch of the input, see detect_coral
+        - batch_idx: Index of the input in its encoder batch
+        """
+        image_filename = input["image_file_name"]
+        filename = os.path.splitext(image_filename)[0]
+
+        image_path = os.path.join(output_temp_dir, "images", image_filename)
+        embedding_path = os.path.join(
+            output_temp_dir,
+            "embeddings",
+            filename + get_embedding_extension(embedding_dtype),
+        )
+
+        if packed_embedding_writer is not None:
+            packed_embedding_writer.write(idx, embedding)
+        else:
+            save_embedding(embedding_path, embedding, embedding_dtype)
+
+        annotations = []
+        if detection_future is not None:
+            annotations = detection_future.result()[batch_idx]
+            self.save_feature_file(image_filename, output_temp_dir, annotations)
+        self.save_annotation_file(
+            idx,
+            image_filename,
+            image.shape[1],
+            image.shape[0],
+            output_temp_dir,
+            annotations,
+        )
+        if "image_path" in input and self.can_copy_image(input["image_path"]):
+            # Copy the original bytes, instead of a slow and lossy re-encode
+            shutil.copyfile(input["image_path"], image_path)
+        else:
+            Image.fromarray(image).save(image_path)
+
+        # Downscaled image for the gallery
+        thumbnail_path = os.path.join(
+            output_temp_dir, ProjectArchive.thumbnail_member(image_filename)
+        )
+        with open(thumbnail_path, "wb") as f:
+            f.write(create_thumbnail(image))
+
+    def can_copy_image(self, image_path: str) -> bool:
+        """
+        Check if the image file can be copied into the project as is.
+
+        The embedding is generated from the stored pixels, ignoring the EXIF
+        orientation, while browsers rotate the image by it. Such images are
+        re-encoded without the EXIF data, so that both agree.
+        """
+        with Image.open(image_path) as image:
+            orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        return orientation == 1
+
+    def save_annotation_file(
+        self,
+        idx: int,
+        image_filename: str,
+        width: int,
+        height: int,
+        output_temp_dir: str,
+        annotations: List[Dict] = None,
+    ):
+        """
+        Save the annotation file of one input. The annotations should have the
+        segmentation in COCO RLE format, the bbox and the area.
+        """
+        filename = os.path.splitext(image_filename)[0]
+        annotation_path = os.path.join(
+            output_temp_dir, "annotations", f"{filename}.json"
+        )
+
+        # Detect coral
+        annotation_file_json = AnnotationFileJson()
+
+        image_json = ImageJson()
+        image_json.set_id(idx)
+        image_json.set_filename(image_filename)
+        image_json.set_width(width)
+        image_json.set_height(height)
+        annotation_file_json.add_image(image_json)
+
+        for annotation_idx, annotation in enumerate(annotations or []):
+            annotation_json = AnnotationJson()
+            annotation_json.set_segmentation(annotation["segmentation"])
+            annotation_json.set_bbox(annotation["bbox"])
+            annotation_json.set_area(annotation["area"])
+            annotation_json.set_category_id(DETECTED_CORAL_CATEGORY_ID)
+            annotation_json.set_id(annotation_idx)
+            annotation_json.set_image_id(idx)
+            annotation_json.set_iscrowd(0)
+            if "fc_features" in annotation:
+                annotation_json.set_feature_id(annotation_idx)
+            annotation_file_json.add_annotation(annotation_json)
+
+        save_json(annotation_file_json.to_json(), annotation_path)
+
+    def save_feature_file(
+        self, image_filename: str, output_temp_dir: str, annotations: List[Dict]
+    ):
+        """
+        Save the features of the detected corals of one input. Row i is the
+        feature of the annotation whose feature_id is i, which stays with the
+        annotation when the ids are reused by the label page.
+        """
+        filename = os.path.splitext(image_filename)[0]
+        feature_path = os.path.join(
+            output_temp_dir, ProjectArchive.feature_member(filename)
+        )
+        features = np.zeros((len(annotations), FEATURE_DIM), dtype=np.float16)
+        for annotation_idx, annotation in enumerate(annotations):
+            features[annotation_idx] = annotation["fc_features"]
+        np.save(feature_path, features)
+
+    def detect_coral(
+        self,
+        images: List[np.ndarray],
+        embeddings: List[np.ndarray],
+        detection_config: Dict,
+    ) -> List[List[Dict]]:
+        """
+        Detect the corals in a batch of images with the mask generator, reusing
+        the embeddings of the images. The masks below the minimum area or
+        confidence are removed, and the masks overlapping a more confident mask
+        by more than the maximum IoU are suppressed.
+
+        Returns:
+        - List[List[Dict]]: The detected masks of each image, with the
+          segmentation in COCO RLE format and the normalized features in fc_features
+        """
+        annotations_list = self.mask_generator.generate_batch(images, embeddings)
+
+        detections = []
+        for image, annotations in zip(images, annotations_list):
+            min_area = detection_config["minArea"] * image.shape[0] * image.shape[1]
+            annotations = [
+                annotation
+                for annotation in annotations
+                if annotation["area"] >= min_area
+                and annotation["predicted_iou"] >= detection_config["minConfidence"]
+            ]
+
+            keep = mask_nms(
+                [annotation["segmentation"] for annotation in annotations],
+                np.array([annotation["predicted_iou"] for annotation in annotations]),
+                detection_config["maxIOU"],
+            )
+            detections.append([annotations[i] for i in sorted(keep)])
+        return detections
+
+    def set_mask_generator(self, mask_generator: SamAutomaticMaskGeneratorOnnx):
+        assert (
+            mask_generator.output_mode == "coco_rle"
+        ), "The mask generator should output COCO RLE masks"
+        self.mask_generator = mask_generator
+
+    def get_mask_generator(self) -> SamAutomaticMaskGeneratorOnnx:
+        return self.mask_generator
+
+    def update_progress(
+        self, num_finished: int, num_total: int, frontend_enabled: bool
+    ):
+        # A request without inputs is complete before any work
+        if num_total == 0:
+            process_percentage = 100
+        else:
+            process_percentage = int(num_finished / num_total * 100)
+
+        if frontend_enabled:
+            eel.updateProgressPercentage(process_percentage)
+
     def create(
         self,
         request: ProjectCreateRequest,
@@ -3,14 +3,20 @@ import os
 import shutil
 import time
 import zipfile
+from functools import partial
 from typing import Dict, List, Tuple, Union
 
 import numpy as np
-from PIL import Image
 
 from ..dataset import Data, Dataset
 from ..util.general import get_resource_path
 from ..util.json import load_json
+from ..util.quantization import (
+    dequantize_int8,
+    get_embedding_extension,
+    load_embedding,
+)
+from .projectArchive import ProjectArchive
 
 TEMP_CREATE_NAME = "__coralscop_lat_temp"
 TEMP_CREATE_NAME_2 = "__coralscop_lat_temp_2"
@@ -22,17 +28,32 @@ class ProjectLoader:
     WEB_FOLDER_NAME = "web"
     ASSET_FOLDER = "assets/images"
 
+    # Routes serving the images and thumbnails of a lazily loaded project
+    # from the project file
+    PROJECT_IMAGE_ROUTE = "project_images"
+    PROJECT_THUMBNAIL_ROUTE = "project_thumbnails"
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    def load(self, project_path: str) -> Union[Dataset, int]:
+    def load(self, project_path: str, lazy: bool = False) -> Union[Dataset, int]:
         """
         Load a project from the given project path.
 
+        If lazy is True, only the index of the project (file listing, project
+        info and annotations) is read up front. The embeddings are read from
+        the project file on demand.
+
         Returns:
         - Dataset: The loaded dataset
         - int: Last image index
         """
+        # Undo the last save, if it was interrupted
+        ProjectArchive.recover(project_path)
+
+        if lazy:
+            return self.load_lazy(project_path)
+
         # Unzip the project file
         start_time = time.time()
         temp_output_dir = os.path.join(os.path.dirname(project_path), TEMP_LOAD_NAME)
@@ -53,6 +74,27 @@ class ProjectLoader:
         image_filenames = sorted(image_filenames)
         filenames = [os.path.splitext(filename)[0] for filename in image_filenames]
 
+        # Load project info
+        project_info = load_json(project_info_path)
+        embedding_layout, embedding_dtype = self.get_embedding_format(project_info)
+
+        packed_embeddings = None
+        if embedding_layout == ProjectArchive.EMBEDDING_LAYOUT_PACKED:
+            embedding_index = load_json(
+                os.path.join(temp_output_dir, ProjectArchive.EMBEDDING_INDEX_FILE)
+            )
+            packed_embeddings = np.fromfile(
+                os.path.join(temp_output_dir, ProjectArchive.PACKED_EMBEDDING_FILE),
+                dtype=embedding_index["dtype"],
+            ).reshape([-1] + embedding_index["shape"])
+            embedding_quantization = None
+            if embedding_dtype == "int8":
+                embedding_quantization = np.load(
+                    os.path.join(
+                        temp_output_dir, ProjectArchive.EMBEDDING_QUANTIZATION_FILE
+                    )
+                )
+
         # Move the images files to the assets folder
         image_files = [
             os.path.join(image_folder, filename)
@@ -64,14 +106,25 @@ class ProjectLoader:
         # Construct dataset
         dataset = Dataset()
         for idx, filename in enumerate(filenames):
-            embedding_path = os.path.join(embedding_folder, f"{filename}.npy")
+            embedding_path = os.path.join(
+                embedding_folder, filename + get_embedding_extension(embedding_dtype)
+            )
             annotation_path = os.path.join(annotation_folder, f"{filename}.json")
 
             data = Data()
             data.set_image_name(image_filenames[idx])
             data.set_image_path(asset_image_paths[idx])
 
-            embedding = np.load(embedding_path)
+            if packed_embeddings is not None:
+                row = embedding_index["rows"][filename]
+                embedding = packed_embeddings[row : row + 1]
+                if embedding_quantization is not None:
+                    scale, zero_point = embedding_quantization[row]
+                    embedding = dequantize_int8(embedding, scale, zero_point)
+                else:
+                    embedding = embedding.astype(np.float32)
+            else:
+                embedding = load_embedding(embedding_path, embedding_dtype)
             data.set_embedding(embedding)
 
             if os.path.exists(annotation_path):
@@ -81,11 +134,10 @@ class ProjectLoader:
             data.set_idx(idx)
             dataset.add_data(data)
 
-        # Load project info
-        project_info = load_json(project_info_path)
         last_image_idx = project_info["last_image_idx"]
         category_info = project_info["category_info"]
         dataset.set_category_info(category_info)
+        dataset.set_embedding_format(embedding_layout, embedding_dtype)
 
         # Delete the temporary folder
         shutil.rmtree(temp_output_dir)
@@ -94,6 +146,91 @@ class ProjectLoader:
 
         return dataset, last_image_idx
 
+    def load_lazy(self, project_path: str) -> Union[Dataset, int]:
+        """
+        Load a project without extracting it. The project file is kept open
+        by the dataset, and each embedding is read from its zip member
+        when it is requested.
+
+        Returns:
+        - Dataset: The loaded dataset
+        - int: Last image index
+        """
+        start_time = time.time()
+        archive = ProjectArchive(project_path)
+
+        image_filenames = archive.list_files(ProjectArchive.IMAGE_FOLDER)
+        filenames = [os.path.splitext(filename)[0] for filename in image_filenames]
+
+        project_info = archive.load_json(ProjectArchive.PROJECT_INFO_FILE)
+        embedding_layout, embedding_dtype = self.get_embedding_format(project_info)
+
+        # The images are served to the front end from the project file
+        image_urls = [
+            self.get_image_url(archive, image_filename)
+            for image_filename in image_filenames
+        ]
+
+        dataset = Dataset()
+        dataset.set_archive(archive)
+        dataset.set_embedding_format(embedding_layout, embedding_dtype)
+        for idx, filename in enumerate(filenames):
+            data = Data()
+            data.set_image_name(image_filenames[idx])
+            data.set_image_path(image_urls[idx])
+            data.set_thumbnail_path(
+                self.get_image_url(
+                    archive, image_filenames[idx], ProjectLoader.PROJECT_THUMBNAIL_ROUTE
+                )
+            )
+
+            if embedding_layout == ProjectArchive.EMBEDDING_LAYOUT_PACKED:
+                embedding_loader = partial(archive.load_packed_embedding, filename)
+            else:
+                embedding_loader = partial(
+                    archive.load_embedding, filename, embedding_dtype
+                )
+            data.set_embedding_loader(embedding_loader)
+
+            annotation_member = ProjectArchive.annotation_member(filename)
+            if archive.contains(annotation_member):
+                data.set_segmentation(archive.load_json(annotation_member))
+
+            data.set_idx(idx)
+            dataset.add_data(data)
+
+        last_image_idx = project_info["last_image_idx"]
+        dataset.set_category_info(project_info["category_info"])
+
+        self.logger.info(
+            f"Project index loaded in {time.time() - start_time} seconds"
+        )
+
+        return dataset, last_image_idx
+
+    def get_embedding_format(self, project_info: Dict) -> Tuple[str, str]:
+        """
+        Get the embedding layout and dtype of the project.
+        Projects created before these options were added use float32 npy files.
+        """
+        embedding_layout = project_info.get(
+            "embedding_layout", ProjectArchive.EMBEDDING_LAYOUT_NPY
+        )
+        embedding_dtype = project_info.get("embedding_dtype", "float32")
+        return embedding_layout, embedding_dtype
+
+    def get_image_url(
+        self,
+        archive: ProjectArchive,
+        image_filename: str,
+        route: str = PROJECT_IMAGE_ROUTE,
+    ) -> str:
+        """
+        Get the url of an image of the project, relative to the web folder.
+        It is served from the project file by the given route.
+        """
+        return "/".join([route, archive.get_token(), image_filename])
+
     def store_image(self, image_paths: List[str]) -> List[str]:
         """
         Store images to the assest folder for front end to access.
@@ -109,11 +246,11 @@ class ProjectLoader:
 
         assset_image_paths = []
         for image_path in image_paths:
-            image = Image.open(image_path)
-
+            # The images of a project are stored as they are displayed, so
+            # they are copied without decoding
             save_path = os.path.join(asset_folder, os.path.basename(image_path))
             save_path = get_resource_path(save_path)
-            image.save(save_path)
+            shutil.copyfile(image_path, save_path)
 
             asset_image_path = os.path.join(
                 ProjectLoader.ASSET_FOLDER, os.path.basename(image_path)
@@ -1,11 +1,14 @@
 import os
+import json
 import zipfile
 import logging
 import shutil
+import warnings
 
-from ..util.json import save_json
-from ..dataset import Dataset
-from PIL import Image
+from ..dataset import Dataset, Data
+from .projectArchive import ProjectArchive
+
+from typing import Dict, List
 
 from ..jsonFormat import (
     ImageJson,
@@ -16,90 +19,212 @@ from ..jsonFormat import (
 )
 
 
-TEMP_CREATE_NAME = "__coralscop_lat_temp"
-TEMP_CREATE_NAME_2 = "__coralscop_lat_temp_2"
-
-
 class ProjectSaver:
+    """
+    Save the dataset into a project file.
+
+    When the dataset is saved back to the project it was loaded from, only the
+    annotation files modified since the last save and the project info are
+    written. They are appended to the project file, superseding the older
+    members with the same name. The project file is compacted once the
+    superseded members take up too much space.
+
+    The members and the new central directory are appended after the end of
+    the previous central directory, which is never overwritten. If a save is
+    interrupted, ProjectArchive.recover cuts the file back to the previous
+    central directory.
+    """
+
+    # Compact the project file when the superseded members take up more than
+    # this fraction of the file. Compaction rewrites the whole project, so
+    # its cost is amortized over the saves that produced the stale data.
+    COMPACT_STALE_RATIO = 0.25
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def save_dataset(
         self, dataset: Dataset, project_path_origin: str, project_path_new: str
     ):
-        # Unzip the original project to temp folder
-        temp_folder_origin = os.path.join(
-            os.path.dirname(project_path_origin), TEMP_CREATE_NAME
-        )
-        if os.path.exists(temp_folder_origin):
-            shutil.rmtree(temp_folder_origin)
+        if os.path.exists(project_path_new) and os.path.samefile(
+            project_path_origin, project_path_new
+        ):
+            self.save_incremental(dataset, project_path_origin)
+        else:
+            self.save_copy(dataset, project_path_origin, project_path_new)
+
+    def save_incremental(self, dataset: Dataset, project_path: str):
+        """
+        Append the modified annotations and the project info to the project file
+        """
+        dirty_data_ids = dataset.get_dirty_data_ids()
+        self.logger.info(f"Saving {len(dirty_data_ids)} modified annotation files")
+
+        with warnings.catch_warnings():
+            # Superseding a member triggers a duplicate name warning
+            warnings.filterwarnings("ignore", message="Duplicate name")
+            with open(project_path, "r+b") as f:
+                with zipfile.ZipFile(f, "a") as archive:
+                    # Append after the previous central directory instead of
+                    # over it, so that it stays valid until the save completes
+                    archive.start_dir = f.seek(0, os.SEEK_END)
+
+                    for data_idx in dirty_data_ids:
+                        data = dataset.get_data(data_idx)
+                        archive.writestr(
+                            self.get_annotation_member(data),
+                            self.to_json_str(self.gen_annotation_file_json(data)),
+                        )
+
+                    archive.writestr(
+                        ProjectArchive.PROJECT_INFO_FILE,
+                        self.to_json_str(self.gen_project_info_json(dataset)),
+                    )
 
-        os.makedirs(temp_folder_origin, exist_ok=True)
-        with zipfile.ZipFile(project_path_origin, "r") as archive:
-            archive.extractall(temp_folder_origin)
+                    # The members must be on disk before the central
+                    # directory that points to them
+                    self.sync(f)
+                self.sync(f)
 
-        # Create temp folder for the new project
-        temp_folder_new = os.path.join(
-            os.path.dirname(project_path_new), TEMP_CREATE_NAME_2
-        )
-        if os.path.exists(temp_folder_new):
-            shutil.rmtree(temp_folder_new)
-        os.makedirs(temp_folder_new, exist_ok=True)
-
-        # Copy the images to the new project folder
-        image_folder_origin = os.path.join(temp_folder_origin, "images")
-        image_folder_new = os.path.join(temp_folder_new, "images")
-        os.makedirs(image_folder_new, exist_ok=True)
-        for image_name in os.listdir(image_folder_origin):
-            image_path_origin = os.path.join(image_folder_origin, image_name)
-            image_path_new = os.path.join(image_folder_new, image_name)
-            shutil.copy(image_path_origin, image_path_new)
-
-        # Copy the embeddings to the new project folder
-        embedding_folder_origin = os.path.join(temp_folder_origin, "embeddings")
-        embedding_folder_new = os.path.join(temp_folder_new, "embeddings")
-        os.makedirs(embedding_folder_new, exist_ok=True)
-        for embedding_name in os.listdir(embedding_folder_origin):
-            embedding_path_origin = os.path.join(
-                embedding_folder_origin, embedding_name
+        dataset.clear_dirty_data_ids(dirty_data_ids)
+
+        stale_bytes, total_bytes = self.measure_stale_bytes(project_path)
+        if stale_bytes > ProjectSaver.COMPACT_STALE_RATIO * total_bytes:
+            self.logger.info(
+                f"Compacting project file with {stale_bytes} of {total_bytes} bytes superseded ..."
             )
-            embedding_path_new = os.path.join(embedding_folder_new, embedding_name)
-            shutil.copy(embedding_path_origin, embedding_path_new)
-
-        # Generate annotation to the new project folder
-        annotation_folder_new = os.path.join(temp_folder_new, "annotations")
-        os.makedirs(annotation_folder_new, exist_ok=True)
-        for data in dataset.get_data_list():
-            filename = os.path.splitext(data.get_image_name())[0]
-            annotation_path = os.path.join(annotation_folder_new, f"{filename}.json")
-
-            annotation_file_json = AnnotationFileJson()
-
-            image_json = ImageJson()
-            image_json.set_id(data.get_idx())
-            image_json.set_filename(data.get_image_name())
-            image_json.set_width(data.get_image_width())
-            image_json.set_height(data.get_image_height())
-            annotation_file_json.add_image(image_json)
-
-            for mask in data.get_segmentation()["annotations"]:
-                annotation_json = AnnotationJson()
-                annotation_json.set_segmentation(mask["segmentation"])
-                annotation_json.set_bbox(mask["bbox"])
-                annotation_json.set_area(mask["area"])
-                annotation_json.set_category_id(mask["category_id"])
-                annotation_json.set_id(mask["id"])
-                annotation_json.set_image_id(data.get_idx())
-                annotation_json.set_iscrowd(mask["iscrowd"])
-                annotation_file_json.add_annotation(annotation_json)
-
-            save_json(annotation_file_json.to_json(), annotation_path)
-
-        # Generate the project info file to the new project folder
-        project_info_path = os.path.join(temp_folder_new, "project_info.json")
+            try:
+                self.compact(project_path)
+            except OSError as e:
+                # e.g. the project file is still mapped in memory on Windows.
+                # The appended members are valid, so compaction can wait.
+                self.logger.warning(f"Failed to compact project file: {e}")
+                if os.path.exists(project_path + ".tmp"):
+                    os.remove(project_path + ".tmp")
+
+    def save_copy(
+        self, dataset: Dataset, project_path_origin: str, project_path_new: str
+    ):
+        """
+        Save the dataset to a new project file. The images, embeddings and other
+        project files are copied from the original project without extraction.
+        All the annotation files are generated from the dataset.
+        """
+        temp_path = project_path_new + ".tmp"
+        with zipfile.ZipFile(project_path_origin, "r") as archive_origin:
+            with zipfile.ZipFile(temp_path, "w") as archive_new:
+                for info in self.get_live_members(archive_origin):
+                    if self.is_generated_member(info.filename):
+                        continue
+                    self.copy_member(archive_origin, archive_new, info)
+
+                for data in dataset.get_data_list():
+                    archive_new.writestr(
+                        self.get_annotation_member(data),
+                        self.to_json_str(self.gen_annotation_file_json(data)),
+                    )
 
+                archive_new.writestr(
+                    ProjectArchive.PROJECT_INFO_FILE,
+                    self.to_json_str(self.gen_project_info_json(dataset)),
+                )
+
+        os.replace(temp_path, project_path_new)
+
+    def compact(self, project_path: str):
+        """
+        Rewrite the project file with the latest version of each member only
+        """
+        temp_path = project_path + ".tmp"
+        with zipfile.ZipFile(project_path, "r") as archive_origin:
+            with zipfile.ZipFile(temp_path, "w") as archive_new:
+                for info in self.get_live_members(archive_origin):
+                    self.copy_member(archive_origin, archive_new, info)
+        os.replace(temp_path, project_path)
+
+    def sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def measure_stale_bytes(self, project_path: str):
+        """
+        Returns:
+        - int: Number of bytes taken by the superseded members and the
+          previous central directories
+        - int: Size of the project file
+        """
+        with zipfile.ZipFile(project_path, "r") as archive:
+            live_bytes = sum(
+                info.compress_size for info in self.get_live_members(archive)
+            )
+        total_bytes = os.path.getsize(project_path)
+        return total_bytes - live_bytes, total_bytes
+
+    def get_live_members(self, archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+        """
+        Get the latest version of each member, in the order of the archive
+        """
+        latest: Dict[str, zipfile.ZipInfo] = {}
+        for info in archive.infolist():
+            latest[info.filename] = info
+        return [info for info in archive.infolist() if latest[info.filename] is info]
+
+    def is_generated_member(self, member: str) -> bool:
+        """
+        Check if the member is generated from the dataset while saving
+        """
+        return member == ProjectArchive.PROJECT_INFO_FILE or member.startswith(
+            f"{ProjectArchive.ANNOTATION_FOLDER}/"
+        )
+
+    def copy_member(
+        self,
+        archive_origin: zipfile.ZipFile,
+        archive_new: zipfile.ZipFile,
+        info: zipfile.ZipInfo,
+    ):
+        # Copy the member info, since writing updates the offsets in the info
+        info_new = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        info_new.compress_type = info.compress_type
+        info_new.external_attr = info.external_attr
+        info_new.file_size = info.file_size
+
+        with archive_origin.open(info) as src, archive_new.open(info_new, "w") as dst:
+            shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+    def get_annotation_member(self, data: Data) -> str:
+        filename = os.path.splitext(data.get_image_name())[0]
+        return ProjectArchive.annotation_member(filename)
+
+    def gen_annotation_file_json(self, data: Data) -> Dict:
+        annotation_file_json = AnnotationFileJson()
+
+        image_json = ImageJson()
+        image_json.set_id(data.get_idx())
+        image_json.set_filename(data.get_image_name())
+        image_json.set_width(data.get_image_width())
+        image_json.set_height(data.get_image_height())
+        annotation_file_json.add_image(image_json)
+
+        for mask in data.get_segmentation()["annotations"]:
+            annotation_json = AnnotationJson()
+            annotation_json.set_segmentation(mask["segmentation"])
+            annotation_json.set_bbox(mask["bbox"])
+            annotation_json.set_area(mask["area"])
+            annotation_json.set_category_id(mask["category_id"])
+            annotation_json.set_id(mask["id"])
+            annotation_json.set_image_id(data.get_idx())
+            annotation_json.set_iscrowd(mask["iscrowd"])
+            annotation_json.set_feature_id(mask.get("feature_id"))
+            annotation_file_json.add_annotation(annotation_json)
+
+        return annotation_file_json.to_json()
+
+    def gen_project_info_json(self, dataset: Dataset) -> Dict:
         project_info_json = ProjectInfoJson()
         project_info_json.set_last_image_idx(dataset.get_last_saved_id())
+        project_info_json.set_embedding_layout(dataset.get_embedding_layout())
+        project_info_json.set_embedding_dtype(dataset.get_embedding_dtype())
         for category in dataset.get_category_info():
             category_json = CategoryJson()
             category_json.set_id(category["id"])
@@ -107,24 +232,7 @@ class ProjectSaver:
             category_json.set_supercategory(category["supercategory"])
             project_info_json.add_category_info(category_json)
 
-        project_info_json.set_last_image_idx(dataset.get_last_saved_id())
-
-        save_json(project_info_json.to_json(), project_info_path)
-
-        # Remove the temp folder for original project
-        shutil.rmtree(temp_folder_origin)
-
-        # Zip the new project folder to the new project path
-        if os.path.exists(project_path_new):
-            os.remove(project_path_new)
-
-        with zipfile.ZipFile(project_path_new, "w") as archive:
-            for root, _, files in os.walk(temp_folder_new):
-                for file in files:
-                    archive.write(
-                        os.path.join(root, file),
-                        os.path.relpath(os.path.join(root, file), temp_folder_new),
-                    )
+        return project_info_json.to_json()
 
-        # Remove the temp folder for the new project
-        shutil.rmtree(temp_folder_new)
+    def to_json_str(self, data: Dict) -> str:
+        return json.dumps(data, indent=4)
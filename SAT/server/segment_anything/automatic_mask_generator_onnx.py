@@ -1,12 +1,18 @@
+import cv2
+import math
+import os
+import threading
 import numpy as np
 from typing import Tuple
 from PIL import Image
 
 import multiprocessing
 
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
 from copy import deepcopy
-from ..util.onnx import preprocess_image, preprocess_point, preprocess_labels
+from ..util.onnx import determine_sam_input_shape, preprocess_image, preprocess_point, preprocess_labels
+from ..util.nms import nms
 import onnxruntime as ort
 import torch
 
@@ -56,59 +62,34 @@ def normalize(input: np.ndarray, p: float = 2.0, dim: int = 1, eps: float = 1e-1
         np.divide(input, norm, out=out)
         return out
 
-def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-
-    areas = (x2 - x1) * (y2 - y1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0, xx2 - xx1)
-        h = np.maximum(0, yy2 - yy1)
-        inter = w * h
-        iou = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(iou <= iou_threshold)[0]
-        order = order[inds + 1]
-
-    return np.array(keep)
-
-def batched_nms(
-    boxes: np.ndarray,
-    scores: np.ndarray,
-    idxs: np.ndarray,
-    iou_threshold: float,
-) -> np.ndarray:
-    unique_classes = np.unique(idxs)
-    keep_mask = np.zeros_like(scores, dtype=bool)
-
-    for cls in unique_classes:
-        cls_indices = np.where(idxs == cls)[0]
-        cls_keep_indices = nms(boxes[cls_indices], scores[cls_indices], iou_threshold)
-        keep_mask[cls_indices[cls_keep_indices]] = True
-
-    keep_indices = np.where(keep_mask)[0]
-    return keep_indices[scores[keep_indices].argsort()[::-1]]
-
 def box_area(boxes: np.ndarray) -> np.ndarray:
     return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
 
+def create_session(model_path: str, num_threads: Optional[int] = None) -> ort.InferenceSession:
+    session_options = ort.SessionOptions()
+    if num_threads is not None:
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+    return ort.InferenceSession(model_path, sess_options=session_options)
+
+# Generator of the current worker process, see SamAutomaticMaskGeneratorOnnx.num_workers
+_worker_generator = None
+
+def _init_worker(encoder_path: str, decoder_path: str, generator_kwargs: Dict[str, Any]):
+    global _worker_generator
+    _worker_generator = SamAutomaticMaskGeneratorOnnx(encoder_path, decoder_path, **generator_kwargs)
+
+def _process_crop_in_worker(*args) -> MaskData:
+    return _worker_generator._process_crop(*args)
+
+def _generate_in_worker(image: np.ndarray, embedding: Optional[np.ndarray]) -> List[Dict[str, Any]]:
+    return _worker_generator.generate(image, embedding)
+
 class SamAutomaticMaskGeneratorOnnx:
     def __init__(
         self,
-        encoder_onnx: ort.InferenceSession,
-        decoder_onnx: ort.InferenceSession,
+        encoder_onnx: Union[ort.InferenceSession, str],
+        decoder_onnx: Union[ort.InferenceSession, str],
         points_per_side: Optional[int] = 32,
         points_per_batch: int = 64,
         pred_iou_thresh: float = 0.88,
@@ -122,7 +103,27 @@ class SamAutomaticMaskGeneratorOnnx:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        low_res_filtering: bool = False,
+        num_workers: int = 0,
+        num_threads: Optional[int] = None,
     ) -> None:
+        """
+        encoder_onnx, decoder_onnx: the ONNX sessions, or the paths of the models
+        to create the sessions from.
+
+        low_res_filtering: filter the masks by category, predicted IoU and
+        stability score on the 256x256 low resolution masks, and upsample only
+        the remaining masks to the image size. It takes much less time and
+        memory on large images, but the stability score is approximated on the
+        low resolution masks.
+
+        num_workers: process the crops of an image, or the images of
+        generate_batch, in a pool of processes. Each worker creates its own
+        sessions, so the models must be given as paths.
+
+        num_threads: intra-op threads of the sessions created from paths. By
+        default, the workers share the CPU cores.
+        """
         assert (points_per_side is None) != (point_grids is None), \
             "Exactly one of points_per_side or point_grid must be provided."
         if points_per_side is not None:
@@ -150,13 +151,105 @@ class SamAutomaticMaskGeneratorOnnx:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.low_res_filtering = low_res_filtering
+
+        self.mask_threshold = 0.0
 
+        self.executor = None
+        if num_workers > 0:
+            assert isinstance(encoder_onnx, str) and isinstance(decoder_onnx, str), \
+                "The models must be given as paths to create the sessions of the workers."
+            if num_threads is None:
+                num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            generator_kwargs = {
+                "points_per_side": None,
+                "points_per_batch": points_per_batch,
+                "pred_iou_thresh": pred_iou_thresh,
+                "stability_score_thresh": stability_score_thresh,
+                "stability_score_offset": stability_score_offset,
+                "box_nms_thresh": box_nms_thresh,
+                "crop_n_layers": crop_n_layers,
+                "crop_nms_thresh": crop_nms_thresh,
+                "crop_overlap_ratio": crop_overlap_ratio,
+                "crop_n_points_downscale_factor": crop_n_points_downscale_factor,
+                "point_grids": self.point_grids,
+                "min_mask_region_area": min_mask_region_area,
+                "output_mode": output_mode,
+                "low_res_filtering": low_res_filtering,
+                "num_threads": num_threads,
+            }
+            # Spawn the workers, as onnxruntime is not safe to fork
+            self.executor = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(encoder_onnx, decoder_onnx, generator_kwargs),
+            )
+            # The sessions are only created in the workers
+            self.encoder_onnx = None
+            self.decoder_onnx = None
+            return
+
+        # The encoder session is created on first use, as the images often
+        # come with their stored embedding
+        self.encoder_path = None
+        self.num_threads = num_threads
+        self.encoder_lock = threading.Lock()
+        if isinstance(encoder_onnx, str):
+            self.encoder_path = encoder_onnx
+            encoder_onnx = None
+        if isinstance(decoder_onnx, str):
+            decoder_onnx = create_session(decoder_onnx, num_threads)
         self.encoder_onnx = encoder_onnx    
         self.decoder_onnx = decoder_onnx
-        self.mask_threshold = 0.0
 
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
-        mask_data = self._generate_masks(image)
+        # Decoders exported with a dynamic prompt axis decode a whole batch of
+        # points in one run. Older decoders only take one prompt per run.
+        point_coords_shape = [
+            input.shape for input in decoder_onnx.get_inputs() if input.name == "point_coords"
+        ][0]
+        self.decoder_batch_supported = not isinstance(point_coords_shape[0], int)
+
+    def close(self):
+        """
+        Shut down the worker processes
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def generate_batch(
+        self, images: List[np.ndarray], embeddings: Optional[List[np.ndarray]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Generate the masks of a batch of images. With workers, the images are
+        processed in parallel, each by one worker.
+        """
+        if embeddings is None:
+            embeddings = [None] * len(images)
+        assert len(images) == len(embeddings), "Each image should have one embedding."
+
+        if self.executor is None:
+            return [self.generate(image, embedding) for image, embedding in zip(images, embeddings)]
+
+        futures = [
+            self.executor.submit(_generate_in_worker, image, embedding)
+            for image, embedding in zip(images, embeddings)
+        ]
+        return [future.result() for future in futures]
+
+    def generate(
+        self, image: np.ndarray, embedding: Optional[np.ndarray] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Generate the masks of an image.
+
+        Args:
+        - image: (H, W, 3) RGB image
+        - embedding: (1, 256, 64, 64) embedding of the whole image, e.g. the
+          embedding stored in the project. The image is encoded if not given.
+        """
+        mask_data = self._generate_masks(image, embedding)
 
         if self.min_mask_region_area > 0:
             mask_data = self.postprocess_small_regions(
@@ -182,20 +275,36 @@ class SamAutomaticMaskGeneratorOnnx:
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": float(mask_data["stability_score"][idx]),
                 "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
+                "fc_features": mask_data["fc_features"][idx],
             }
             curr_anns.append(ann)
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, embedding: Optional[np.ndarray] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
+        orig_box = [0, 0, orig_size[1], orig_size[0]]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        data = MaskData()
+        crop_args = []
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
+            # The given embedding is only valid for the crop of the whole image
+            crop_embedding = embedding if crop_box == orig_box else None
+            crop_args.append((image, crop_box, layer_idx, orig_size, crop_embedding))
+
+        if self.executor is not None:
+            futures = [self.executor.submit(_process_crop_in_worker, *args) for args in crop_args]
+            crop_results = (future.result() for future in futures)
+        else:
+            crop_results = (self._process_crop(*args) for args in crop_args)
+
+        # The masks of all crops are merged by the NMS across crops
+        data = MaskData()
+        for crop_data in crop_results:
             data.cat(crop_data)
 
         if len(crop_boxes) > 1:
@@ -207,10 +316,9 @@ class SamAutomaticMaskGeneratorOnnx:
             )
             data.filter(keep_by_nms)
 
-        fc_features = normalize(data["fc_features"], dim=-1)
-        similarity = np.dot(fc_features, fc_features.T)
-        np.fill_diagonal(similarity, -np.inf)
-        data["similarity"] = similarity
+        # The features are compared by their dot product, e.g. by the mask
+        # feature index of the project, instead of a dense similarity matrix
+        data["fc_features"] = normalize(data["fc_features"], dim=-1)
         data.to_numpy()
         return data
 
@@ -220,10 +328,17 @@ class SamAutomaticMaskGeneratorOnnx:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        embedding: Optional[np.ndarray] = None,
     ) -> MaskData:
         x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
+        cropped_im = Image.fromarray(image[y0:y1, x0:x1, :])
+        cropped_im_size = (cropped_im.height, cropped_im.width)
+        # The points are scaled to the resized image, not to the padded tensor
+        resized_size = determine_sam_input_shape(cropped_im)
+
+        # Encode the crop once and share the embedding across the point batches
+        if embedding is None:
+            embedding = self._encode_image(cropped_im)
 
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
@@ -231,7 +346,9 @@ class SamAutomaticMaskGeneratorOnnx:
 
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(cropped_im, points, cropped_im_size, crop_box, orig_size)
+            batch_data = self._process_batch(
+                embedding, points, cropped_im_size, resized_size, crop_box, orig_size
+            )
             data.cat(batch_data)
             del batch_data
 
@@ -244,67 +361,65 @@ class SamAutomaticMaskGeneratorOnnx:
 
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = np.array([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = np.tile(np.array(crop_box), (len(data["rles"]), 1))
         return data
 
+    def _encode_image(self, image: Image.Image) -> np.ndarray:
+        with self.encoder_lock:
+            if self.encoder_onnx is None:
+                self.encoder_onnx = create_session(self.encoder_path, self.num_threads)
+        input_tensor = preprocess_image(image)
+        outputs = self.encoder_onnx.run(None, {"images": input_tensor})
+        return outputs[0]
+
     def _process_batch(
         self,
-        image: np.ndarray,
+        embeddings: np.ndarray,
         points: np.ndarray,
         im_size: Tuple[int, ...],
+        resized_size: Tuple[int, int],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
     ) -> MaskData:
         orig_h, orig_w = orig_size
+        input_image_height, input_image_width = im_size
+        resized_width, resized_height = resized_size
 
-        image = Image.fromarray(image)
-        input_image_width, input_image_height = image.size
-        input_tensor = preprocess_image(image)
-        resized_width, resized_height = input_tensor.shape[3], input_tensor.shape[2]
-
-        outputs = self.encoder_onnx.run(None, {"images": input_tensor})
-        embeddings = outputs[0]
-
-        bs = points.shape[0]
         onnx_coord_batch = preprocess_point(points, input_image_width, input_image_height, resized_width, resized_height)
         onnx_label_batch = np.ones(len(points), dtype=np.int32)
         onnx_label_batch = preprocess_labels(onnx_label_batch)
 
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
-        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
-
-        masks = np.zeros((bs, input_image_height, input_image_width), dtype=np.float32)
-        iou_preds = np.zeros((bs), dtype=np.float32)
-        cate_preds = np.zeros((bs), dtype=np.float32)
-        fc_features = np.zeros((bs, 256), dtype=np.float32)
-
-        # Process the point one by one
-        for i in range(bs):
-            onnx_coord = onnx_coord_batch[:, i, :][:, None, :]
-            onnx_label = onnx_label_batch[:, i][None, :]
-
-            mask, iou_pred, _, cate_pred, fc_feature = self.decoder_onnx.run(None, {
-                "image_embeddings": embeddings,
-                "point_coords": onnx_coord,
-                "point_labels": onnx_label,
-                "mask_input": onnx_mask_input,
-                "has_mask_input": onnx_has_mask_input,
-                "orig_im_size": np.array([input_image_height, input_image_width], dtype=np.float32)
-            })
-
-            cate_pred = np.argmax(cate_pred, axis=2)[0]
-            masks[i] = mask
-            iou_preds[i] = iou_pred
-            cate_preds[i] = cate_pred
-            fc_features[i] = fc_feature
+        # One single-point prompt per grid point: (bs, 1, 2) and (bs, 1)
+        onnx_coord_batch = onnx_coord_batch.transpose(1, 0, 2)
+        onnx_label_batch = onnx_label_batch.transpose(1, 0)
+
+        if self.low_res_filtering:
+            # Let the decoder upsample to the low resolution only, as onnxruntime
+            # computes all outputs even if they are not fetched
+            low_res_height = math.ceil(resized_height / 4)
+            low_res_width = math.ceil(resized_width / 4)
+            _, iou_preds, low_res_masks, cate_preds, fc_features = self._run_decoder(
+                embeddings, onnx_coord_batch, onnx_label_batch, low_res_width, low_res_height
+            )
+            mask_key = "low_res_masks"
+            masks = low_res_masks[:, 0, :, :]
+        else:
+            mask_key = "masks"
+            masks, iou_preds, _, cate_preds, fc_features = self._run_decoder(
+                embeddings, onnx_coord_batch, onnx_label_batch, input_image_width, input_image_height
+            )
+            masks = masks[:, 0, :, :]
+        iou_preds = iou_preds[:, 0]
+        cate_preds = np.argmax(cate_preds[:, 0, :], axis=1).astype(np.float32)
+        fc_features = fc_features[:, 0, :]
 
         data = MaskData(
-            masks=masks,
             iou_preds=iou_preds,
             cate_preds=cate_preds,
             fc_features=fc_features,
             points=points,
         )
+        data[mask_key] = masks
 
         del masks
         del fc_features
@@ -318,15 +433,25 @@ class SamAutomaticMaskGeneratorOnnx:
             print(f"number of masks filtered by iou_preds: {np.sum(~keep_mask)}")
             data.filter(keep_mask)
 
+        if self.low_res_filtering:
+            # Exclude the padding of the low resolution masks
+            stability_masks = data[mask_key][:, :low_res_height, :low_res_width]
+        else:
+            stability_masks = data[mask_key]
         data["stability_score"] = calculate_stability_score(
-            data["masks"], self.mask_threshold, self.stability_score_offset
+            stability_masks, self.mask_threshold, self.stability_score_offset
         )
+        del stability_masks
         if self.stability_score_thresh > 0.0:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
             print(f"number of masks filtered by stability_score: {np.sum(~keep_mask)}")
             data.filter(keep_mask)
 
-        data["masks"] = data["masks"] > self.mask_threshold
+        if self.low_res_filtering:
+            data["masks"] = self._upsample_masks(data["low_res_masks"], im_size)
+            del data["low_res_masks"]
+        else:
+            data["masks"] = data["masks"] > self.mask_threshold
         data["boxes"] = batched_mask_to_box(data["masks"])
 
         keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
@@ -342,6 +467,67 @@ class SamAutomaticMaskGeneratorOnnx:
 
         return data
 
+    def _run_decoder(
+        self,
+        embeddings: np.ndarray,
+        onnx_coords: np.ndarray,
+        onnx_labels: np.ndarray,
+        image_width: int,
+        image_height: int,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Decode a batch of prompts against the same image embedding.
+
+        Args:
+        - onnx_coords: (B, N, 2) point coordinates of B prompts
+        - onnx_labels: (B, N) point labels of B prompts
+
+        Returns:
+        - masks (B, 1, H, W), iou_preds (B, 1), low_res_masks (B, 1, 256, 256),
+          cate_preds (B, 1, C) and fc_features (B, 1, 256)
+        """
+        inputs = {
+            "image_embeddings": embeddings,
+            "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array([image_height, image_width], dtype=np.float32),
+        }
+
+        if self.decoder_batch_supported:
+            inputs["point_coords"] = onnx_coords
+            inputs["point_labels"] = onnx_labels
+            return tuple(self.decoder_onnx.run(None, inputs))
+
+        # Process the prompts one by one
+        outputs = []
+        for i in range(onnx_coords.shape[0]):
+            inputs["point_coords"] = onnx_coords[i : i + 1]
+            inputs["point_labels"] = onnx_labels[i : i + 1]
+            outputs.append(self.decoder_onnx.run(None, inputs))
+        return tuple(np.concatenate(output, axis=0) for output in zip(*outputs))
+
+    def _upsample_masks(
+        self,
+        low_res_masks: np.ndarray,
+        im_size: Tuple[int, ...],
+    ) -> np.ndarray:
+        """
+        Upsample the (N, 256, 256) low resolution mask logits to (N, H, W)
+        binary masks, the same way as the postprocessing of the decoder
+        """
+        im_height, im_width = im_size
+        # The decoder rounds the resized size, see SamOnnxModel.resize_longest_image_size
+        scale = 1024 / max(im_height, im_width)
+        resized_height = int(math.floor(im_height * scale + 0.5))
+        resized_width = int(math.floor(im_width * scale + 0.5))
+        masks = np.zeros((low_res_masks.shape[0], im_height, im_width), dtype=bool)
+        for i, low_res_mask in enumerate(low_res_masks):
+            mask = cv2.resize(low_res_mask, (1024, 1024), interpolation=cv2.INTER_LINEAR)
+            mask = mask[:resized_height, :resized_width]
+            mask = cv2.resize(mask, (im_width, im_height), interpolation=cv2.INTER_LINEAR)
+            masks[i] = mask > self.mask_threshold
+        return masks
+
     @staticmethod
     def postprocess_small_regions(
         mask_data: MaskData, min_area: int, nms_thresh: float
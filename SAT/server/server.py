@@ -4,10 +4,12 @@ import os
 
 from tkinter import Tk, filedialog, messagebox
 from .embedding import EmbeddingGenerator
+from .embeddingCache import EmbeddingCache
 
 # from .maskEiditor import MaskEidtor
 from .maskCreator import MaskCreator, Prompt
 from .util.general import get_resource_path
+from .util.thumbnail import ThumbnailCache, create_thumbnail
 
 from .project import (
     ProjectCreator,
@@ -15,10 +17,21 @@ from .project import (
     ProjectExportor,
     JsonImportor,
     ProjectSaver,
+    ProjectArchive,
+    MaskFeatureIndex,
 )
 from .util.requests import ProjectCreateRequest
 from .dataset import Dataset, Data
-from .util.coco import to_coco_annotation, rle_mask_to_rle_vis_encoding
+from .util.coco import (
+    to_coco_annotation,
+    crop_mask_to_coco_annotation,
+    crop_mask_to_rle_vis_runs,
+    numpy_mask_to_rle_vis_runs,
+    encode_rle_vis_base64,
+    RLE_VIS_FORMAT_LIST,
+    RLE_VIS_FORMAT_BASE64,
+    RLE_VIS_FORMATS,
+)
 from .util.requests import FileDialogRequest
 
 from typing import Dict, List, Tuple
@@ -49,6 +62,19 @@ class Server:
     SAM_DECODER_PATH = "models/vit_h_decoder_quantized.onnx"
     SAM_MODEL_TYPE = "vit_b"
 
+    # Embeddings shared across projects, so that images added to multiple
+    # projects are only encoded once
+    EMBEDDING_CACHE_DIR = os.path.join(
+        os.path.expanduser("~"), ".coralscop_lat", "embedding_cache"
+    )
+    EMBEDDING_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+    # Thumbnails of the projects created without them
+    THUMBNAIL_CACHE_DIR = os.path.join(
+        os.path.expanduser("~"), ".coralscop_lat", "thumbnail_cache"
+    )
+    THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -56,7 +82,16 @@ class Server:
         self.logger.info("Loading embedding encoder model ...")
         start_time = time.time()
         model_path = get_resource_path(Server.SAM_ENCODER_PATH)
-        self.embeddings_generator = EmbeddingGenerator(model_path)
+        embedding_cache = None
+        try:
+            embedding_cache = EmbeddingCache(
+                Server.EMBEDDING_CACHE_DIR,
+                model_path,
+                Server.EMBEDDING_CACHE_MAX_BYTES,
+            )
+        except OSError as e:
+            self.logger.warning(f"Embedding cache disabled: {e}")
+        self.embeddings_generator = EmbeddingGenerator(model_path, embedding_cache)
         self.logger.info(
             f"Embedding model loaded in {time.time() - start_time} seconds"
         )
@@ -73,11 +108,22 @@ class Server:
         # Project creation
         self.project_creator = ProjectCreator(self.embeddings_generator)
 
+        self.thumbnail_cache: ThumbnailCache = None
+        try:
+            self.thumbnail_cache = ThumbnailCache(
+                Server.THUMBNAIL_CACHE_DIR, Server.THUMBNAIL_CACHE_MAX_BYTES
+            )
+        except OSError as e:
+            self.logger.warning(f"Thumbnail cache disabled: {e}")
+
         # Dataset
         self.dataset: Dataset = None
         self.current_image_idx: int = 0
         self.project_path: str = None
 
+        # Built from the project on the first similarity query
+        self.mask_feature_index: MaskFeatureIndex = None
+
     def select_folder(self, file_dialog_request: FileDialogRequest):
         """
         Open a dialog to select a folder
@@ -184,7 +230,7 @@ class Server:
         self.logger.info(f"Loading project from {project_path} ...")
         project_loader = ProjectLoader()
 
-        dataset, last_image_idx = project_loader.load(project_path)
+        dataset, last_image_idx = project_loader.load(project_path, lazy=True)
         self.logger.info(f"Project loaded with last image idx: {last_image_idx}")
 
         self.set_dataset(dataset)
@@ -193,6 +239,63 @@ class Server:
         self.set_project_path(project_path)
         self.logger.info(f"Project path set to {self.project_path}")
 
+    def get_project_image(self, token: str, image_name: str) -> bytes:
+        """
+        Read an image of the opened project from the project file.
+
+        Returns:
+        - bytes: The image file, or None if the token does not match the
+          opened project or the image does not exist
+        """
+        if self.dataset is None:
+            return None
+
+        archive = self.dataset.get_archive()
+        if archive is None or archive.get_token() != token:
+            return None
+
+        image_member = ProjectArchive.image_member(image_name)
+        if not archive.contains(image_member):
+            return None
+        return archive.read(image_member)
+
+    def get_project_thumbnail(self, token: str, image_name: str) -> bytes:
+        """
+        Get the thumbnail of an image of the opened project. Projects created
+        without thumbnails get them generated on first request, and cached.
+
+        Returns:
+        - bytes: The JPEG thumbnail, or None if the token does not match the
+          opened project or the image does not exist
+        """
+        if self.dataset is None:
+            return None
+
+        archive = self.dataset.get_archive()
+        if archive is None or archive.get_token() != token:
+            return None
+
+        thumbnail_member = ProjectArchive.thumbnail_member(image_name)
+        if archive.contains(thumbnail_member):
+            return archive.read(thumbnail_member)
+
+        image_member = ProjectArchive.image_member(image_name)
+        if not archive.contains(image_member):
+            return None
+
+        key = None
+        if self.thumbnail_cache is not None:
+            info = archive.get_member_info(image_member)
+            key = self.thumbnail_cache.gen_key(image_name, info.CRC, info.file_size)
+            thumbnail = self.thumbnail_cache.get(key)
+            if thumbnail is not None:
+                return thumbnail
+
+        thumbnail = create_thumbnail(archive.read(image_member))
+        if self.thumbnail_cache is not None:
+            self.thumbnail_cache.put(key, thumbnail)
+        return thumbnail
+
     def get_current_data_dict(self) -> Dict:
         return self.get_data_dict(self.get_current_image_idx())
 
@@ -288,7 +391,10 @@ class Server:
         self.project_creator.terminate()
 
     def set_dataset(self, dataset):
+        if self.dataset is not None and self.dataset is not dataset:
+            self.dataset.close()
         self.dataset = dataset
+        self.mask_feature_index = None
 
     def get_dataset(self):
         return self.dataset
@@ -299,19 +405,60 @@ class Server:
 
         self.current_image_idx = image_idx
 
+        self.set_mask_session_image(MaskCreator.DEFAULT_SESSION_ID, image_idx)
+
+        # Warm up the embeddings of the neighbours for the next navigation
+        self.dataset.prefetch(image_idx)
+
+    def set_mask_session_image(self, session_id: str, image_idx: int):
+        """
+        Set the image prompted in the mask creator session
+        """
         data = self.get_data(image_idx)
         self.mask_creator.set_image(
-            data.get_embedding(),
+            self.dataset.get_embedding(image_idx),
             [
                 data.get_image_height(),
                 data.get_image_width(),
             ],
+            session_id,
+            image_idx,
         )
 
+    def prepare_mask_session(self, session_id: str, image_idx: int = None):
+        """
+        Switch the mask creator session to the image, if it prompts another image
+        """
+        if image_idx is None:
+            return
+        session = self.mask_creator.get_session(session_id)
+        if session.get_image_key() != image_idx:
+            self.set_mask_session_image(session_id, image_idx)
+
+    def speculate_mask(
+        self,
+        prompt_sets: List[List[Dict]],
+        session_id: str = MaskCreator.DEFAULT_SESSION_ID,
+        image_idx: int = None,
+        roi: bool = False,
+    ):
+        """
+        Decode the masks of the candidate prompt sets in the background, e.g.
+        the current prompts with the point under the pointer. A following
+        create_mask with one of the prompt sets, in the same session and mode,
+        takes the decoded mask instead of running the decoder.
+        """
+        self.prepare_mask_session(session_id, image_idx)
+        prompt_sets = [[Prompt(prompt) for prompt in prompts] for prompts in prompt_sets]
+        self.mask_creator.speculate(prompt_sets, session_id, roi)
+
+    def close_mask_session(self, session_id: str):
+        self.mask_creator.close_session(session_id)
+
     def get_current_image_idx(self):
         return self.current_image_idx
 
-    def save_data(self, data: Dict):
+    def save_data(self, data: Dict) -> int:
         """
         Save the data to the dataset
         {
@@ -319,6 +466,9 @@ class Server:
             "annotations": List[Dict]
             "category_info": List[Dict]
         }
+
+        Returns:
+            The new version of the data
         """
         self.logger.info(f"Saving data ...")
         segmentation = {}
@@ -328,6 +478,42 @@ class Server:
         data_idx = data["images"][0]["id"]
         self.dataset.update_data(data_idx, segmentation)
         self.dataset.set_category_info(data["category_info"])
+        self.update_mask_features(data_idx)
+        return self.dataset.get_data(data_idx).get_version()
+
+    def save_data_patch(self, patch: Dict) -> Dict:
+        """
+        Save the changes of the annotations of one image to the dataset,
+        instead of the whole segmentation
+        {
+            "idx": int - Image idx,
+            "version": int - Version of the data the changes are based on,
+            "added": List[Dict] - New annotations,
+            "updated": List[Dict] - Changed annotations, by id,
+            "deleted": List[int] - Ids of the removed annotations,
+            "category_info": List[Dict] - Optional, only if changed
+        }
+
+        Returns:
+            {
+                "success": bool - False if the data changed since the version,
+                "version": int - Current version of the data
+            }
+        """
+        data_idx = patch["idx"]
+        self.logger.info(
+            f"Saving data {data_idx}: {len(patch.get('added', []))} added, {len(patch.get('updated', []))} updated, {len(patch.get('deleted', []))} deleted"
+        )
+        success = self.dataset.patch_data(data_idx, patch["version"], patch)
+        if success:
+            self.update_mask_features(data_idx)
+        if success and patch.get("category_info") is not None:
+            self.dataset.set_category_info(patch["category_info"])
+
+        return {
+            "success": success,
+            "version": self.dataset.get_data(data_idx).get_version(),
+        }
 
     @time_it
     def save_dataset(self, output_path: str):
@@ -338,7 +524,20 @@ class Server:
         self.logger.info(f"Saving the dataset to {output_path} ...")
 
         project_saver = ProjectSaver()
-        project_saver.save_dataset(self.dataset, self.get_project_path(), output_path)
+
+        archive = self.dataset.get_archive()
+        if archive is None:
+            project_saver.save_dataset(
+                self.dataset, self.get_project_path(), output_path
+            )
+            return
+
+        # The project file is held open by the dataset. Release it while
+        # the project is rewritten.
+        with archive.released():
+            project_saver.save_dataset(
+                self.dataset, self.get_project_path(), output_path
+            )
 
     def get_project_path(self) -> str:
         return self.project_path
@@ -350,12 +549,82 @@ class Server:
         data_list = self.dataset.get_data_list_by_category_id(category_id)
         return [data.get_idx() for data in data_list]
 
-    def create_mask(self, prompts: List[Dict]) -> Dict:
+    def get_mask_feature_index(self) -> MaskFeatureIndex:
+        if self.mask_feature_index is None:
+            self.mask_feature_index = MaskFeatureIndex.from_dataset(self.dataset)
+        return self.mask_feature_index
+
+    def update_mask_features(self, image_idx: int):
+        """
+        Set the changed annotations of the image in the mask feature index, if
+        it is built, so that the masks of the changed ids are not matched with
+        the features of the masks they replaced
+        """
+        if self.mask_feature_index is None:
+            return
+        data = self.dataset.get_data(image_idx)
+        self.mask_feature_index.set_annotations(
+            image_idx, data.get_segmentation()["annotations"]
+        )
+
+    @time_it
+    def get_similar_masks(
+        self,
+        image_idx: int,
+        annotation_id: int,
+        top_k: int = 100,
+        min_similarity: float = 0.8,
+    ) -> List[Dict]:
+        """
+        Find the detected corals of all images in the project that are most
+        similar to the given detected coral, by the cosine similarity of their
+        decoder features.
+
+        Only the corals detected when the project was created have features,
+        as long as their masks are not changed. Other masks return no result.
+
+        Returns:
+        - List[Dict]: The masks sorted by descending similarity:
+            {
+                "image_idx": int,
+                "annotation_id": int,
+                "similarity": float
+            }
+        """
+        mask_feature_index = self.get_mask_feature_index()
+        if not mask_feature_index.contains(image_idx, annotation_id):
+            self.logger.info(
+                f"No feature for annotation {annotation_id} of image {image_idx}"
+            )
+            return []
+        return mask_feature_index.get_similar_masks(
+            image_idx, annotation_id, top_k, min_similarity
+        )
+
+    def create_mask(
+        self,
+        prompts: List[Dict],
+        session_id: str = MaskCreator.DEFAULT_SESSION_ID,
+        image_idx: int = None,
+        rle_format: str = RLE_VIS_FORMAT_LIST,
+        roi: bool = False,
+    ) -> Dict:
         """
         Create a mask based on the prompts
 
         Args:
             prompts: List of prompts
+            session_id: Id of the mask creator session of the client. Each
+                session keeps its own image and prompt sequence, so that
+                several windows or clients can create masks in parallel.
+            image_idx: Image to prompt. The session switches to it, if it
+                prompts another image. The default session prompts the
+                current image.
+            rle_format: Encoding of the RLE for frontend visualization,
+                "list" for a list of run lengths in "rle", or "base64" for
+                the run lengths packed as uint32 in "rle_base64"
+            roi: Decode only the region of interest around the mask, so that
+                the cost depends on the size of the mask instead of the image
 
         Returns:
             A dictionary containing the mask annotation,
@@ -371,13 +640,28 @@ class Server:
                 "rle": rle-encoded mask, added for frontend visualization
             }
         """
+        assert rle_format in RLE_VIS_FORMATS, f"Invalid RLE format: {rle_format}"
         self.logger.info(f"Creating mask ...")
 
+        self.prepare_mask_session(session_id, image_idx)
+
         prompts = [Prompt(prompt) for prompt in prompts]
-        mask = self.mask_creator.create_mask(prompts)
-        annotation = to_coco_annotation(mask)
+        if roi:
+            mask, offset = self.mask_creator.create_mask_roi(prompts, session_id)
+            image_size = self.mask_creator.get_session(session_id).get_image_size()
+            annotation = crop_mask_to_coco_annotation(mask, offset, image_size)
+            run_lengths = crop_mask_to_rle_vis_runs(mask, offset, image_size)
+        else:
+            mask = self.mask_creator.create_mask(prompts, session_id)
+            annotation = to_coco_annotation(mask)
+            # The runs are taken from the decoded mask, instead of the COCO RLE
+            run_lengths = numpy_mask_to_rle_vis_runs(mask)
         annotation["category_id"] = -2  # Category id for prompted mask
-        annotation["rle"] = rle_mask_to_rle_vis_encoding(annotation["segmentation"])
+
+        if rle_format == RLE_VIS_FORMAT_BASE64:
+            annotation["rle_base64"] = encode_rle_vis_base64(run_lengths)
+        else:
+            annotation["rle"] = run_lengths.tolist()
 
         return annotation
 
@@ -426,12 +710,16 @@ class Server:
 
                 for annotation in segmentation["annotations"]:
                     annotation["image_id"] = data_idx
+                data.drop_stale_feature_ids(segmentation["annotations"])
                 data.set_segmentation(imported_data.get_segmentation())
+                self.dataset.mark_dirty(data_idx)
             else:
                 # If not matching found, then set the annotation to empty
                 self.logger.error(f"Data not found for {data_name}")
                 image_data = data.get_segmentation()["images"][0]
                 data.set_segmentation({"images": [image_data], "annotations": []})
+                self.dataset.mark_dirty(data.get_idx())
+            self.update_mask_features(data.get_idx())
 
         self.logger.info(f"Matched {matched_count} data")
         self.dataset.set_category_info(improted_dataset.get_category_info())
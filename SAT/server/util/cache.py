@@ -0,0 +1,62 @@
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache of numpy arrays,
+    bounded by the total number of bytes of the stored arrays.
+    """
+
+    def __init__(self, max_bytes: int):
+        assert max_bytes >= 0, "Cache size must be non-negative"
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: Hashable, value: np.ndarray):
+        nbytes = value.nbytes
+        with self.lock:
+            if key in self.items:
+                self.size_bytes -= self.items.pop(key).nbytes
+
+            # Do not let a single item flush the whole cache
+            if nbytes > self.max_bytes:
+                return
+
+            self.items[key] = value
+            self.size_bytes += nbytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size_bytes -= evicted.nbytes
+
+    def contains(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.items
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            if key in self.items:
+                self.size_bytes -= self.items.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size_bytes = 0
+
+    def get_size_bytes(self) -> int:
+        return self.size_bytes
+
+    def get_max_bytes(self) -> int:
+        return self.max_bytes
@@ -1,8 +1,14 @@
+import base64
 from pycocotools import mask as coco_mask
 import numpy as np
 from typing import Dict, List
 import cv2
 
+# Encodings of the run lengths used by the frontend
+RLE_VIS_FORMAT_LIST = "list"
+RLE_VIS_FORMAT_BASE64 = "base64"
+RLE_VIS_FORMATS = [RLE_VIS_FORMAT_LIST, RLE_VIS_FORMAT_BASE64]
+
 
 def is_rel_encoding(segmentation: Dict) -> bool:
     return "counts" in segmentation and "size" in segmentation
@@ -12,28 +18,143 @@ def is_polygon_encoding(segmentation: List) -> bool:
     return type(segmentation) == list
 
 
+def decode_rle_counts(segmentation: Dict) -> np.ndarray:
+    """
+    Get the run lengths of the COCO RLE, alternating between 0s and 1s and
+    starting with 0s, in column-major order. The compressed counts string is
+    decoded without decoding the mask.
+    """
+    counts = segmentation["counts"]
+    if isinstance(counts, list):
+        return np.array(counts, dtype=np.int64)
+    if isinstance(counts, str):
+        counts = counts.encode("utf-8")
+
+    # Each count is a variable length integer of 5 bits per character, where
+    # 0x20 marks that more characters follow and 0x10 of the last character
+    # is the sign
+    chars = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    if len(chars) == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_last = (chars & 0x20) == 0
+    value_idxs = np.concatenate(([0], np.cumsum(is_last)[:-1]))
+    value_starts = np.concatenate(([0], np.nonzero(is_last)[0][:-1] + 1))
+    shifts = 5 * (np.arange(len(chars)) - value_starts[value_idxs])
+
+    values = np.zeros(int(is_last.sum()), dtype=np.int64)
+    np.add.at(values, value_idxs, (chars & 0x1F) << shifts)
+    last_chars = np.nonzero(is_last)[0]
+    is_negative = (chars[last_chars] & 0x10) != 0
+    values[is_negative] |= -1 << (shifts[last_chars[is_negative]] + 5)
+
+    # Counts after the third are stored as the difference to the count two
+    # places before
+    run_lengths = values.copy()
+    run_lengths[2::2] = np.cumsum(values[2::2])
+    run_lengths[1::2] = np.cumsum(values[1::2])
+    return run_lengths
+
+
 def rle_mask_to_rle_vis_encoding(segmentation: Dict) -> List[int]:
-    arr = coco_mask.decode(segmentation)
+    """
+    Convert the COCO RLE to the run lengths used by the frontend, which
+    alternate between 0s and 1s starting with 0s, in row-major order.
+    """
+    return rle_mask_to_rle_vis_runs(segmentation).tolist()
+
+
+def rle_mask_to_rle_vis_runs(segmentation: Dict) -> np.ndarray:
+    """
+    Convert the COCO RLE to the run lengths used by the frontend, as an array.
+
+    The column-major runs of the COCO RLE are transposed without decoding
+    the mask, so the cost depends on the number of runs rather than on the
+    image resolution.
+    """
+    height, width = segmentation["size"]
+    run_lengths = decode_rle_counts(segmentation)
+    ends = np.cumsum(run_lengths)
+    starts = ends - run_lengths
+
+    # Foreground runs, split at the column boundaries into (column, y0, y1)
+    starts, ends = starts[1::2], ends[1::2]
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+    first_columns = starts // height
+    num_columns = (ends - 1) // height - first_columns + 1
+    segment_runs = np.repeat(np.arange(len(starts)), num_columns)
+    columns = first_columns[segment_runs] + (
+        np.arange(len(segment_runs))
+        - np.repeat(np.cumsum(num_columns) - num_columns, num_columns)
+    )
+    y0 = np.maximum(starts[segment_runs] - columns * height, 0)
+    y1 = np.minimum(ends[segment_runs] - columns * height, height)
+
+    # Each column is a step function of y, toggled at y0 and y1. A row-major
+    # pixel differs from the pixel before it where the toggles of its column
+    # and of the column before it have an odd count. The pixel before the
+    # first pixel of a row is the last pixel of the previous row.
+    toggle_columns = np.concatenate((columns, columns))
+    toggle_rows = np.concatenate((y0, y1))
+    next_columns = toggle_columns + 1
+    next_rows = toggle_rows + (next_columns == width)
+    event_columns = np.concatenate((toggle_columns, next_columns % width))
+    event_rows = np.concatenate((toggle_rows, next_rows))
+    valid = event_rows < height
+    event_columns, event_rows = event_columns[valid], event_rows[valid]
+
+    order = np.lexsort((event_rows, event_columns))
+    event_columns, event_rows = event_columns[order], event_rows[order]
+
+    # Pair the events of each column into the row intervals of odd count,
+    # closing the last interval of a column at the bottom of the image
+    unique_columns, column_counts = np.unique(event_columns, return_counts=True)
+    odd_columns = unique_columns[column_counts % 2 == 1]
+    if len(odd_columns) > 0:
+        event_columns = np.concatenate((event_columns, odd_columns))
+        event_rows = np.concatenate(
+            (event_rows, np.full(len(odd_columns), height, dtype=event_rows.dtype))
+        )
+        order = np.lexsort((event_rows, event_columns))
+        event_columns, event_rows = event_columns[order], event_rows[order]
+    interval_columns = event_columns[0::2]
+    interval_starts = event_rows[0::2]
+    interval_lengths = event_rows[1::2] - interval_starts
+
+    # Row-major indices of the pixels that differ from the pixel before them
+    interval_idxs = np.repeat(np.arange(len(interval_lengths)), interval_lengths)
+    rows = interval_starts[interval_idxs] + (
+        np.arange(len(interval_idxs))
+        - np.repeat(np.cumsum(interval_lengths) - interval_lengths, interval_lengths)
+    )
+    changes = np.sort(rows * width + interval_columns[interval_idxs])
 
-    # Flatten the 2D array to a 1D array
-    flat = arr.flatten()
+    # A mask starting with 1s starts with an empty run of 0s
+    indices = np.concatenate(([0], changes, [height * width]))
+    return np.diff(indices)
 
-    # Find the indices where the value changes
-    diffs = np.diff(flat)
-    change_indices = np.where(diffs != 0)[0] + 1
 
-    # Include the start and end indices
-    indices = np.concatenate(([0], change_indices, [len(flat)]))
+def numpy_mask_to_rle_vis_runs(mask: np.ndarray) -> np.ndarray:
+    """
+    Get the run lengths used by the frontend of the (H, W) binary mask
+    """
+    flat = mask.ravel().astype(bool, copy=False)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
 
-    # Compute the run lengths
-    run_lengths = np.diff(indices)
+    # A mask starting with 1s starts with an empty run of 0s
+    first_change = [0] if len(flat) > 0 and flat[0] else []
+    indices = np.concatenate(([0], first_change, changes, [len(flat)]))
+    return np.diff(indices)
 
-    # Ensure the encoding starts with zero
-    if flat[0] == 0:
-        return run_lengths.tolist()
-    else:
-        # Insert a zero at the beginning to start with zero
-        return np.insert(run_lengths, 0, 0).tolist()
+
+def encode_rle_vis_base64(run_lengths: np.ndarray) -> str:
+    """
+    Pack the run lengths used by the frontend as little-endian uint32 in a
+    base64 string, which is much smaller and faster to serialize to JSON and
+    to parse in the frontend than a list of numbers
+    """
+    data = np.asarray(run_lengths, dtype="<u4").tobytes()
+    return base64.b64encode(data).decode("ascii")
 
 
 def numpy_mask_to_rle_mask(mask: np.ndarray) -> Dict:
@@ -92,6 +213,95 @@ def to_coco_annotation(mask: np.ndarray) -> Dict:
     return annotation
 
 
+def crop_mask_to_runs(
+    crop: np.ndarray, major_offset: int, minor_offset: int, minor_size: int, total_size: int
+) -> np.ndarray:
+    """
+    Get the run lengths, alternating between 0s and 1s and starting with 0s,
+    of an image that is empty except for the binary crop, in the order of
+    the flattened (major, minor) image. The cost depends on the size of the
+    crop only.
+
+    Args:
+    - crop: (n_major, n_minor) binary crop
+    - major_offset, minor_offset: Position of the crop in the image
+    - minor_size: Size of the image along the minor axis
+    - total_size: Number of pixels of the image
+    """
+    n_major, n_minor = crop.shape
+
+    # The zero padding makes each line of the crop start and end with 0s, so
+    # the changes of the padded crop are the starts and ends of the runs of 1s
+    padded = np.pad(crop.astype(np.int8, copy=False), ((0, 0), (1, 1)))
+    changes = np.flatnonzero(np.diff(padded.ravel())) + 1
+    majors = changes // (n_minor + 2)
+    minors = changes % (n_minor + 2) - 1
+    positions = (major_offset + majors) * minor_size + minor_offset + minors
+
+    # A run of 1s ending at the end of a line and the run starting at the
+    # start of the next line are one run in the image
+    merged = np.zeros(len(positions), dtype=bool)
+    same = np.flatnonzero(positions[1:] == positions[:-1])
+    merged[same] = True
+    merged[same + 1] = True
+    positions = positions[~merged]
+
+    # A run of 1s ending at the end of the image has no run of 0s after it
+    positions = positions[positions < total_size]
+
+    indices = np.concatenate(([0], positions, [total_size]))
+    return np.diff(indices)
+
+
+def crop_mask_to_rle_vis_runs(
+    crop: np.ndarray, offset: List[int], image_size: List[int]
+) -> np.ndarray:
+    """
+    Get the run lengths used by the frontend of an image that is empty except
+    for the (h, w) binary crop at offset [x, y]
+    """
+    height, width = image_size
+    return crop_mask_to_runs(crop, offset[1], offset[0], width, height * width)
+
+
+def crop_mask_to_coco_annotation(
+    crop: np.ndarray, offset: List[int], image_size: List[int]
+) -> Dict:
+    """
+    Same as to_coco_annotation, for an image that is empty except for the
+    (h, w) binary crop at offset [x, y]. The RLE is built from the runs of
+    the crop, without the mask of the whole image.
+    """
+    height, width = image_size
+    counts = crop_mask_to_runs(crop.T, offset[0], offset[1], height, height * width)
+    rle = coco_mask.frPyObjects(
+        {"counts": counts.tolist(), "size": [height, width]}, height, width
+    )
+    rle["counts"] = rle["counts"].decode("utf-8")
+
+    rows = np.flatnonzero(crop.any(axis=1))
+    columns = np.flatnonzero(crop.any(axis=0))
+    bbox = [0, 0, 0, 0]
+    if len(rows) > 0:
+        bbox = [
+            int(offset[0] + columns[0]),
+            int(offset[1] + rows[0]),
+            int(columns[-1] - columns[0] + 1),
+            int(rows[-1] - rows[0] + 1),
+        ]
+
+    annotation = {
+        "segmentation": rle,
+        "bbox": bbox,
+        "area": int(np.count_nonzero(crop)),
+        "category_id": -1,
+        "id": -1,
+        "image_id": -1,
+        "iscrowd": 0,
+    }
+    return annotation
+
+
 def rle_mask_to_poly_mask(rle: Dict) -> List[int]:
     mask = decode_rle_mask(rle)
     # Find contours using OpenCV
@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+from typing import Any, BinaryIO, Callable, Optional
+
+
+class DiskCache:
+    """
+    Folder of cached files keyed by name, bounded by the total size of the
+    files. The least recently used files are evicted first, using the
+    modification time of the files, which is refreshed on every hit, so the
+    order is kept across sessions and shared by the processes using the folder.
+
+    cache_dir/
+        <key><extension>
+    """
+
+    def __init__(self, cache_dir: str, extension: str, max_bytes: int):
+        assert max_bytes >= 0, "Cache size must be non-negative"
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = cache_dir
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Size of the cached files, from the least to the most recently used
+        self.entries: OrderedDict = OrderedDict()
+        self.size_bytes = 0
+        self.load_entries()
+        self.evict()
+
+    def load_entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(self.extension):
+                continue
+            stat = entry.stat()
+            entries.append(
+                (stat.st_mtime_ns, entry.name[: -len(self.extension)], stat.st_size)
+            )
+
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+            self.size_bytes += size
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{self.extension}")
+
+    def get(self, key: str, load: Callable[[str], Any]) -> Optional[Any]:
+        """
+        Load the cached file with the given function of its path
+
+        Returns:
+        - The loaded value, or None if the key is not cached
+        """
+        path = self.get_path(key)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+
+        try:
+            value = load(path)
+            os.utime(path)
+        except (OSError, ValueError) as e:
+            # e.g. evicted by another process sharing the cache
+            self.logger.warning(f"Failed to load cached file {key}: {e}")
+            self.remove(key)
+            return None
+        return value
+
+    def put(self, key: str, write: Callable[[BinaryIO], None], size: int):
+        """
+        Cache the file written by the given function into a binary file.
+        The file is written to a temporary file first, so that a reader never
+        sees a partial file.
+
+        Args:
+        - size: Expected size of the file. Files larger than the cache are skipped.
+        """
+        if size > self.max_bytes:
+            return
+
+        path = self.get_path(key)
+        temp_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                write(f)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            self.logger.warning(f"Failed to cache file {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)
+            self.entries[key] = size
+            self.size_bytes += size
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits its budget
+        """
+        evicted = []
+        with self.lock:
+            while self.size_bytes > self.max_bytes:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self.get_path(evicted_key))
+            except OSError:
+                pass
+
+    def remove(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def get_num_entries(self) -> int:
+        return len(self.entries)
+
+    def get_size_bytes(self) -> int:
+        return self.size_bytes
+
+    def get_max_bytes(self) -> int:
+        return self.max_bytes
@@ -0,0 +1,129 @@
+import numpy as np
+
+from pycocotools import mask as coco_mask
+from typing import Dict, List, Optional
+
+
+def box_iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Compute the IoU between every pair of XYXY boxes
+
+    Args:
+    - boxes_a: (N, 4) boxes
+    - boxes_b: (M, 4) boxes
+
+    Returns:
+    - np.ndarray: (N, M) IoU matrix
+    """
+    boxes_a = boxes_a.astype(np.float32, copy=False)
+    boxes_b = boxes_b.astype(np.float32, copy=False)
+    areas_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    areas_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    width = np.minimum.outer(boxes_a[:, 2], boxes_b[:, 2])
+    width -= np.maximum.outer(boxes_a[:, 0], boxes_b[:, 0])
+    np.clip(width, 0, None, out=width)
+    height = np.minimum.outer(boxes_a[:, 3], boxes_b[:, 3])
+    height -= np.maximum.outer(boxes_a[:, 1], boxes_b[:, 1])
+    np.clip(height, 0, None, out=height)
+
+    intersection = width * height
+    union = np.add.outer(areas_a, areas_b)
+    union -= intersection
+    np.maximum(union, 1e-10, out=union)
+    return intersection / union
+
+
+def greedy_suppress(iou_matrix: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Greedy non-maximum suppression on the IoU matrix of items sorted by
+    descending score. An item is suppressed if its IoU with a kept item of
+    higher score is above the threshold.
+
+    Returns:
+    - np.ndarray: Boolean mask of the kept items
+    """
+    keep = np.ones(iou_matrix.shape[0], dtype=bool)
+
+    # Only the pairs above the threshold can suppress, grouped by the item
+    # of higher score
+    rows, cols = np.nonzero(np.triu(iou_matrix > iou_threshold, 1))
+    if len(rows) == 0:
+        return keep
+    suppressing_items, starts = np.unique(rows, return_index=True)
+    for i, suppressed_items in zip(suppressing_items, np.split(cols, starts[1:])):
+        if keep[i]:
+            keep[suppressed_items] = False
+    return keep
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Non-maximum suppression of XYXY boxes
+
+    Returns:
+    - np.ndarray: Indices of the kept boxes, sorted by descending score
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    boxes = np.asarray(boxes)[order]
+    keep = greedy_suppress(box_iou_matrix(boxes, boxes), iou_threshold)
+    return order[keep]
+
+
+def to_coco_rles(rles: List[Dict]) -> List[Dict]:
+    """
+    Convert the RLEs to the compressed RLEs expected by pycocotools.
+    Uncompressed RLEs have the counts as a list of run lengths.
+    """
+    coco_rles = []
+    for rle in rles:
+        if isinstance(rle["counts"], list):
+            height, width = rle["size"]
+            rle = coco_mask.frPyObjects(rle, height, width)
+        coco_rles.append(rle)
+    return coco_rles
+
+
+def masks_to_rles(masks: np.ndarray) -> List[Dict]:
+    """
+    Encode (N, H, W) binary masks to compressed RLEs
+    """
+    masks = np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8))
+    return coco_mask.encode(masks)
+
+
+def mask_iou_matrix(rles_a: List[Dict], rles_b: Optional[List[Dict]] = None) -> np.ndarray:
+    """
+    Compute the IoU between every pair of masks, on their RLEs. Pairs whose
+    bounding boxes do not overlap are skipped without decoding the RLEs.
+
+    Args:
+    - rles_a: N RLEs
+    - rles_b: M RLEs, or None to compare rles_a with itself
+
+    Returns:
+    - np.ndarray: (N, M) IoU matrix
+    """
+    rles_a = to_coco_rles(rles_a)
+    rles_b = rles_a if rles_b is None else to_coco_rles(rles_b)
+    if len(rles_a) == 0 or len(rles_b) == 0:
+        return np.zeros((len(rles_a), len(rles_b)), dtype=np.float64)
+    return np.asarray(coco_mask.iou(rles_a, rles_b, [0] * len(rles_b)))
+
+
+def mask_nms(rles: List[Dict], scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Non-maximum suppression of masks by their IoU
+
+    Returns:
+    - np.ndarray: Indices of the kept masks, sorted by descending score
+    """
+    if len(rles) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    rles = to_coco_rles(rles)
+    sorted_rles = [rles[i] for i in order]
+    keep = greedy_suppress(mask_iou_matrix(sorted_rles), iou_threshold)
+    return order[keep]
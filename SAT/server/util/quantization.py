@@ -0,0 +1,92 @@
+import numpy as np
+
+from io import BytesIO
+from typing import Tuple, Union
+
+EMBEDDING_DTYPES = ["float32", "float16", "int8"]
+
+# Embeddings are quantized per channel, i.e. along axis 1 of 1 x 256 x 64 x 64
+CHANNEL_AXIS = 1
+
+INT8_MIN = -128
+INT8_MAX = 127
+
+
+def quantize_int8(embedding: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Quantize the embedding to int8 with a scale and zero point per channel,
+    such that embedding ~= (quantized - zero_point) * scale
+
+    Returns:
+    - np.ndarray: Quantized embedding, int8 with the shape of the embedding
+    - np.ndarray: Scale per channel, float32 of shape (channels,)
+    - np.ndarray: Zero point per channel, float32 of shape (channels,)
+    """
+    embedding = embedding.astype(np.float32)
+    reduce_axes = tuple(i for i in range(embedding.ndim) if i != CHANNEL_AXIS)
+
+    # Make sure that zero is representable
+    min_value = np.minimum(embedding.min(axis=reduce_axes), 0.0)
+    max_value = np.maximum(embedding.max(axis=reduce_axes), 0.0)
+
+    scale = (max_value - min_value) / (INT8_MAX - INT8_MIN)
+    scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+    zero_point = np.round(INT8_MIN - min_value / scale).astype(np.float32)
+
+    shape = [1] * embedding.ndim
+    shape[CHANNEL_AXIS] = -1
+    quantized = np.round(embedding / scale.reshape(shape)) + zero_point.reshape(shape)
+    quantized = np.clip(quantized, INT8_MIN, INT8_MAX).astype(np.int8)
+    return quantized, scale, zero_point
+
+
+def dequantize_int8(
+    quantized: np.ndarray, scale: np.ndarray, zero_point: np.ndarray
+) -> np.ndarray:
+    shape = [1] * quantized.ndim
+    shape[CHANNEL_AXIS] = -1
+    embedding = quantized.astype(np.float32) - zero_point.reshape(shape)
+    embedding *= scale.reshape(shape)
+    return embedding
+
+
+def get_embedding_extension(dtype: str) -> str:
+    """
+    Int8 embeddings are stored with their quantization parameters in a npz file
+    """
+    return ".npz" if dtype == "int8" else ".npy"
+
+
+def save_embedding(file: Union[str, BytesIO], embedding: np.ndarray, dtype: str):
+    """
+    Save the float32 embedding in the given data type
+    """
+    assert dtype in EMBEDDING_DTYPES, f"Unsupported embedding dtype {dtype}"
+    if dtype == "int8":
+        quantized, scale, zero_point = quantize_int8(embedding)
+        np.savez(file, embedding=quantized, scale=scale, zero_point=zero_point)
+    else:
+        np.save(file, embedding.astype(dtype))
+
+
+def load_embedding(file: Union[str, BytesIO], dtype: str) -> np.ndarray:
+    """
+    Load the embedding saved by save_embedding, as float32
+    """
+    assert dtype in EMBEDDING_DTYPES, f"Unsupported embedding dtype {dtype}"
+    if dtype == "int8":
+        with np.load(file) as stored:
+            return dequantize_int8(
+                stored["embedding"], stored["scale"], stored["zero_point"]
+            )
+    return np.load(file).astype(np.float32, copy=False)
+
+
+def encode_embedding(embedding: np.ndarray, dtype: str) -> bytes:
+    buffer = BytesIO()
+    save_embedding(buffer, embedding, dtype)
+    return buffer.getvalue()
+
+
+def decode_embedding(data: bytes, dtype: str) -> np.ndarray:
+    return load_embedding(BytesIO(data), dtype)
@@ -13,10 +13,24 @@ class ProjectCreateRequest:
                     "image_path": "/path/to/image.jpg"
                 }
             ],
-            "output_file": "/path/to/output"
+            "output_file": "/path/to/output",
+            "config": {
+                "embeddingLayout": "npy" or "packed",
+                "embeddingDtype": "float32", "float16" or "int8",
+                "encoderBatchSize": 1,
+                "resume": false,
+                "detectCoral": false,
+                "minArea": 0.001,
+                "minConfidence": 0.5,
+                "maxIOU": 0.01,
+            }
         }
 
         If the image_path is provided, the image_url will be ignored.
+        The config is optional. With resume enabled, an interrupted creation
+        of the same output continues from the inputs it has completed.
+        With detectCoral enabled, the corals detected in each image are saved
+        as annotations. minArea is the fraction of the image area.
         """
         self.request = request
         assert "inputs" in request, "Missing 'inputs' in request"
@@ -28,6 +42,33 @@ class ProjectCreateRequest:
     def get_output_file(self) -> str:
         return self.request["output_file"]
 
+    def get_config(self) -> Dict:
+        return self.request.get("config", {})
+
+    def get_embedding_layout(self) -> str:
+        return self.get_config().get("embeddingLayout", "npy")
+
+    def get_embedding_dtype(self) -> str:
+        return self.get_config().get("embeddingDtype", "float32")
+
+    def get_encoder_batch_size(self) -> int:
+        return self.get_config().get("encoderBatchSize", 1)
+
+    def get_resume(self) -> bool:
+        return self.get_config().get("resume", False)
+
+    def get_detect_coral(self) -> bool:
+        return self.get_config().get("detectCoral", False)
+
+    def get_min_area(self) -> float:
+        return self.get_config().get("minArea", 0.001)
+
+    def get_min_confidence(self) -> float:
+        return self.get_config().get("minConfidence", 0.5)
+
+    def get_max_iou(self) -> float:
+        return self.get_config().get("maxIOU", 0.01)
+
 
 class FileDialogRequest:
 
@@ -0,0 +1,59 @@
+import hashlib
+import numpy as np
+
+from io import BytesIO
+from PIL import Image
+from typing import Optional, Union
+from .diskCache import DiskCache
+
+# Longest side of the thumbnails shown in the gallery
+THUMBNAIL_SIZE = 256
+THUMBNAIL_EXTENSION = ".jpg"
+THUMBNAIL_QUALITY = 85
+
+
+def create_thumbnail(image: Union[np.ndarray, bytes], size: int = THUMBNAIL_SIZE) -> bytes:
+    """
+    Create the JPEG thumbnail of an image, given as its pixels or its encoded file
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    else:
+        image = Image.open(BytesIO(image))
+        # Let the JPEG decoder downscale while decoding, which is much faster
+        image.draft("RGB", (size, size))
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((size, size), Image.Resampling.BILINEAR)
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+
+class ThumbnailCache:
+    """
+    Sidecar cache of the thumbnails of projects created without thumbnails.
+    The thumbnails are keyed by the image name and the checksum and size of
+    the image in the project, so they stay valid when the project is saved
+    or copied. The total size of the cached thumbnails is bounded, see DiskCache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache = DiskCache(cache_dir, THUMBNAIL_EXTENSION, max_bytes)
+
+    def gen_key(self, image_name: str, crc: int, file_size: int) -> str:
+        key = f"{image_name}:{crc:08x}:{file_size}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.cache.get(key, read_file)
+
+    def put(self, key: str, thumbnail: bytes):
+        self.cache.put(key, lambda f: f.write(thumbnail), len(thumbnail))
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
@@ -13,6 +13,10 @@ class ActionState {
         // Do nothing by default
     }
 
+    hoverPixel(imageX, imageY) {
+        // Do nothing by default
+    }
+
     registerShortCut(key, callback) {
         this.shortCutsDict[key] = callback;
     }
@@ -82,6 +86,10 @@ class MaskCreationState extends ActionState {
     rightClickPixel(imageX, imageY) {
         this.maskCreator.addPrompt(imageX, imageY, Prompt.NEGATIVE);
     }
+
+    hoverPixel(imageX, imageY) {
+        this.maskCreator.speculate(imageX, imageY);
+    }
 }
 
 /**
@@ -120,6 +128,10 @@ class ActionManager {
         this.state.leftClickPixel(imageX, imageY);
     }
 
+    hoverPixel(imageX, imageY) {
+        this.state.hoverPixel(imageX, imageY);
+    }
+
     setState(stateId) {
         switch (stateId) {
             case ActionManager.STATE_SELECT_MASK:
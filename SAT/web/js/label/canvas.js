@@ -167,6 +167,36 @@ class Canvas {
             const actionManager = new ActionManager();
             actionManager.rightClickPixel(imageX, imageY);
         });
+
+        this.canvas.addEventListener("mousemove", (event) => {
+            if (this.isDragging || this.data === null) {
+                return;
+            }
+
+            let [canvasX, canvasY] = this.getMousePos(event);
+            canvasX = Math.floor(canvasX);
+            canvasY = Math.floor(canvasY);
+
+            let [imageX, imageY] = this.canvasPixelToImagePixel(
+                canvasX,
+                canvasY
+            );
+
+            const imageHeight = this.data.getImageHeight();
+            const imageWidth = this.data.getImageWidth();
+
+            if (
+                imageX < 0 ||
+                imageX >= imageWidth ||
+                imageY < 0 ||
+                imageY >= imageHeight
+            ) {
+                return;
+            }
+
+            const actionManager = new ActionManager();
+            actionManager.hoverPixel(imageX, imageY);
+        });
     }
 
     showData(data) {
@@ -5,6 +5,18 @@ class Core {
     static DEFAULT_HISTORY_SIZE = 10;
     static ISSUE_URL = "https://github.com/ykwongaq/ImageAnnotator/issues";
 
+    // Mask creator session of this page in the backend. Each page has its
+    // own session, so that windows labelling different images do not reset
+    // each other's image and prompt state.
+    static MASK_SESSION_ID = `${Date.now().toString(36)}-${Math.random()
+        .toString(36)
+        .slice(2)}`;
+    // The prompted masks are sent as base64 packed run lengths, which are
+    // much faster to transfer and parse than a list of numbers
+    static MASK_RLE_FORMAT = "base64";
+    // Decode only the region around the prompted mask in the backend
+    static MASK_ROI_DECODING = true;
+
     constructor() {
         if (Core.instance) {
             return Core.instance;
@@ -15,6 +27,10 @@ class Core {
 
         this.dataModified = false;
 
+        // State of the data last saved to or loaded from the backend, to
+        // send only the changed annotations on save
+        this.syncedState = null;
+
         return this;
     }
 
@@ -119,6 +135,7 @@ class Core {
 
                             const data = Data.parseResponse(response);
                             this.setData(data);
+                            this.setSyncedState(response["version"]);
 
                             this.dataHistoryManager = new HistoryManager(
                                 Core.DEFAULT_HISTORY_SIZE
@@ -237,7 +254,81 @@ class Core {
     }
 
     /**
-     * Save the current data
+     * Record the current data as the state of the backend
+     * @param {number} version - Version of the data in the backend
+     */
+    setSyncedState(version) {
+        this.syncedState = this.createSyncedState(version);
+    }
+
+    createSyncedState(version) {
+        const annotations = new Map();
+        for (const mask of this.data.getMasks()) {
+            annotations.set(mask.getId(), JSON.stringify(mask.toJson()));
+        }
+
+        const categoryManager = new CategoryManager();
+        return {
+            idx: this.data.getIdx(),
+            version: version,
+            annotations: annotations,
+            categoryInfo: JSON.stringify(categoryManager.toJson()),
+        };
+    }
+
+    /**
+     * Create the changes of the current data since the synced state
+     * {
+     *   "idx": number,
+     *   "version": number,
+     *   "added": List[Dict],
+     *   "updated": List[Dict],
+     *   "deleted": List[number],
+     *   "category_info": List[Dict], only if changed
+     * }
+     * @returns {Object} The patch, or null if nothing changed
+     */
+    createPatch() {
+        const state = this.createSyncedState(this.syncedState.version);
+        const patch = {
+            idx: state.idx,
+            version: state.version,
+            added: [],
+            updated: [],
+            deleted: [],
+        };
+
+        for (const [maskId, annotation] of state.annotations) {
+            const syncedAnnotation = this.syncedState.annotations.get(maskId);
+            if (syncedAnnotation === undefined) {
+                patch.added.push(JSON.parse(annotation));
+            } else if (syncedAnnotation !== annotation) {
+                patch.updated.push(JSON.parse(annotation));
+            }
+        }
+        for (const maskId of this.syncedState.annotations.keys()) {
+            if (!state.annotations.has(maskId)) {
+                patch.deleted.push(maskId);
+            }
+        }
+        if (state.categoryInfo !== this.syncedState.categoryInfo) {
+            patch["category_info"] = JSON.parse(state.categoryInfo);
+        }
+
+        if (
+            patch.added.length === 0 &&
+            patch.updated.length === 0 &&
+            patch.deleted.length === 0 &&
+            !("category_info" in patch)
+        ) {
+            return null;
+        }
+        return patch;
+    }
+
+    /**
+     * Save the changes of the current data since it was last saved or loaded.
+     * The whole data is saved if there is no synced state of it:
      * {
      *   "images": List[Dict]
      *   "annotations": List[Dict]
@@ -246,6 +337,46 @@ class Core {
      * @param {function} callBack
      */
     save(callBack = null, errorCallBack = null) {
+        if (
+            this.syncedState === null ||
+            this.syncedState.idx !== this.data.getIdx()
+        ) {
+            this.saveAll(callBack, errorCallBack);
+            return;
+        }
+
+        const patch = this.createPatch();
+        if (patch === null) {
+            if (callBack != null) {
+                callBack();
+            }
+            return;
+        }
+
+        const state = this.createSyncedState(null);
+        eel.save_data_patch(patch)()
+            .then((response) => {
+                if (!response["success"]) {
+                    throw new Error(
+                        "The annotations of this image were changed elsewhere. Please reload the image."
+                    );
+                }
+                state.version = response["version"];
+                this.syncedState = state;
+
+                if (callBack != null) {
+                    callBack();
+                }
+            })
+            .catch((error) => {
+                if (errorCallBack != null) {
+                    errorCallBack(error);
+                }
+                this.popUpError(error);
+            });
+    }
+
+    saveAll(callBack = null, errorCallBack = null) {
         const data = this.data.toJson();
 
         const categoryManager = new CategoryManager();
@@ -254,7 +385,9 @@ class Core {
         data["category_info"] = categoryInfo;
 
         eel.save_data(data)()
-            .then(() => {
+            .then((version) => {
+                this.setSyncedState(version);
+
                 if (callBack != null) {
                     callBack();
                 }
@@ -285,6 +418,7 @@ class Core {
                     maskCreator.clearPrompts();
 
                     this.setData(Data.parseResponse(response));
+                    this.setSyncedState(response["version"]);
 
                     this.dataHistoryManager = new HistoryManager(
                         Core.DEFAULT_HISTORY_SIZE
@@ -322,6 +456,7 @@ class Core {
                     maskCreator.clearPrompts();
 
                     this.setData(Data.parseResponse(response));
+                    this.setSyncedState(response["version"]);
                     this.dataHistoryManager = new HistoryManager(
                         Core.DEFAULT_HISTORY_SIZE
                     );
@@ -358,6 +493,7 @@ class Core {
                     maskCreator.clearPrompts();
 
                     this.setData(Data.parseResponse(response));
+                    this.setSyncedState(response["version"]);
                     this.dataHistoryManager = new HistoryManager(
                         Core.DEFAULT_HISTORY_SIZE
                     );
@@ -406,7 +542,13 @@ class Core {
     }
 
     createPromptedMask(prompts, callBack = null, errorCallBack = null) {
-        eel.create_mask(prompts)()
+        eel.create_mask(
+            prompts,
+            Core.MASK_SESSION_ID,
+            this.data.getIdx(),
+            Core.MASK_RLE_FORMAT,
+            Core.MASK_ROI_DECODING
+        )()
             .then((annotation) => {
                 if (callBack != null) {
                     callBack(annotation);
@@ -420,6 +562,32 @@ class Core {
             });
     }
 
+    /**
+     * Release the mask creator session of this page in the backend
+     */
+    closeMaskSession() {
+        eel.close_mask_session(Core.MASK_SESSION_ID)().catch((error) => {
+            console.error(error);
+        });
+    }
+
+    /**
+     * Ask the backend to decode the masks of the candidate prompt sets in
+     * the background, so that adding one of them returns at once.
+     * Failures are only logged, as nothing waits for the result.
+     * @param {Array} promptSets List of candidate lists of prompts
+     */
+    speculatePromptedMask(promptSets) {
+        eel.speculate_mask(
+            promptSets,
+            Core.MASK_SESSION_ID,
+            this.data.getIdx(),
+            Core.MASK_ROI_DECODING
+        )().catch((error) => {
+            console.error(error);
+        });
+    }
+
     setDataModified(modified) {
         this.dataModified = modified;
     }
@@ -671,6 +839,7 @@ class Core {
 
                             const data = Data.parseResponse(response);
                             this.setData(data);
+                            this.setSyncedState(response["version"]);
                             this.dataHistoryManager = new HistoryManager(
                                 Core.DEFAULT_HISTORY_SIZE
                             );
@@ -362,11 +362,33 @@ class Mask {
 
     getDecodedMask() {
         if (this.decodeMask === null) {
-            this.decodeMask = this.decodeRleMask(this.annotation["rle"]);
+            if ("rle_base64" in this.annotation) {
+                this.decodeMask = this.decodeRleMask(
+                    Mask.decodeBase64Rle(this.annotation["rle_base64"])
+                );
+            } else {
+                this.decodeMask = this.decodeRleMask(this.annotation["rle"]);
+            }
         }
         return this.decodeMask;
     }
 
+    /**
+     * Decode the run lengths packed as little-endian uint32 in base64
+     * @param {string} rleBase64
+     * @returns {Uint32Array} Run lengths
+     */
+    static decodeBase64Rle(rleBase64) {
+        const binary = atob(rleBase64);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        // Browsers run on little-endian platforms, so the bytes can be
+        // viewed as uint32 directly
+        return new Uint32Array(bytes.buffer);
+    }
+
     decodeRleMask(rle_mask) {
         const totalLength = rle_mask.reduce((sum, len) => sum + len, 0);
         const mask = new Uint8Array(totalLength); // Use Uint8Array for better performance
@@ -435,7 +457,7 @@ class Mask {
     }
 
     toJson() {
-        return {
+        const annotation = {
             id: this.getId(),
             image_id: this.getImageId(),
             category_id: this.category.getCategoryId(),
@@ -445,6 +467,11 @@ class Mask {
             iscrowd: this.annotation["iscrowd"],
             predicted_iou: this.annotation["predicted_iou"],
         };
+        // Keep the link of a detected coral to its feature in the project
+        if ("feature_id" in this.annotation) {
+            annotation["feature_id"] = this.annotation["feature_id"];
+        }
+        return annotation;
     }
 
     deepCopy() {
@@ -20,6 +20,7 @@ class GalleryPage {
      * {
      *      "image_name": Name of the image
      *      "image_path": Path to the image,
+     *      "thumbnail_path": Path to the downscaled image, or null,
      *      "idx": index of the data,
      *  }
      * @param {Object} galleryDataList - List of dictionary that containing the gallery data
@@ -39,9 +40,14 @@ class GalleryPage {
         );
         const item = galleryItem.querySelector(".gallery-item");
 
-        // Show image
+        // Show the thumbnail, if any. The images are only loaded when
+        // scrolled into view.
         const imageElement = item.querySelector("img");
-        imageElement.src = encodeURIComponent(galleryData.image_path);
+        imageElement.loading = "lazy";
+        imageElement.decoding = "async";
+        imageElement.src = encodeURIComponent(
+            galleryData.thumbnail_path || galleryData.image_path
+        );
 
         // Show filename
         const idx = galleryData.idx;
@@ -104,6 +104,13 @@ function main() {
         console.log(core.getData());
         return core.isDataModified();
     };
+
+    // The page may stay if the user cancels the unload, so the session is
+    // only released once the page is hidden
+    window.addEventListener("pagehide", () => {
+        const core = new Core();
+        core.closeMaskSession();
+    });
 }
 
 document.addEventListener("DOMContentLoaded", main);
@@ -38,6 +38,9 @@ class Prompt {
 }
 
 class MaskCreator {
+    // Minimum time between two speculative decodings of the hovered pixel (ms)
+    static SPECULATION_INTERVAL = 100;
+
     constructor() {
         if (MaskCreator.instance) {
             return MaskCreator.instance;
@@ -46,6 +49,9 @@ class MaskCreator {
 
         this.prompts = [];
         this.mask = null;
+
+        this.hoveredPixel = null;
+        this.speculationTimer = null;
     }
 
     addPrompt(imageX, imageY, label) {
@@ -53,6 +59,31 @@ class MaskCreator {
         this.updateMask();
     }
 
+    /**
+     * Decode the mask of adding a positive prompt at the hovered pixel in
+     * the background, so that clicking on it shows the mask at once.
+     * The requests are throttled, and only the latest hovered pixel is sent.
+     * @param {number} imageX
+     * @param {number} imageY
+     */
+    speculate(imageX, imageY) {
+        this.hoveredPixel = [imageX, imageY];
+        if (this.speculationTimer !== null) {
+            return;
+        }
+
+        this.speculationTimer = setTimeout(() => {
+            this.speculationTimer = null;
+            const [x, y] = this.hoveredPixel;
+            const prompts = this.prompts.concat([
+                new Prompt(x, y, Prompt.POSITIVE),
+            ]);
+
+            const core = new Core();
+            core.speculatePromptedMask([prompts]);
+        }, MaskCreator.SPECULATION_INTERVAL);
+    }
+
     clearPrompts() {
         this.prompts = [];
         this.mask = null;